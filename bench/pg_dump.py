@@ -0,0 +1,75 @@
+""" Dump and restore benchmark against a local Postgres stand-in.
+
+Fills a scratch database with a number of equally sized tables, then times
+a single threaded custom format dump and restore, which is what `fuku pg
+dump` and `fuku pg restore` used to do, against directory format with
+parallel jobs. Connection details come from the usual PG* environment
+variables and the role needs permission to create databases.
+
+    python bench/pg_dump.py [--tables N] [--rows N] [--jobs N]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+SOURCE = 'fuku_bench_source'
+TARGET = 'fuku_bench_target'
+
+
+def psql(dbname, sql):
+    subprocess.run(
+        ['psql', '-q', '-v', 'ON_ERROR_STOP=1', '-d', dbname, '-c', sql],
+        check=True, stdout=subprocess.DEVNULL
+    )
+
+
+def recreate(dbname):
+    psql('postgres', f'DROP DATABASE IF EXISTS {dbname}')
+    psql('postgres', f'CREATE DATABASE {dbname}')
+
+
+def timed(argv):
+    start = time.perf_counter()
+    subprocess.run(argv, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tables', type=int, default=8, help='number of tables')
+    parser.add_argument('--rows', type=int, default=500000, help='rows per table')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help='parallel jobs')
+    args = parser.parse_args()
+
+    recreate(SOURCE)
+    for ii in range(args.tables):
+        psql(SOURCE, (
+            f'CREATE TABLE t{ii} AS SELECT g AS id, md5(g::text) AS a, md5((g * 2)::text) AS b'
+            f' FROM generate_series(1, {args.rows}) g;'
+            f' ALTER TABLE t{ii} ADD PRIMARY KEY (id)'
+        ))
+
+    work = tempfile.mkdtemp()
+    try:
+        dump_file = os.path.join(work, 'bench.dump')
+        dump_dir = os.path.join(work, 'bench.dir')
+        serial = timed(['pg_dump', '-Fc', '-x', '-O', '-d', SOURCE, '-f', dump_file])
+        parallel = timed(['pg_dump', '-Fd', '-j', str(args.jobs), '-x', '-O', '-d', SOURCE, '-f', dump_dir])
+        print(f'dump: {serial:.1f}s serial, {parallel:.1f}s with {args.jobs} jobs ({serial / parallel:.1f}x)')
+
+        recreate(TARGET)
+        serial = timed(['pg_restore', '-x', '-O', '-d', TARGET, dump_file])
+        recreate(TARGET)
+        parallel = timed(['pg_restore', '-x', '-O', '-j', str(args.jobs), '-d', TARGET, dump_dir])
+        print(f'restore: {serial:.1f}s serial, {parallel:.1f}s with {args.jobs} jobs ({serial / parallel:.1f}x)')
+    finally:
+        shutil.rmtree(work)
+        psql('postgres', f'DROP DATABASE IF EXISTS {TARGET}')
+        psql('postgres', f'DROP DATABASE IF EXISTS {SOURCE}')
+
+
+if __name__ == '__main__':
+    main()
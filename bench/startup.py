@@ -0,0 +1,67 @@
+""" Startup time benchmark for the fuku CLI.
+
+Runs a handful of commands that never touch AWS and compares them against
+the same commands with boto3, fabric and every fuku module imported up
+front, which is what the CLI used to do on every invocation.
+
+    python bench/startup.py [--runs N]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'fuku', 'scripts', 'fuku')
+COMMANDS = [
+    ['session', 'sh'],
+    ['region', 'ls'],
+]
+EAGER = (
+    'import importlib, runpy, sys\n'
+    'for name in ("boto3", "fabric.operations"):\n'
+    '    try:\n'
+    '        importlib.import_module(name)\n'
+    '    except ImportError:\n'
+    '        pass\n'
+    'for name in ("session", "profile", "region", "cluster", "node", "app", "image",\n'
+    '             "task", "service", "redis", "pg", "metrics", "datadog", "route"):\n'
+    '    importlib.import_module("fuku." + name)\n'
+    'sys.argv = sys.argv[1:]\n'
+    'runpy.run_path(sys.argv[0], run_name="__main__")\n'
+)
+
+
+def timed(argv, env, runs):
+    times = []
+    for ii in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, env=env, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', '-n', type=int, default=10, help='runs per command')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home, PYTHONPATH=ROOT, PYTHONWARNINGS='ignore')
+        base = timed([sys.executable, '-c', 'pass'], env, args.runs)
+        print(f'interpreter startup: {base * 1000:.0f}ms')
+        for cmd in COMMANDS:
+            lazy = timed([sys.executable, SCRIPT] + cmd, env, args.runs)
+            eager = timed([sys.executable, '-c', EAGER, SCRIPT] + cmd, env, args.runs)
+            print(
+                f'fuku {" ".join(cmd)}: {lazy * 1000:.0f}ms lazy, {eager * 1000:.0f}ms eager'
+                f' ({lazy / eager:.0%} of eager, {(lazy - base) / (eager - base):.0%} excluding'
+                ' interpreter startup)'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -185,7 +185,7 @@ class EcsApp(App):
     def iter_target_groups(self):
         self.use_context = False
         ctx = self.get_context()
-        paginate = self.get_boto_paginator('elbv2', 'describe_target_groups').paginate()
+        paginate = self.get_boto_paginator('elbv2', 'describe_target_groups', cache=True).paginate()
         for gr in paginate.search(
             'TargetGroups[?starts_with(TargetGroupName, `"fuku-{cluster}-"`)] '.format(**ctx) +
             '| sort_by(@, &TargetGroupName)'
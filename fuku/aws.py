@@ -0,0 +1,134 @@
+import json
+import os
+import threading
+
+from .cache import get_cache
+
+# Size of the urllib3 connection pool held by each client. Concurrent callers
+# sharing a client will block once this many connections are in use.
+MAX_POOL_CONNECTIONS = int(os.environ.get('FUKU_MAX_POOL_CONNECTIONS', 10))
+
+# Seconds to keep responses from read-only calls made through cached
+# clients. Anything not listed here uses DEFAULT_CACHE_TTL.
+DEFAULT_CACHE_TTL = 60
+CACHE_TTLS = {
+    'ec2.DescribeInstanceTypes': 7 * 24 * 3600,
+    'ec2.DescribeInternetGateways': 24 * 3600,
+    'ec2.DescribeSecurityGroups': 3600,
+    'ec2.DescribeSubnets': 24 * 3600,
+    'ec2.DescribeVpcs': 24 * 3600,
+    'ecr.DescribeRepositories': 3600,
+    'ecs.ListClusters': 3600,
+    'elasticache.DescribeCacheClusters': 3600,
+    'elbv2.DescribeTargetGroups': 300,
+    'rds.DescribeDBInstances': 3600,
+}
+READ_PREFIXES = ('Describe', 'List', 'Get', 'Head', 'BatchGet')
+
+_lock = threading.RLock()
+_sessions = {}
+_clients = {}
+_resources = {}
+
+
+def get_config():
+    from botocore.config import Config
+    return Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+
+
+def get_session(profile=None, region=None):
+    key = (profile, region)
+    with _lock:
+        try:
+            return _sessions[key]
+        except KeyError:
+            pass
+        import boto3
+        session = boto3.Session(profile_name=profile, region_name=region)
+        # Registered on the session so every client and resource inherits it.
+        session.events.register('after-call', _invalidate_handler(profile, region))
+        _sessions[key] = session
+        return session
+
+
+def get_client(service, profile=None, region=None, cache=False):
+    key = (service, profile, region, cache)
+    with _lock:
+        try:
+            return _clients[key]
+        except KeyError:
+            pass
+        client = get_session(profile, region).client(service, config=get_config())
+        if cache:
+            register_cache(client, profile, region)
+        _clients[key] = client
+        return client
+
+
+def get_resource(service, profile=None, region=None, cache=False):
+    # Resources are not thread safe, so each thread gets its own.
+    key = (service, profile, region, cache, threading.get_ident())
+    with _lock:
+        try:
+            return _resources[key]
+        except KeyError:
+            pass
+        resource = get_session(profile, region).resource(service, config=get_config())
+        if cache:
+            register_cache(resource.meta.client, profile, region)
+        _resources[key] = resource
+        return resource
+
+
+def get_namespace(service, profile, region):
+    return f'aws:{profile}:{region}:{service}'
+
+
+def is_read_only(operation):
+    return operation.startswith(READ_PREFIXES)
+
+
+def register_cache(client, profile, region):
+    """ Serve read-only calls made through `client` from the local cache.
+    """
+    cache = get_cache()
+
+    def build_key(params, model, context, **kwargs):
+        if not is_read_only(model.name) or model.has_streaming_output:
+            return
+        service = model.service_model.service_name
+        context['fuku_cache'] = (
+            get_namespace(service, profile, region),
+            model.name + ':' + json.dumps(params, sort_keys=True, default=str),
+            CACHE_TTLS.get(f'{service}.{model.name}', DEFAULT_CACHE_TTL)
+        )
+
+    def lookup(model, context, **kwargs):
+        if 'fuku_cache' not in context:
+            return
+        namespace, key, ttl = context['fuku_cache']
+        parsed = cache.get(namespace, key)
+        if parsed is not None:
+            from botocore.awsrequest import AWSResponse
+            context['fuku_cache_hit'] = True
+            return AWSResponse(None, 200, {}, None), parsed
+
+    def store(http_response, parsed, model, context, **kwargs):
+        if 'fuku_cache' not in context or context.get('fuku_cache_hit'):
+            return
+        if http_response.status_code < 300:
+            namespace, key, ttl = context['fuku_cache']
+            cache.set(namespace, key, parsed, ttl)
+
+    client.meta.events.register('before-parameter-build', build_key)
+    client.meta.events.register('before-call', lookup)
+    client.meta.events.register('after-call', store)
+
+
+def _invalidate_handler(profile, region):
+    def invalidate(http_response, model, **kwargs):
+        if is_read_only(model.name) or http_response.status_code >= 300:
+            return
+        service = model.service_model.service_name
+        get_cache().invalidate(get_namespace(service, profile, region))
+    return invalidate
@@ -0,0 +1,92 @@
+import os
+import pickle
+import stat
+import threading
+import time
+
+from .db import get_rc_path
+
+
+class Cache(object):
+    """ Small key/value store kept in an SQLite database under the fuku
+    RC path. Values are grouped into namespaces so related entries can be
+    invalidated together, and expire after an optional TTL in seconds.
+
+    Clearing `enabled` stops both reads and writes, while `refresh` skips
+    reads but still stores fresh values. Invalidation always applies.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.enabled = True
+        self.refresh = False
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            import sqlite3
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError:
+                pass
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            # Entries may include credentials, such as registry tokens.
+            os.chmod(self.path, stat.S_IRUSR | stat.S_IWUSR)
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                ' namespace TEXT NOT NULL,'
+                ' key TEXT NOT NULL,'
+                ' value BLOB NOT NULL,'
+                ' expires REAL,'
+                ' PRIMARY KEY (namespace, key))'
+            )
+            conn.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, namespace, key, default=None):
+        if not self.enabled or self.refresh:
+            return default
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT value, expires FROM cache WHERE namespace = ? AND key = ?',
+                (namespace, key)
+            ).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return default
+        return pickle.loads(row[0])
+
+    def set(self, namespace, key, value, ttl=None):
+        if not self.enabled:
+            return
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO cache (namespace, key, value, expires) VALUES (?, ?, ?, ?)',
+                (namespace, key, pickle.dumps(value), expires)
+            )
+            self.conn.commit()
+
+    def invalidate(self, namespace, key=None):
+        with self._lock:
+            if key is None:
+                self.conn.execute('DELETE FROM cache WHERE namespace = ?', (namespace,))
+            else:
+                self.conn.execute(
+                    'DELETE FROM cache WHERE namespace = ? AND key = ?',
+                    (namespace, key)
+                )
+            self.conn.commit()
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = Cache(os.path.join(get_rc_path(), 'cache.sqlite'))
+    return _cache
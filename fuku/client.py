@@ -1,8 +1,11 @@
 import argparse
+import importlib
 import logging
+from collections import OrderedDict
 
 from colorama import Fore
 
+from .cache import get_cache
 from .db import get_default_db, save_db
 
 
@@ -10,52 +13,109 @@ class Client(object):
     global_arguments = {('app', 'application'), ('pg', 'DB instance')}
 
     def __init__(self):
-        self.modules = []
+        self._modules = OrderedDict()
         self.parser = argparse.ArgumentParser()
-        self.parser.add_argument(
+        self.add_global_arguments(self.parser)
+        self.db = get_default_db()
+        self.contexts = {}
+        self.logger = logging.getLogger('fuku.client')
+
+    def add_global_arguments(self, parser):
+        parser.add_argument(
             f'--log',
             help='Log level. Default: WARNING',
             choices=('CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'),
         )
 
+        parser.add_argument(
+            '--no-cache', action='store_true',
+            help='Neither read nor store cached AWS responses'
+        )
+        parser.add_argument(
+            '--refresh', action='store_true',
+            help='Ignore cached AWS responses, storing fresh ones'
+        )
+
         # global arguments
         for arg, verbose_name in self.global_arguments:
-            self.parser.add_argument(
+            parser.add_argument(
                 f'--{arg}', metavar=arg.upper(),
                 help=f'Global {verbose_name} argument overwriting context'
             )
 
-        self.db = get_default_db()
-        self.logger = logging.getLogger('fuku.client')
-
     def add_module(self, module):
-        module = module(db=self.db, client=self)
-        for mod in self.modules:
-            if mod.name == module.name:
-                raise TypeError('duplicate modules: {}'.format(mod.name))
-        self.modules.append(module)
+        """ Add either a module class, or a `(name, 'package.module.Class')`
+        pair that is only imported once it's needed.
+        """
+        if isinstance(module, tuple):
+            name, module = module
+        else:
+            module = module(db=self.db, client=self)
+            name = module.name
+        if name in self._modules:
+            raise TypeError('duplicate modules: {}'.format(name))
+        self._modules[name] = module
 
     def add_modules(self, *args):
         for mod in args:
             self.add_module(mod)
 
-    def add_arguments(self):
+    def load_module(self, name):
+        path, cls_name = self._modules[name].rsplit('.', 1)
+        cls = getattr(importlib.import_module(path), cls_name)
+        module = cls(db=self.db, client=self)
+        if module.name != name:
+            raise TypeError('module {} is named {}'.format(name, module.name))
+        self._modules[name] = module
+        return module
+
+    @property
+    def modules(self):
+        return [self.get_module(name) for name in self._modules]
+
+    def iter_stored_modules(self, names=()):
+        """ Modules with saved state, or named in `names`. Modules without
+        either have nothing to save or show, so aren't imported.
+        """
+        for name in self._modules:
+            if self.db.get(name) or name in names:
+                yield self.get_module(name)
+
+    def get_command(self, argv=None):
+        parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+        self.add_global_arguments(parser)
+        _, remaining = parser.parse_known_args(argv)
+        for arg in remaining:
+            if not arg.startswith('-'):
+                return arg
+
+    def add_arguments(self, argv=None):
         subp = self.parser.add_subparsers()
 
-        for mod in self.modules:
-            modp = subp.add_parser(mod.name)
-            mod.add_arguments(modp)
-            modp.set_defaults(handler=mod.entry)
+        # Only the module being invoked needs its arguments built.
+        command = self.get_command(argv)
+        for name in self._modules:
+            modp = subp.add_parser(name)
+            if name == command:
+                mod = self.get_module(name)
+                mod.add_arguments(modp)
+                modp.set_defaults(handler=mod.entry)
 
     def get_module(self, name):
-        for mod in self.modules:
-            if mod.name == name:
-                return mod
-        raise KeyError('no module named {}'.format(name))
+        try:
+            module = self._modules[name]
+        except KeyError:
+            raise KeyError('no module named {}'.format(name))
+        if isinstance(module, str):
+            module = self.load_module(name)
+        return module
 
     def get_selected(self, module):
         return self.get_module(module).get_selected()
 
+    def invalidate_contexts(self):
+        self.contexts.clear()
+
     def iter_parent_modules(self, name):
         self.logger.debug('Iterating parent modules')
         for mod in self.modules:
@@ -64,9 +124,9 @@ class Client(object):
                 yield mod
 
     def iter_dependent_modules(self, parent):
-        for mod in self.modules:
-            if mod.name in parent.dependencies:
-                yield mod
+        for name in self._modules:
+            if name in parent.dependencies:
+                yield self.get_module(name)
 
     def entry(self):
         self.add_arguments()
@@ -77,6 +137,10 @@ class Client(object):
         logformat = f'{Fore.CYAN}%(levelname)-10s {Fore.GREEN}%(name)s\t{Fore.RESET}%(message)s'
         logging.basicConfig(level=loglevel, format=logformat)
 
+        cache = get_cache()
+        cache.enabled = not self.args.no_cache
+        cache.refresh = self.args.refresh
+
         try:
             handler = self.args.handler
         except AttributeError:
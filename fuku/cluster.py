@@ -1,3 +1,4 @@
+import json
 import os
 import random
 import re
@@ -5,6 +6,7 @@ import stat
 
 from .db import get_rc_path
 from .module import Module
+from .parallel import StepFailed, imap_concurrent, run_graph
 from .utils import EntityAlreadyExists, entity_already_exists
 
 ARN_PROG = re.compile(r'[^/]*/fuku-(.+)')
@@ -26,6 +28,7 @@ class Cluster(Module):
         p = subp.add_parser('mk', help='make a cluster')
         p.add_argument('name', metavar='NAME', help='cluster name')
         p.add_argument('--type', '-t', choices=['swarm', 'ecs'], default='ecs', help='cluster type')
+        p.add_argument('--restart', action='store_true', help='ignore progress from a failed attempt')
         p.set_defaults(cluster_handler=self.handle_make)
 
         p = subp.add_parser('sl', help='select a cluster')
@@ -48,26 +51,65 @@ class Cluster(Module):
             print(cl)
 
     def handle_make(self, args):
-        self.make(args.name, args.type)
+        self.make(args.name, args.type, args.restart)
 
-    def make(self, name, type):
+    def make(self, name, type, restart=False):
         self.validate(name)
-        vpc = self.create_vpc(name, type)
-        self.create_subnets(name, vpc)
-        self.create_igw(name)
-        nat_id = self.create_nat(name)
-        self.create_route_tables(name, nat_id)
-        ecs = self.get_boto_client('ecs')
-        ecs.create_cluster(
-            clusterName=f'fuku-{name}'
-        )
-        ec2 = self.get_boto_client('ec2')
-        self.create_key_pair(name, ec2=ec2)
-        sg_id = self.create_security_group(name, vpc, ec2=ec2)
-        self.create_log_group(name)
-        self.create_alb(name, vpc.id, sg_id)
+
+        def vpc_resource(vpc_id):
+            return self.get_boto_resource('ec2').Vpc(vpc_id)
+
+        # Each step maps to the steps it needs and a function of their
+        # results. Results are recorded in the journal, so must be JSON.
+        steps = {
+            'vpc': ([], lambda r: self.create_vpc(name, type).id),
+            'subnets': (['vpc'], lambda r: self.create_subnets(name, vpc_resource(r['vpc']))),
+            'igw': (['vpc'], lambda r: self.create_igw(name).id),
+            'eip': ([], lambda r: self.create_eip()),
+            'nat': (['subnets', 'eip'], lambda r: self.create_nat(name, r['eip'])),
+            'route_tables': (['nat', 'igw'], lambda r: self.create_route_tables(name, r['nat'])),
+            'ecs_cluster': ([], lambda r: self.create_ecs_cluster(name)),
+            'key_pair': ([], lambda r: self.create_key_pair(name)),
+            'security_group': (['vpc'], lambda r: self.create_security_group(name, vpc_resource(r['vpc']))),
+            'log_group': ([], lambda r: self.create_log_group(name)),
+            'alb': (['vpc', 'subnets', 'security_group'],
+                    lambda r: self.create_alb(name, r['vpc'], r['security_group'])),
+        }
+
+        path = self.get_make_journal_path(name)
+        journal = {}
+        if os.path.exists(path):
+            if restart:
+                os.remove(path)
+            else:
+                with open(path) as journal_f:
+                    journal = json.load(journal_f)
+                print(f'resuming, already done: {", ".join(sorted(journal))}')
+
+        def checkpoint(step, journal):
+            print(f'{step} [DONE]')
+            with open(f'{path}.tmp', 'w') as journal_f:
+                json.dump(journal, journal_f)
+            os.replace(f'{path}.tmp', path)
+
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+        try:
+            # Creating the key pair prompts for a passphrase, which mustn't
+            # be interleaved with other steps' output.
+            run_graph(steps, journal=journal, on_done=checkpoint, serial=['key_pair'])
+        except StepFailed as e:
+            # Steps that exited through self.error have already said why.
+            reason = f': {e.error}' if str(e.error) else ''
+            self.error(f'failed to create "{e.step}"{reason}\nrun again to resume')
+        os.remove(path)
         self.select(name)
 
+    def get_make_journal_path(self, name):
+        return os.path.join(get_rc_path(), name, 'make.json')
+
     def handle_update(self, args):
         self.update(args.name, args.pem)
 
@@ -113,34 +155,56 @@ class Cluster(Module):
     def handle_summary(self, args):
         self.summary()
 
-    def summary(self):
+    def summary(self, workers=8):
         app_mod = self.get_module('app')
         svc_mod = self.get_module('service')
-        for app in app_mod.iter_apps():
-            all_svcs = []
-            for svc in svc_mod.iter_services(app_name=app):
-                svc_data = svc_mod.describe_service(svc, app_name=app)
-                all_svcs.append((svc, svc_data))
-            print(f'{app}')
-            all_svcs = sorted(all_svcs, key=lambda x: x[0])
+
+        # One pass over the cluster's services, grouped by app.
+        apps = {app: [] for app in app_mod.iter_apps()}
+        for arn in svc_mod.iter_service_arns():
+            _, app, _ = arn[arn.rfind('/') + 1:].split('-', 2)
+            apps.setdefault(app, []).append(arn)
+
+        # Print each app as soon as all of its services are described.
+        remaining = {app: len(arns) for app, arns in apps.items()}
+        described = {app: [] for app in apps}
+        for app in sorted(app for app, cnt in remaining.items() if not cnt):
+            self.print_app_summary(app, [])
+        arns = [arn for app_arns in apps.values() for arn in app_arns]
+        for services in svc_mod.iter_service_descriptions(arns, workers):
+            for svc in services:
+                _, app, _ = svc['serviceName'].split('-', 2)
+                described[app].append(svc)
+                remaining[app] -= 1
+                if not remaining[app]:
+                    self.print_app_summary(app, described[app])
+        # Services deleted since being listed are never described.
+        for app in sorted(app for app, cnt in remaining.items() if cnt):
+            self.print_app_summary(app, described[app])
+
+    def print_app_summary(self, app, services):
+        print(f'{app}')
+        all_svcs = sorted(
+            (svc['serviceName'].split('-', 2)[2], svc) for svc in services
+        )
+        try:
+            max_w = max(len(s[0]) for s in all_svcs)
+        except ValueError:
+            max_w = None
+        for svc, data in all_svcs:
+            if max_w:
+                w = max_w - len(svc)
+            else:
+                w = 0
             try:
-                max_w = max(len(s[0]) for s in all_svcs)
-            except ValueError:
-                max_w = None
-            for svc, data in all_svcs:
-                if max_w:
-                    w = max_w - len(svc)
-                else:
-                    w = 0
-                try:
-                    des_cnt = data['deployments'][0]['desiredCount']
-                    run_cnt = data['deployments'][0]['runningCount']
-                    print(f'  {svc}{w * " "}  {des_cnt}  {run_cnt}')
-                except:
-                    pass
+                des_cnt = data['deployments'][0]['desiredCount']
+                run_cnt = data['deployments'][0]['runningCount']
+                print(f'  {svc}{w * " "}  {des_cnt}  {run_cnt}')
+            except (KeyError, IndexError):
+                pass
 
     def iter_clusters(self):
-        ecs = self.get_boto_client('ecs')
+        ecs = self.get_boto_client('ecs', cache=True)
         for cl in ecs.list_clusters()['clusterArns']:
             m = ARN_PROG.match(cl)
             if not m:
@@ -364,6 +428,12 @@ class Cluster(Module):
         for sn in self.iter_public_subnets(name):
             rt.associate_with_subnet(SubnetId=sn.id)
 
+    def create_ecs_cluster(self, name):
+        ecs = self.get_boto_client('ecs')
+        ecs.create_cluster(
+            clusterName=f'fuku-{name}'
+        )
+
     def create_eip(self):
         ec2_cli = self.get_boto_client('ec2')
         return ec2_cli.allocate_address(
@@ -488,7 +558,7 @@ class Cluster(Module):
         if name is None:
             name = self.get_context()['cluser']
         if ec2 is None:
-            ec2 = self.get_boto_resource('ec2')
+            ec2 = self.get_boto_resource('ec2', cache=True)
         vpcs = ec2.vpcs.filter(Filters=[{'Name': 'tag:cluster', 'Values': [name]}])
         for vpc in vpcs:
             return vpc
@@ -509,54 +579,37 @@ class Cluster(Module):
             )['GroupId']
         if sg_id is None:
             sg_id = self.get_security_group_id(name)
-        with entity_already_exists():
-            ec2.authorize_security_group_ingress(
-                GroupId=sg_id,
-                IpProtocol='tcp',
-                FromPort=22,
-                ToPort=22,
-                CidrIp='0.0.0.0/0'
-            )
-        with entity_already_exists():
-            ec2.authorize_security_group_ingress(
-                GroupId=sg_id,
-                IpProtocol='tcp',
-                FromPort=80,
-                ToPort=80,
-                CidrIp='0.0.0.0/0'
-            )
-        with entity_already_exists():
-            ec2.authorize_security_group_ingress(
-                GroupId=sg_id,
-                IpProtocol='tcp',
-                FromPort=443,
-                ToPort=443,
-                CidrIp='0.0.0.0/0'
-            )
-        with entity_already_exists():
-            ec2.authorize_security_group_ingress(
-                GroupId=sg_id,
-                IpProtocol='tcp',
-                FromPort=5432,
-                ToPort=5432,
-                CidrIp='0.0.0.0/0'
-            )
-        with entity_already_exists():
-            ec2.authorize_security_group_ingress(
-                GroupId=sg_id,
-                IpPermissions=[{
-                    'IpProtocol': '-1',
-                    'UserIdGroupPairs': [{
-                        'UserId': user_id,
-                        'GroupId': sg_id
-                    }]
+        rules = [
+            {
+                'IpProtocol': 'tcp',
+                'FromPort': port,
+                'ToPort': port,
+                'CidrIp': '0.0.0.0/0'
+            }
+            for port in (22, 80, 443, 5432)
+        ]
+        rules.append({
+            'IpPermissions': [{
+                'IpProtocol': '-1',
+                'UserIdGroupPairs': [{
+                    'UserId': user_id,
+                    'GroupId': sg_id
                 }]
-            )
+            }]
+        })
+
+        def authorize(rule):
+            with entity_already_exists():
+                ec2.authorize_security_group_ingress(GroupId=sg_id, **rule)
+
+        for _, _, error in imap_concurrent(authorize, rules):
+            if error:
+                raise error
         return sg_id
 
     def get_security_group_id(self, name=None):
         name = name or self.store_get('selected')
-        ec2 = self.get_boto_client('ec2')
+        ec2 = self.get_boto_client('ec2', cache=True)
         vpc = self.get_vpc(name)
         all_groups = ec2.describe_security_groups(
             Filters=[{'Name': 'vpc-id', 'Values': [vpc.id]}]
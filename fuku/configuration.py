@@ -53,10 +53,4 @@ class Configuration(Module):
 
     def load(self, cache):
         super().load(cache)
-        if 'bucket' in cache:
-            self.store['bucket'] = cache['bucket']
-        else:
-            try:
-                del self.store['bucket']
-            except KeyError:
-                pass
+        self.store_set('bucket', cache.get('bucket'))
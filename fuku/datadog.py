@@ -20,13 +20,14 @@ class Datadog(Module):
     def make(self, key):
         task_mod = self.get_module('task')
         task_mod.make('dd_agent', '!datadog/docker-dd-agent:latest', logs=False)
-        task_mod.env_set(
-            'dd_agent',
-            {
-                'API_KEY': key,
-                'SD_BACKEND': 'docker',
-            }
-        )
-        task_mod.volume_add('dd_agent', 'socket', '/var/run/docker.sock', '/var/run/docker.sock', read_only=True)
-        task_mod.volume_add('dd_agent', 'proc', '/host/proc/', '/proc/', read_only=True)
-        task_mod.volume_add('dd_agent', 'cgroup', '/host/sys/fs/cgroup', '/cgroup/', read_only=True)
+        with task_mod.editing('dd_agent'):
+            task_mod.env_set(
+                'dd_agent',
+                {
+                    'API_KEY': key,
+                    'SD_BACKEND': 'docker',
+                }
+            )
+            task_mod.volume_add('dd_agent', 'socket', '/var/run/docker.sock', '/var/run/docker.sock', read_only=True)
+            task_mod.volume_add('dd_agent', 'proc', '/host/proc/', '/proc/', read_only=True)
+            task_mod.volume_add('dd_agent', 'cgroup', '/host/sys/fs/cgroup', '/cgroup/', read_only=True)
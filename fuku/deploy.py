@@ -0,0 +1,141 @@
+import threading
+import time
+from collections import OrderedDict
+
+from .module import Module
+from .parallel import RateLimiter, imap_concurrent
+from .utils import parse_duration
+from .waiter import ServiceWaiter, WaitTimeout
+
+
+class Deploy(Module):
+    """ Release an image to services in one pipelined step. Once the image
+    is pushed, task definitions referencing it are registered and services
+    updated concurrently, then all of them are waited on together.
+    """
+    dependencies = ['app']
+
+    def __init__(self, **kwargs):
+        super().__init__('deploy', **kwargs)
+
+    def add_arguments(self, parser):
+        parser.add_argument('image', metavar='IMAGE', help='image to deploy, e.g. web:1.2')
+        parser.add_argument('tasks', metavar='TASK', nargs='*', help='task names (default: all services)')
+        parser.add_argument('--no-push', action='store_true', help='image is already pushed')
+        parser.add_argument('--no-wait', action='store_true', help='do not wait for services to settle')
+        parser.add_argument('--timeout', '-t', type=parse_duration, default=1800, help='wait timeout, e.g. 20m')
+        parser.add_argument('--workers', '-w', type=int, default=8, help='services to deploy at once')
+        parser.add_argument('--rate', type=float, default=5, help='maximum ECS requests per second')
+        parser.set_defaults(deploy_handler=self.handle_deploy)
+
+    def handle_deploy(self, args):
+        self.deploy(
+            args.image, args.tasks, push=not args.no_push, wait=not args.no_wait,
+            timeout=args.timeout, workers=args.workers, rate=args.rate
+        )
+
+    def deploy(self, image, task_names=None, push=True, wait=True, timeout=1800, workers=8, rate=5):
+        ctx = self.get_context()
+        img_mod = self.get_module('image')
+        task_mod = self.get_module('task')
+        svc_mod = self.get_module('service')
+        if not task_names:
+            task_names = list(svc_mod.iter_services())
+        if not task_names:
+            self.error('no services to deploy')
+
+        start = time.monotonic()
+        timings = OrderedDict((name, OrderedDict()) for name in task_names)
+        uri = '!' + img_mod.image_name_to_uri(image)
+        app_task = task_mod.get_task(None)
+        limiter = RateLimiter(rate)
+
+        # Nothing may reference the image until it's pushed, so a failed
+        # push leaves task definitions untouched.
+        pushed = threading.Event()
+        push_result = {}
+
+        def push_image():
+            t0 = time.monotonic()
+            try:
+                if push:
+                    img_mod.push(image)
+            except BaseException as e:
+                push_result['error'] = e
+            push_result['time'] = time.monotonic() - t0
+            pushed.set()
+
+        def deploy_one(task_name):
+            times = timings[task_name]
+            t0 = time.monotonic()
+            pushed.wait()
+            if 'error' in push_result:
+                raise RuntimeError('image push failed')
+            times['push wait'] = time.monotonic() - t0
+
+            t0 = time.monotonic()
+            task_mod.update(task_name, image_name=uri)
+            times['register'] = time.monotonic() - t0
+
+            t0 = time.monotonic()
+            svc_mod.update(task_name, app_task=app_task, limiter=limiter)
+            times['update'] = time.monotonic() - t0
+            print(f'{task_name} [UPDATED]')
+
+        pusher = threading.Thread(target=push_image, daemon=True)
+        pusher.start()
+        failed = []
+        updated = []
+        for task_name, _, error in imap_concurrent(deploy_one, task_names, workers):
+            if error:
+                failed.append(task_name)
+                # Errors raised through `error` have already been printed.
+                reason = f': {error}' if str(error) else ''
+                print(f'{task_name} [FAILED{reason}]')
+            else:
+                updated.append(task_name)
+        pusher.join()
+
+        if wait and updated:
+            prefix = f'fuku-{ctx["app"]}-'
+            waiter = ServiceWaiter(
+                svc_mod.get_boto_client('ecs'),
+                f'fuku-{ctx["cluster"]}',
+                [prefix + name for name in updated],
+                timeout=timeout
+            )
+            t0 = time.monotonic()
+            try:
+                results = waiter.wait()
+            except WaitTimeout as e:
+                results = waiter.settled
+                for svc in e.holdouts:
+                    print(f'{svc[len(prefix):]} [FAILED: timed out]')
+            for svc, settled_at in waiter.settled_at.items():
+                timings[svc[len(prefix):]]['wait'] = settled_at - t0
+            for name in updated:
+                result = results.get(prefix + name)
+                if result != 'SETTLED':
+                    failed.append(name)
+                    if result:
+                        print(f'{name} [FAILED: {result}]')
+
+        self.print_timings(push_result.get('time', 0), timings, time.monotonic() - start)
+        error = push_result.get('error')
+        if error is not None and not isinstance(error, SystemExit):
+            raise error
+        if failed:
+            self.error(f'failed to deploy: {", ".join(sorted(failed))}', status=1)
+
+    def print_timings(self, push_time, timings, total):
+        stages = ['push wait', 'register', 'update', 'wait']
+        width = max(len(n) for n in timings)
+        print(f'push: {push_time:.1f}s')
+        print(' ' * width + ''.join(f'  {s:>9}' for s in stages))
+        for name, times in timings.items():
+            cols = ''.join(
+                f'  {times[s]:>8.1f}s' if s in times else f'  {"-":>9}'
+                for s in stages
+            )
+            print(f'{name.ljust(width)}{cols}')
+        print(f'total: {total:.1f}s')
@@ -1,4 +1,15 @@
+import base64
+import hashlib
+import threading
+import time
+
+from .cache import get_cache
 from .module import Module
+from .parallel import imap_concurrent
+from .utils import parse_duration
+
+# Refresh ECR tokens this many seconds before they expire.
+TOKEN_MARGIN = 300
 
 
 class Image(Module):
@@ -6,6 +17,8 @@ class Image(Module):
 
     def __init__(self, **kwargs):
         super().__init__('image', **kwargs)
+        self._login_lock = threading.Lock()
+        self._repositories = None
 
     def add_arguments(self, parser):
         subp = parser.add_subparsers(help='image help')
@@ -22,10 +35,17 @@ class Image(Module):
         p.add_argument('local', metavar='LOCAL', nargs='?', help='local image name')
         p.set_defaults(image_handler=self.handle_connect)
 
-        p = subp.add_parser('push', help='push a connected image')
-        p.add_argument('repo', metavar='REPO', help='repository name')
+        p = subp.add_parser('push', help='push connected images')
+        p.add_argument('repos', metavar='REPO', nargs='+', help='repository name, with optional tag')
+        p.add_argument('--workers', '-w', type=int, default=4, help='images to push at once')
         p.set_defaults(image_handler=self.handle_push)
 
+        p = subp.add_parser('prewarm', help='pull images onto every container instance')
+        p.add_argument('repos', metavar='REPO', nargs='+', help='repository name, with optional tag')
+        p.add_argument('--workers', '-w', type=int, default=10, help='nodes to pull on at once')
+        p.add_argument('--timeout', '-t', type=parse_duration, default=900, help='per node timeout, e.g. 10m')
+        p.set_defaults(image_handler=self.handle_prewarm)
+
     def handle_list(self, args):
         self.list()
 
@@ -39,7 +59,7 @@ class Image(Module):
     def make(self, name):
         ctx = self.get_context()
         ecr = self.get_boto_client('ecr')
-        if name in list(self.iter_repositories(ecr=ecr, ctx=ctx)):
+        if name in self.get_repository_names(ctx=ctx):
             self.error('image by that name already exists')
         if name[0] == '/':
             repo = name[1:]
@@ -50,12 +70,13 @@ class Image(Module):
         ecr.create_repository(
             repositoryName=repo
         )
+        self._repositories = None
 
     def handle_connect(self, args):
         self.connect(args.repo, args.local)
 
     def connect(self, repo, local):
-        if repo not in list(self.iter_repositories()):
+        if repo not in self.get_repository_names():
             self.error(f'repository "{repo}" does not exist')
         if repo[0] == '/':
             x = self.store.setdefault('images', {})
@@ -71,10 +92,35 @@ class Image(Module):
             x['local'] = local
 
     def handle_push(self, args):
-        self.push(args.repo)
+        if len(args.repos) == 1:
+            self.push(args.repos[0])
+        else:
+            self.push_many(args.repos, args.workers)
 
-    def push(self, repo):
+    def push_many(self, repos, workers=4):
+        """ Push several images at once, prefixing their output lines with
+        the repository.
+        """
         ctx = self.get_context()
+        self.login(ctx=ctx)
+        width = max(len(r) for r in repos)
+
+        def push(repo):
+            def prefix(line):
+                print(f'{repo.ljust(width)} | {line}')
+            self.push(repo, ctx=ctx, on_output=prefix)
+
+        failed = []
+        for repo, _, error in imap_concurrent(push, repos, workers):
+            if error:
+                failed.append(repo)
+                print(f'{repo.ljust(width)} | [FAILED: {error}]')
+        if failed:
+            self.error(f'failed to push: {", ".join(failed)}')
+
+    def push(self, repo, ctx=None, on_output=None):
+        if ctx is None:
+            ctx = self.get_context()
         ii = repo.find(':')
         if ii >= 0:
             tag = ':' + repo[ii + 1:]
@@ -87,33 +133,79 @@ class Image(Module):
             local = self.store.get('images', {}).get(ctx['app'], {}).get(repo, {}).get('local', None)
         if not local:
             self.error('image not connected')
-        ecr = self.get_boto_client('ecr')
-        uri = self.get_uri(repo, ctx=ctx, ecr=ecr)
+        uri = self.get_uri(repo, ctx=ctx)
         self.run(f'docker tag {local} {uri}{tag}')
         self.login(ctx=ctx)
-        self.run(f'docker push {uri}{tag}', capture=False)
+        if on_output:
+            self.run(['docker', 'push', f'{uri}{tag}'], capture=False, on_stdout=on_output, on_stderr=on_output)
+        else:
+            self.run(f'docker push {uri}{tag}', capture=False)
+
+    def handle_prewarm(self, args):
+        self.prewarm([self.image_name_to_uri(r) for r in args.repos], args.workers, args.timeout)
+
+    def prewarm(self, uris, workers=10, timeout=900):
+        """ Pull images onto every active container instance ahead of a
+        rollout, so new tasks start from a local image. This is only an
+        optimisation, so nodes that fail are warned about and skipped.
+        Returns the number of seconds taken.
+        """
+        start = time.monotonic()
+        auth = self.get_authorization()
+        user, password = base64.b64decode(auth['token']).decode().split(':', 1)
+        cmd = f'docker login --username {user} --password-stdin {auth["endpoint"]} > /dev/null'
+        for uri in sorted(set(uris)):
+            cmd += f' && docker pull --quiet {uri}'
+        node_mod = self.get_module('node')
+        results = node_mod.fan_out(
+            cmd,
+            node_mod.iter_container_instances(),
+            workers=workers,
+            timeout=timeout,
+            ignore_errors=True,
+            stdin=password
+        )
+        for name, (ok, _) in sorted(results.items()):
+            if not ok:
+                self.get_logger().warning(f'unable to prewarm "{name}", it will pull on demand')
+        elapsed = time.monotonic() - start
+        print(f'prewarmed in {elapsed:.1f}s')
+        return elapsed
 
     def iter_repositories(self, ecr=None, ctx=None):
         if ctx is None:
             ctx = self.get_context()
-        if ecr is None:
-            ecr = self.get_boto_client('ecr')
-        data = ecr.describe_repositories()
-        data = [d['repositoryName'] for d in data['repositories'] if d['repositoryName'] != 'fuku']
+        data = [d for d in self.get_repository_index(ecr) if d != 'fuku']
         pre = ctx['app'] + '-'
         results = ['/' + d for d in data if '-' not in d]
         results += [d[len(pre):] for d in data if d.startswith(pre)]
         for res in results:
             yield res
 
+    def get_repository_names(self, ctx=None):
+        return set(self.iter_repositories(ctx=ctx))
+
+    def get_repository_index(self, ecr=None):
+        """ Map every repository name in the registry to its URI. Built
+        once per invocation from cached responses.
+        """
+        if self._repositories is None:
+            if ecr is None:
+                ecr = self.get_boto_client('ecr', cache=True)
+            paginator = ecr.get_paginator('describe_repositories')
+            self._repositories = {
+                repo['repositoryName']: repo['repositoryUri']
+                for page in paginator.paginate()
+                for repo in page['repositories']
+            }
+        return self._repositories
+
     def get_my_context(self):
         return {}
 
     def get_uri(self, repo, ecr=None, ctx=None):
         if ctx is None:
             ctx = self.get_context()
-        if ecr is None:
-            ecr = self.get_boto_client('ecr')
         if repo[0] != '/':
             repo = f'{ctx["app"]}-{repo}'
         else:
@@ -124,19 +216,58 @@ class Image(Module):
             repo = repo[:ii]
         else:
             tag = ''
-        try:
-            return ecr.describe_repositories(
-                repositoryNames=[repo]
-            )['repositories'][0]['repositoryUri'] + tag
-        except KeyError:
-            self.error('unknown repository')
+        index = self.get_repository_index(ecr)
+        if repo not in index:
+            # The index may predate the repository, so check directly.
+            from botocore.exceptions import ClientError
+            try:
+                data = self.get_boto_client('ecr').describe_repositories(
+                    repositoryNames=[repo]
+                )['repositories'][0]
+            except ClientError:
+                self.error(f'unknown repository "{repo}"')
+            index[repo] = data['repositoryUri']
+        return index[repo] + tag
 
     def login(self, ctx=None):
-        # TODO: Should really be using the `get_authorization_token` thingo.
+        """ Log docker in to ECR, unless it's already using the current
+        token.
+        """
+        if ctx is None:
+            ctx = self.get_context()
+        with self._login_lock:
+            auth = self.get_authorization(ctx)
+            cache = get_cache()
+            namespace = self.get_token_namespace(ctx)
+            digest = hashlib.sha256(auth['token'].encode()).hexdigest()
+            if cache.get(namespace, f'login:{auth["endpoint"]}') == digest:
+                return
+            user, password = base64.b64decode(auth['token']).decode().split(':', 1)
+            self.run(
+                ['docker', 'login', '--username', user, '--password-stdin', auth['endpoint']],
+                stdin=password
+            )
+            cache.set(namespace, f'login:{auth["endpoint"]}', digest, auth['expires'] - time.time())
+
+    def get_authorization(self, ctx=None):
         if ctx is None:
             ctx = self.get_context()
-        data = self.run(f'aws --profile={ctx["profile"]} --region={ctx["region"]} ecr get-login --no-include-email')
-        self.run(data)
+        cache = get_cache()
+        namespace = self.get_token_namespace(ctx)
+        auth = cache.get(namespace, 'token')
+        if auth is None:
+            ecr = self.get_boto_client('ecr')
+            data = ecr.get_authorization_token()['authorizationData'][0]
+            auth = {
+                'token': data['authorizationToken'],
+                'endpoint': data['proxyEndpoint'],
+                'expires': data['expiresAt'].timestamp() - TOKEN_MARGIN,
+            }
+            cache.set(namespace, 'token', auth, auth['expires'] - time.time())
+        return auth
+
+    def get_token_namespace(self, ctx):
+        return f'ecr-token:{ctx.get("profile")}:{ctx.get("region")}'
 
     # def create_repository(self, repo):
     #     data = self.run(
@@ -276,7 +276,7 @@ class Machine(Module):
         )
         sel = self.get_selected(fail=False)
         if sel == name:
-            del self.store['selected']
+            self.store_set('selected', None)
         try:
             del self.store.get('machines', {})[name]
         except KeyError:
@@ -293,12 +293,9 @@ class Machine(Module):
                 if not self.exists(name):
                     self.error('unkown machine')
                 self.store.setdefault('machines', {}).setdefault(name, {})
-                self.store['selected'] = name
+                self.store_set('selected', name)
             else:
-                try:
-                    del self.store['selected']
-                except KeyError:
-                    pass
+                self.store_set('selected', None)
             self.clear_parent_selections()
 
     def handle_stats(self, args):
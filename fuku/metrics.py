@@ -54,7 +54,6 @@ class Metrics(Module):
         node_mod = self.client.get_module('node')
         cmd = f'echo {met} >> /usr/share/collectd/collectd-cloudwatch/src/cloudwatch/config/whitelist.conf'
         cmd += '; systemctl restart collectd'
-        cmd = '\'' + cmd + '\''
         node_mod.all_run(cmd)
 
     def handle_remove(self, args):
@@ -70,6 +69,5 @@ class Metrics(Module):
         self.puts3(f'{ctx["cluster"]}/metrics.json', {})
         cmd = f'truncate -s 0 /usr/share/collectd/collectd-cloudwatch/src/cloudwatch/config/whitelist.conf'
         cmd += '; systemctl restart collectd'
-        cmd = '\'' + cmd + '\''
         node_mod = self.client.get_module('node')
         node_mod.all_run(cmd)
@@ -1,3 +1,4 @@
+import getpass
 import json
 import logging
 import os
@@ -8,8 +9,7 @@ import unicodedata
 from contextlib import contextmanager
 from string import Template
 
-import boto3
-
+from . import aws
 from .db import get_rc_path
 from .runner import run
 
@@ -22,9 +22,19 @@ class Module(object):
         self.db = db
         self.store = self.db.setdefault(self.name, {})
         self.client = client
-        self.use_context = True
+        self._use_context = True
         self._checks = {}
 
+    @property
+    def use_context(self):
+        return self._use_context
+
+    @use_context.setter
+    def use_context(self, value):
+        if value != self._use_context:
+            self.client.invalidate_contexts()
+        self._use_context = value
+
     def add_arguments(self, parser):
         pass
 
@@ -37,10 +47,18 @@ class Module(object):
             self.error('"fuku" is a reserved name')
 
     def get_context(self, ctx={}, use_context=True):
-        for dep in self.client.iter_dependent_modules(self):
-            ctx = dep.get_context(ctx)
-        if self.use_context and use_context:
-            ctx.update(self.get_my_context())
+        use_context = self.use_context and use_context
+        key = (self.name, use_context)
+        cache = self.client.contexts
+        if key not in cache:
+            my_ctx = {}
+            for dep in self.client.iter_dependent_modules(self):
+                my_ctx.update(dep.get_context())
+            if use_context:
+                my_ctx.update(self.get_my_context())
+            cache[key] = my_ctx
+        ctx = dict(ctx)
+        ctx.update(cache[key])
         return ctx
 
     def get_module(self, name):
@@ -49,9 +67,9 @@ class Module(object):
     def get_selected(self):
         return None
 
-    def error(self, msg):
+    def error(self, msg, status=None):
         print(msg)
-        sys.exit()
+        sys.exit(status)
 
     def register_check(self, key, call):
         self._checks[key] = call
@@ -87,7 +105,7 @@ class Module(object):
             tf.close()
 
     def run(self, cmd, cfg={}, capture='discard', use_self=False, ignore_errors=False,
-            env={}):
+            env={}, timeout=None, **kwargs):
         # cfg = self.merged_config(cfg, use_self)
         # final = subs(cmd, cfg)
         # print(final)
@@ -98,7 +116,9 @@ class Module(object):
             cmd,
             capture=capture not in set([None, '', False]),
             ignore_errors=ignore_errors,
-            env=env_copy
+            env=env_copy,
+            timeout=timeout,
+            **kwargs
         )
         if capture == 'json':
             output = json.loads(output)
@@ -151,13 +171,7 @@ class Module(object):
         return self.store
 
     def load(self, cache):
-        if 'selected' in cache:
-            self.store['selected'] = cache['selected']
-        else:
-            try:
-                del self.store['selected']
-            except KeyError:
-                pass
+        self.store_set('selected', cache.get('selected'))
 
     def store_set(self, key, value):
         self.get_logger().debug(f'Set {self.name} store {self.store} with {key}={value}')
@@ -171,6 +185,7 @@ class Module(object):
                 del self.store[key]
             except KeyError:
                 pass
+        self.client.invalidate_contexts()
 
     def store_get(self, key):
         parts = key.split('.')
@@ -188,26 +203,16 @@ class Module(object):
                 value = value.get(p, None)
         return value
 
-    def setup_boto_session(self, ctx={}):
+    def get_boto_resource(self, resource, ctx={}, cache=False):
         ctx = self.get_context(ctx, use_context=False)
-        kwargs = {}
-        if 'region' in ctx:
-            kwargs['region_name'] = ctx['region']
-        if 'profile' in ctx:
-            kwargs['profile_name'] = ctx['profile']
-        boto3.setup_default_session(**kwargs)
+        return aws.get_resource(resource, ctx.get('profile'), ctx.get('region'), cache=cache)
 
-    def get_boto_resource(self, resource, ctx={}):
-        self.setup_boto_session(ctx)
-        return boto3.resource(resource)
-
-    def get_boto_client(self, resource, ctx={}):
-        self.setup_boto_session(ctx)
-        return boto3.client(resource)
+    def get_boto_client(self, resource, ctx={}, cache=False):
+        ctx = self.get_context(ctx, use_context=False)
+        return aws.get_client(resource, ctx.get('profile'), ctx.get('region'), cache=cache)
 
-    def get_boto_paginator(self, client, resource, ctx={}):
-        self.setup_boto_session(ctx)
-        return boto3.client(client).get_paginator(resource)
+    def get_boto_paginator(self, client, resource, ctx={}, cache=False):
+        return self.get_boto_client(client, ctx, cache=cache).get_paginator(resource)
 
     def puts3(self, key, value):
         ctx = self.get_context()
@@ -240,7 +245,26 @@ class Module(object):
         except:
             pass
 
-    def encrypt_file(self, path, purpose='an unknown resource'):
+    def get_passphrase(self, purpose='an unknown resource'):
+        """ Ask once for a password to secure several files with.
+        """
+        print(f'\nPlease enter a password to secure {purpose}.')
+        print('Be sure to keep this safe, as it is required for future')
+        print('access to this resource.\n')
+        while 1:
+            passphrase = getpass.getpass('Password: ')
+            if passphrase and passphrase == getpass.getpass('Repeat password: '):
+                return passphrase
+            print('\npasswords do not match, please try again\n')
+
+    def encrypt_file(self, path, purpose='an unknown resource', passphrase=None):
+        if passphrase is not None:
+            self.run(
+                ['gpg', '--batch', '--yes', '--pinentry-mode', 'loopback', '--passphrase-fd', '0',
+                 '-c', path],
+                stdin=passphrase
+            )
+            return
         print(f'\nPlease enter a password to secure {purpose}.')
         print('Be sure to keep this safe, as it is required for future')
         print('access to this resource.\n')
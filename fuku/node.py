@@ -1,9 +1,13 @@
-import base64
+import argparse
 import json
 import re
 
+from . import ssh
 from .module import Module
-from .utils import StoreKeyValuePair, json_serial
+from .parallel import imap_concurrent
+from .runner import CommandError
+from .topology import Topology
+from .utils import StoreKeyValuePair, json_serial, parse_duration
 
 
 class Node(Module):
@@ -15,6 +19,8 @@ class Node(Module):
 
     def __init__(self, **kwargs):
         super().__init__('node', **kwargs)
+        self._topology = None
+        self._bastion_ip = None
 
     def add_arguments(self, parser):
         subp = parser.add_subparsers(help='node help')
@@ -46,6 +52,13 @@ class Node(Module):
         p.add_argument('name', metavar='NAME', nargs='?', help='node name')
         p.set_defaults(node_handler=self.handle_ssh)
 
+        p = subp.add_parser('exec', help='run a command on one or all nodes')
+        p.add_argument('--all', '-a', action='store_true', help='run on every running node')
+        p.add_argument('--workers', '-w', type=int, default=10, help='nodes to run on at once')
+        p.add_argument('--timeout', '-t', type=parse_duration, help='per node timeout, e.g. 30s or 5m')
+        p.add_argument('args', metavar='ARG', nargs=argparse.REMAINDER, help='node name (unless --all) and command')
+        p.set_defaults(node_handler=self.handle_exec)
+
         p = subp.add_parser('init', help='initialise swarm')
         p.add_argument('name', metavar='NAME', help='node name')
         p.set_defaults(node_handler=self.handle_init_swarm)
@@ -241,6 +254,16 @@ class Node(Module):
     def handle_ssh(self, args):
         self.ssh_run('', args.name, tty=True)
 
+    def handle_exec(self, args):
+        if args.all:
+            if not args.args:
+                self.error('expected a command')
+            self.all_run(' '.join(args.args), workers=args.workers, timeout=args.timeout)
+        else:
+            if len(args.args) < 2:
+                self.error('expected a node name and a command, or --all')
+            self.ssh_run(' '.join(args.args[1:]), args.args[0], capture=False, timeout=args.timeout)
+
     def handle_reboot(self, args):
         self.reboot(args.name)
 
@@ -269,7 +292,7 @@ class Node(Module):
         )
 
     def iter_instances(self):
-        ec2 = self.get_boto_resource('ec2')
+        ec2 = self.get_boto_resource('ec2', cache=True)
         cluster = self.client.get_selected('cluster')
         filters = [
             {
@@ -316,27 +339,31 @@ class Node(Module):
         return insts[0]
 
     def get_instance_arn(self, name):
-        ctx = self.get_context()
-        ecs = self.get_boto_client('ecs')
-        paginator = ecs.get_paginator('list_container_instances')
         ec2inst = self.get_instance(name)
-        instances = paginator.paginate(
-            cluster=f'fuku-{ctx["cluster"]}',
-        )
-        for inst in instances:
-            for arn in inst['containerInstanceArns']:
-                res = ecs.describe_container_instances(
-                    cluster=f'fuku-{ctx["cluster"]}',
-                    containerInstances=[arn]
-                )
-                for ci in res['containerInstances']:
-                    if ci['ec2InstanceId'] == ec2inst.id:
-                        return arn
-        raise Exception
+        arn = self.get_topology().get_instance_arn(ec2inst.id)
+        if arn is None:
+            self.error(f'node "{name}" is not registered with the cluster')
+        return arn
+
+    def get_topology(self, refresh=False):
+        if self._topology is None or refresh:
+            ctx = self.get_context()
+            self._topology = Topology(
+                self.get_boto_client('ecs'),
+                f'fuku-{ctx["cluster"]}'
+            )
+        return self._topology
 
     def get_bastion(self):
         return self.get_instance('bastion')
 
+    def get_bastion_ip(self):
+        # Only cached for this invocation, so a replaced bastion is picked
+        # up straight away.
+        if self._bastion_ip is None:
+            self._bastion_ip = self.get_bastion().public_ip_address
+        return self._bastion_ip
+
     def iter_managers(self):
         ctx = self.get_context()
         ec2 = self.get_boto_resource('ec2')
@@ -373,17 +400,16 @@ class Node(Module):
         for inst in ec2.instances.filter(Filters=filters):
             yield inst
 
-    def ssh_run(self, cmd, name=None, inst=None, tty=False, capture=None):
+    def ssh_run(self, cmd, name=None, inst=None, tty=False, capture=None, timeout=None, **kwargs):
         ctx = self.get_context()
         if inst is None:
             name = name or ctx['node']
             inst = self.get_instance(name)
-        bastion = self.get_bastion()
-        ip = bastion.public_ip_address
-        priv_ip = inst.private_ip_address
-        b64cmd = base64.b64encode(cmd.encode()).decode()
-        full_cmd = f'ssh-add {ctx["pem"]} 2> /dev/null && ssh{" -t" if tty else ""} -o StrictHostKeyChecking=no -o LogLevel=QUIET  -A ec2-user@{ip} ssh{" -t" if tty else ""} -o StrictHostKeyChecking=no -o LogLevel=QUIET {priv_ip} "\`echo {b64cmd} | base64 -di\`"'
-        return self.run(full_cmd, capture=capture)
+        ssh.add_key(ctx['pem'])
+        bastion = self.get_bastion_ip()
+        ssh.open_master(inst.private_ip_address, bastion, timeout=timeout)
+        full_cmd = ssh.ssh_command(inst.private_ip_address, cmd, bastion=bastion, tty=tty)
+        return self.run(full_cmd, capture=capture, timeout=timeout, **kwargs)
 
     def handle_bastion(self, args):
         self.bastion()
@@ -443,9 +469,54 @@ class Node(Module):
             self.error('no managers available')
         return self.ssh_run(cmd, inst=mgr, tty=tty, capture=capture)
 
-    def all_run(self, cmd):
-        for node in self.iter_nodes():
-            self.ssh_run(cmd, inst=node, capture=False)
+    def all_run(self, cmd, workers=10, timeout=None, ignore_errors=False):
+        return self.fan_out(cmd, self.iter_nodes(), workers, timeout, ignore_errors)
+
+    def fan_out(self, cmd, nodes, workers=10, timeout=None, ignore_errors=False, stdin=None):
+        """ Run a command on many nodes at once, printing each node's
+        output prefixed with its name as it finishes, followed by a summary.
+        Returns a dictionary of node names to `(ok, output)`.
+        """
+        nodes = list(nodes)
+        self.get_bastion_ip()
+        width = max([len(self.get_instance_name(n)) for n in nodes] or [0])
+
+        def run(node):
+            try:
+                return True, self.ssh_run(cmd, inst=node, capture='text', timeout=timeout, stdin=stdin)
+            except CommandError as e:
+                return False, e.out
+
+        results = {}
+        for node, result, error in imap_concurrent(run, nodes, workers):
+            name = self.get_instance_name(node)
+            ok, out = (False, str(error)) if error else result
+            results[name] = (ok, out)
+            lines = [line for line in (out, getattr(out, 'stderr', '')) if line]
+            for line in '\n'.join(lines).splitlines() or ['']:
+                print(f'{name.ljust(width)} | {line}')
+            if not ok:
+                print(f'{name.ljust(width)} | [FAILED]')
+
+        failed = sorted(name for name, (ok, _) in results.items() if not ok)
+        print(f'{len(results) - len(failed)} of {len(results)} nodes succeeded')
+        if failed and not ignore_errors:
+            self.error(f'failed on: {", ".join(failed)}')
+        return results
+
+    def iter_container_instances(self):
+        """ EC2 instances registered with the cluster and accepting tasks.
+        """
+        ec2 = self.get_boto_resource('ec2')
+        for ci in self.get_topology().container_instances.values():
+            if ci.get('status') == 'ACTIVE':
+                yield ec2.Instance(ci['ec2InstanceId'])
+
+    def get_instance_name(self, inst):
+        for tag in inst.tags or []:
+            if tag['Key'] == 'name':
+                return tag['Value']
+        return inst.id
 
     def get_my_context(self):
         ctx = {}
@@ -490,6 +561,13 @@ class EcsNode(Node):
         p.add_argument('name', metavar='NAME', nargs='?', help='node name')
         p.set_defaults(node_handler=self.handle_ssh)
 
+        p = subp.add_parser('exec', help='run a command on one or all nodes')
+        p.add_argument('--all', '-a', action='store_true', help='run on every running node')
+        p.add_argument('--workers', '-w', type=int, default=10, help='nodes to run on at once')
+        p.add_argument('--timeout', '-t', type=parse_duration, help='per node timeout, e.g. 30s or 5m')
+        p.add_argument('args', metavar='ARG', nargs=argparse.REMAINDER, help='node name (unless --all) and command')
+        p.set_defaults(node_handler=self.handle_exec)
+
         p = subp.add_parser('wait', help='wait for OK status')
         p.add_argument('name', metavar='NAME', help='node name')
         p.set_defaults(node_handler=self.handle_wait)
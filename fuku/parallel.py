@@ -0,0 +1,172 @@
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+THROTTLE_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'TooManyRequestsException',
+    'SlowDown',
+}
+
+
+class RateLimiter(object):
+    """ Token bucket shared between threads, allowing `rate` calls per
+    second in bursts of up to `burst`. The rate halves each time AWS
+    throttles us and creeps back up as calls succeed.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.max_rate = float(rate)
+        self.min_rate = self.max_rate / 32
+        self.rate = self.max_rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def backoff(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+
+    def recover(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate * 1.1)
+
+
+def is_throttled(error):
+    try:
+        return error.response['Error']['Code'] in THROTTLE_CODES
+    except (AttributeError, KeyError, TypeError):
+        return False
+
+
+def throttled(limiter, call, *args, retries=8, **kwargs):
+    for attempt in range(retries + 1):
+        limiter.acquire()
+        try:
+            result = call(*args, **kwargs)
+        except Exception as e:
+            if not is_throttled(e) or attempt == retries:
+                raise
+            limiter.backoff()
+            time.sleep(min(30, 2 ** attempt) * random.uniform(0.5, 1))
+        else:
+            limiter.recover()
+            return result
+
+
+def imap_concurrent(func, items, workers=8):
+    """ Call `func` on each item using a pool of threads, yielding
+    `(item, result, error)` tuples in the order they complete. A worker
+    calling `Module.error` fails only its own item, with the `SystemExit`
+    as the error.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(func, item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                result = future.result()
+            except (Exception, SystemExit) as e:
+                yield item, None, e
+            else:
+                yield item, result, None
+
+
+def chunks(items, size):
+    items = list(items)
+    for ii in range(0, len(items), size):
+        yield items[ii:ii + size]
+
+
+class StepFailed(Exception):
+    def __init__(self, step, error):
+        super().__init__(f'{step}: {error}')
+        self.step = step
+        self.error = error
+
+
+def run_graph(steps, workers=8, journal=None, on_done=None, serial=()):
+    """ Run a dependency graph of steps on a pool of threads. `steps` maps
+    each name to a `(dependencies, func)` pair, where `func` is called with
+    a dictionary of results from the steps it depends on.
+
+    `journal` holds the results of steps already finished, which are
+    skipped, and is updated as steps complete. `on_done(name, journal)` is
+    called after each step so the caller can checkpoint progress. The
+    first failure, including a `SystemExit` from `Module.error`, stops any
+    new steps from starting and is raised as `StepFailed` once running
+    steps have finished.
+
+    Steps named in `serial`, such as those prompting the user, run one at
+    a time on the calling thread before anything else starts, so may only
+    depend on each other.
+    """
+    journal = {} if journal is None else journal
+    for name, (deps, _) in steps.items():
+        missing = [d for d in deps if d not in steps]
+        if missing:
+            raise ValueError(f'step "{name}" depends on unknown steps: {", ".join(missing)}')
+        if name in serial and any(d not in serial for d in deps):
+            raise ValueError(f'serial step "{name}" depends on steps that are not serial')
+    for name in serial:
+        if name in journal:
+            continue
+        deps, func = steps[name]
+        missing = [d for d in deps if d not in journal]
+        if missing:
+            raise ValueError(f'serial step "{name}" runs before {", ".join(missing)}')
+        try:
+            journal[name] = func({d: journal[d] for d in deps})
+        except (Exception, SystemExit) as e:
+            raise StepFailed(name, e)
+        if on_done:
+            on_done(name, journal)
+    pending = {name for name in steps if name not in journal}
+    running = {}
+    failure = None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            if failure is None:
+                for name in sorted(pending):
+                    deps, func = steps[name]
+                    if all(d in journal for d in deps):
+                        results = {d: journal[d] for d in deps}
+                        running[pool.submit(func, results)] = name
+                        pending.discard(name)
+            if not running:
+                if failure is None:
+                    raise ValueError(f'dependency cycle between steps: {", ".join(sorted(pending))}')
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    journal[name] = future.result()
+                except (Exception, SystemExit) as e:
+                    if failure is None:
+                        failure = StepFailed(name, e)
+                    continue
+                if on_done:
+                    on_done(name, journal)
+    if failure is not None:
+        raise failure
+    return journal
@@ -1,14 +1,149 @@
+import fnmatch
+import json
 import os
 import re
+import shlex
+import time
 import uuid
 from datetime import datetime, timedelta
 from pprint import pprint
 
-import botocore
-
 from .db import get_rc_path
 from .module import Module
-from .utils import gen_secret
+from .parallel import chunks, imap_concurrent
+from .pgdriver import connection, execute, get_psycopg2, inventory, read_pgpass, transaction
+from .runner import CommandError, stream
+from .s3stream import DEFAULT_PART_SIZE, MB, MultipartUpload, RangedDownload
+from .utils import gen_secret, parse_duration
+
+VERBOSE_PROGRESS = [
+    ('started', re.compile(r'(?:dumping contents of|processing data for) table "?([^"]+)"?')),
+    ('finished', re.compile(r'finished item \d+ TABLE DATA (.+)')),
+]
+VERBOSE_PROBLEM = re.compile(r'error|warning|fatal', re.IGNORECASE)
+MANIFEST = 'manifest.json'
+DB_NAME = re.compile(r'^[a-z_][a-z0-9_]*$')
+
+TOC_ENTRY = re.compile(r'(\d+); \d+ \d+ (.+)$')
+TOC_SCRIPT_ENTRY = re.compile(r'^-- TOC entry (\d+) ', re.MULTILINE)
+# Entries whose tag names the table they belong to, as "schema table ...".
+TABLE_ENTRIES = (
+    'TABLE DATA', 'TABLE', 'FK CONSTRAINT', 'CHECK CONSTRAINT', 'CONSTRAINT',
+    'TRIGGER', 'DEFAULT', 'POLICY', 'RULE',
+)
+# Entries whose table can only be found from their SQL.
+OTHER_ENTRIES = ('DEFAULT ACL', 'SEQUENCE OWNED BY', 'SEQUENCE SET', 'SEQUENCE', 'INDEX')
+SQL_INDEX_TABLE = re.compile(r'\bON (?:ONLY )?([^\s(]+)')
+SQL_OWNED_BY = re.compile(r'OWNED BY ([^\s;]+)\.[^.\s;]+;')
+SQL_ALTER_TABLE = re.compile(r'ALTER TABLE (?:ONLY )?([^\s(]+)')
+SQL_REFERENCES = re.compile(r'REFERENCES ([^\s(]+)')
+
+
+class TableProgress(object):
+    """ Turns verbose pg_dump/pg_restore output into a line per table,
+    passing through anything that looks like a problem.
+    """
+
+    def __init__(self, total=None):
+        self.total = total
+        self.done = 0
+        self.start = time.monotonic()
+
+    def feed(self, line):
+        for event, prog in VERBOSE_PROGRESS:
+            m = prog.search(line)
+            if m:
+                elapsed = time.monotonic() - self.start
+                if event == 'finished':
+                    self.done += 1
+                count = f'{self.done}/{self.total}' if self.total else str(self.done)
+                print(f'  [{count}] {elapsed:7.1f}s  {event} {m.group(1)}')
+                return
+        if VERBOSE_PROBLEM.search(line):
+            print(line)
+
+
+def split_name(qualified):
+    schema, _, name = qualified.replace('"', '').rpartition('.')
+    return schema, name
+
+
+def select_toc(toc, script='', tables=None, exclude_tables=None):
+    """ Filter the lines of a dump's table of contents (`pg_restore -l`)
+    down to the tables selected by include/exclude patterns, which match
+    either the table name or schema.table.
+
+    Everything belonging to a dropped table goes, not just its data, so
+    a clean restore doesn't replace it with an empty copy. Indexes and
+    sequences are matched to their tables using `script`, the verbose
+    schema-only output of pg_restore. Foreign keys are kept when either
+    end is restored, as dropping a table drops the keys referencing it.
+    With include patterns, objects that belong to no table are left out.
+    """
+    def matches(name, patterns):
+        return any(fnmatch.fnmatchcase(n, p) for n in (name[1], '.'.join(name)) for p in patterns)
+
+    def selected(name):
+        if name is None:
+            return not tables
+        if tables and not matches(name, tables):
+            return False
+        return not (exclude_tables and matches(name, exclude_tables))
+
+    sql = {}
+    parts = TOC_SCRIPT_ENTRY.split(script)
+    for ii in range(1, len(parts) - 1, 2):
+        sql[parts[ii]] = parts[ii + 1]
+
+    parsed = []
+    for line in toc:
+        m = TOC_ENTRY.match(line)
+        desc, fields = None, []
+        if m:
+            rest = m.group(2)
+            desc = next((d for d in TABLE_ENTRIES + OTHER_ENTRIES if rest.startswith(d + ' ')), None)
+            if desc == 'DEFAULT' and rest.startswith('DEFAULT ACL '):
+                desc = None
+            fields = rest[len(desc) + 1:].split() if desc else []
+        parsed.append((line, m.group(1) if m else None, desc, fields))
+
+    # Sequences are tied to tables by their OWNED BY entries.
+    sequence_tables = {}
+    for line, toc_id, desc, fields in parsed:
+        m = desc == 'SEQUENCE OWNED BY' and SQL_OWNED_BY.search(sql.get(toc_id, ''))
+        if m and len(fields) > 1:
+            sequence_tables[(fields[0], fields[1])] = split_name(m.group(1))
+
+    entries = []
+    n_tables = 0
+    for line, toc_id, desc, fields in parsed:
+        if toc_id is None:
+            # Comments and blank lines.
+            entries.append(line)
+            continue
+        text = sql.get(toc_id, '')
+        table = None
+        if desc in TABLE_ENTRIES and len(fields) > 1:
+            table = (fields[0], fields[1])
+        elif desc == 'INDEX':
+            m = SQL_INDEX_TABLE.search(text)
+            table = split_name(m.group(1)) if m else None
+        elif desc in ('SEQUENCE', 'SEQUENCE SET', 'SEQUENCE OWNED BY') and len(fields) > 1:
+            table = sequence_tables.get((fields[0], fields[1]))
+            if table is None:
+                # Identity columns are set up by altering their table.
+                m = SQL_ALTER_TABLE.search(text)
+                table = split_name(m.group(1)) if m else None
+        keep = selected(table)
+        if desc == 'FK CONSTRAINT' and not keep:
+            m = SQL_REFERENCES.search(text)
+            keep = bool(m) and selected(split_name(m.group(1)))
+        if not keep:
+            continue
+        if desc == 'TABLE DATA':
+            n_tables += 1
+        entries.append(line)
+    return {'entries': entries, 'tables': n_tables}
 
 
 class Pg(Module):
@@ -48,16 +183,22 @@ class Pg(Module):
         p = subp.add_parser('psql')
         p.add_argument('--dbname', '-d', help='DB name')
         p.add_argument('--command', '-c', help='run SQL')
+        p.add_argument('--file', '-f', metavar='FILE', help='run SQL from a file, or - for standard input')
+        p.add_argument('--single-transaction', '-1', action='store_true', help='run the file in one transaction')
         p.set_defaults(pg_handler=self.handle_psql)
 
         p = subp.add_parser('dump', help='dump contents of database')
         p.add_argument('dbname', metavar='DBNAME', help='DB name')
-        p.add_argument('output', metavar='OUTPUT', help='output filename')
+        p.add_argument('output', metavar='OUTPUT', help='output filename, or directory with --parallel')
+        self.add_parallel_arguments(p)
         p.set_defaults(pg_handler=self.handle_dump)
 
         p = subp.add_parser('restore', help='restore a database')
         p.add_argument('dbname', metavar='DBNAME', help='DB name')
-        p.add_argument('input', metavar='INPUT', help='database dump file')
+        p.add_argument('input', metavar='INPUT', nargs='?', help='database dump file or directory')
+        p.add_argument('--from-backup', '-b', metavar='KEY', help='stream a backup from S3 instead')
+        p.add_argument('--workers', '-w', type=int, default=4, help='backup parts to download at once')
+        self.add_parallel_arguments(p)
         p.set_defaults(pg_handler=self.handle_restore)
 
         p = subp.add_parser('rollback', help='rollback a database')
@@ -68,14 +209,28 @@ class Pg(Module):
         p = subp.add_parser('backup', help='backup a database to S3')
         p.add_argument('dbname', metavar='DBNAME', help='DB name')
         p.add_argument('--list', action='store_true', help='list backups')
+        p.add_argument('--compress', '-z', metavar='LEVEL', type=int, nargs='?', const=3,
+                       help='compress with zstd (default level: 3)')
+        p.add_argument('--part-size', type=int, default=DEFAULT_PART_SIZE // MB, help='upload part size (MB)')
+        p.add_argument('--workers', '-w', type=int, default=4, help='parts to upload at once')
         p.set_defaults(pg_handler=self.handle_backup)
 
+        p = subp.add_parser('prune', help='remove old backups')
+        p.add_argument('dbname', metavar='DBNAME', help='DB name')
+        p.add_argument('--keep', '-k', type=int, default=7, help='number of latest backups to keep')
+        p.add_argument('--younger-than', '-y', metavar='AGE', type=parse_duration,
+                       help='keep backups made within AGE, e.g. 30d')
+        p.add_argument('--dry-run', '-n', action='store_true', help='only report what would be removed')
+        p.set_defaults(pg_handler=self.handle_prune)
+
         p = subp.add_parser('share', help='share a backed up database')
         p.add_argument('dbname', metavar='DBNAME', help='DB name')
         p.add_argument('key', metavar='KEY', help='backup key')
         p.set_defaults(pg_handler=self.handle_share)
 
         p = subp.add_parser('summary', help='summarize databases')
+        p.add_argument('--workers', '-w', type=int, default=8, help='instances to query at once')
+        p.add_argument('--sample', type=float, default=1.0, help='seconds to measure transaction rates over')
         p.set_defaults(pg_handler=self.handle_summary)
 
         # ## SECTION FOR fuku pg db ## #
@@ -83,21 +238,31 @@ class Pg(Module):
         ssp = p.add_subparsers()
 
         p = ssp.add_parser('ls')
+        p.add_argument('--sample', type=float, default=1.0, help='seconds to measure transaction rates over')
         p.set_defaults(pg_handler=self.handle_db_list)
 
         p = ssp.add_parser('mk')
-        p.add_argument('dbname', metavar='DBNAME', help='DB name')
+        p.add_argument('dbnames', metavar='DBNAME', nargs='+', help='DB names')
         p.set_defaults(pg_handler=self.handle_db_make)
 
         p = ssp.add_parser('rm')
-        p.add_argument('dbname', metavar='DBNAME', help='DB name')
+        p.add_argument('dbnames', metavar='DBNAME', nargs='+', help='DB names')
         p.set_defaults(pg_handler=self.handle_db_remove)
 
+    def add_parallel_arguments(self, parser):
+        parser.add_argument('--parallel', '-P', action='store_true',
+                            help='use directory format and parallel jobs')
+        parser.add_argument('--jobs', '-j', type=int, help='parallel jobs (default: instance vCPUs)')
+        parser.add_argument('--table', '-t', dest='tables', action='append',
+                            help='only this table, may be a pattern and repeated')
+        parser.add_argument('--exclude-table', '-T', dest='exclude_tables', action='append',
+                            help='skip this table, may be a pattern and repeated')
+
     def handle_list(self, args):
         self.list(args.name)
 
     def list(self, name):
-        rds = self.get_boto_client('rds')
+        rds = self.get_boto_client('rds', cache=True)
         if name:
             data = rds.describe_db_instances(
                 Filters=[{
@@ -111,7 +276,7 @@ class Pg(Module):
                 print(dbinst)
 
     def iter_db_instances(self):
-        rds = self.get_boto_client('rds')
+        rds = self.get_boto_client('rds', cache=True)
         data = rds.describe_db_instances()
         ctx = self.get_context(use_context=False)
         pre = f'fuku-{ctx["cluster"]}-'
@@ -164,76 +329,118 @@ class Pg(Module):
         self.select(name)
 
     def handle_db_list(self, args):
-        self.db_list()
+        self.db_list(args.sample)
 
-    def db_list(self):
-        for db in self.iter_dbs():
-            print(db)
+    def db_list(self, sample=1.0):
+        ctx = self.get_context()
+        rows = inventory(self.get_instance_params(ctx['dbinstance']), sample)
+        for row in rows:
+            row['name'] = row['name'][row['name'].find('_') + 1:]
+        self.print_inventory(rows)
 
     def iter_dbs(self, inst_name=None):
         if inst_name is None:
-            ctx = self.get_context()
-            inst_name = ctx['dbinstance']
-        else:
-            ctx = self.get_context(use_context=False)
-        path = os.path.join(ctx['cluster'], f'{inst_name}.pgpass')
-        path = self.get_secure_file(path)
-        endpoint = self.get_endpoint(inst_name)
-        cmd = 'psql -h {} -p {} -U {} -d {}'.format(
-            endpoint['Address'],
-            endpoint['Port'],
-            inst_name,
-            'postgres'
-        )
-        sql = 'SELECT datname FROM pg_database WHERE datistemplate = false;'
-        cmd = f'{cmd} -c "{sql}"'
-        output = self.run(
-            cmd,
-            capture=True,
-            env={'PGPASSFILE': path}
-        )
-        for db in output.split()[4:-2]:
-            i = db.find('_')
-            yield db[i + 1:]
+            inst_name = self.get_context()['dbinstance']
+        for row in inventory(self.get_instance_params(inst_name), sample=0):
+            yield row['name'][row['name'].find('_') + 1:]
+
+    def get_instance_params(self, inst_name):
+        """ Connection parameters for an instance's master user, from its
+        cached credentials.
+        """
+        ctx = self.get_context(use_context=False)
+        return read_pgpass(self.get_secure_file(os.path.join(ctx['cluster'], f'{inst_name}.pgpass')))
 
-    def handle_db_make(self, args):
-        self.db_make(args.dbname)
+    def print_inventory(self, rows, indent=''):
+        def size(n):
+            return f'{n / MB / 1024:.1f}GB' if n >= 1024 * MB else f'{n / MB:.1f}MB'
 
-    def db_make(self, name):
-        password = gen_secret(16)
+        width = max([len(r['name']) for r in rows] or [0])
+        for row in rows:
+            line = f'{indent}{row["name"].ljust(width)}  {size(row["size"]):>9}  {row["connections"]:>4} conns'
+            if row['tps'] is not None:
+                line += f'  {row["tps"]:>8.1f} tps'
+            print(line)
+
+    def handle_db_make(self, args):
+        self.db_make(args.dbnames)
+
+    def db_make(self, names):
+        """ Create databases, each with a role of its own, over a single
+        connection to the instance. CREATE DATABASE can't run in a
+        transaction, so the role and grants follow in one, and the
+        database is dropped again if they fail.
+        """
+        if isinstance(names, str):
+            names = [names]
         ctx = self.get_context()
         inst_name = ctx['dbinstance']
-        db_id = self.get_db_id(name)
-        self.psql(command=f'CREATE DATABASE {db_id} OWNER {inst_name}')
-        self.psql(command=f'CREATE ROLE {db_id} NOSUPERUSER NOCREATEDB NOCREATEROLE LOGIN ENCRYPTED PASSWORD \'{password}\'')
-        self.psql(command=f'GRANT ALL ON DATABASE {db_id} TO {db_id}')
-        self.psql(command=f'GRANT rds_superuser TO {db_id}')
-        data = self.get_endpoint(inst_name)
-        path = os.path.join(self.get_rc_path(), ctx['app'], inst_name, f'{name}.pgpass')
-        try:
-            os.makedirs(os.path.dirname(path))
-        except OSError:
-            pass
-        with open(path, 'w') as outf:
-            outf.write('{}:{}:{}:{}:{}'.format(
-                data['Address'],
-                data['Port'],
-                db_id,
-                db_id,
-                password
-            ))
-        os.chmod(path, 0o600)
-        self.encrypt_file(path, purpose='the database credentials')
+        self.check_db_names(names)
+        params = self.get_instance_params(inst_name)
+        # Ask for one password rather than one per database.
+        passphrase = self.get_passphrase('the database credentials') if len(names) > 1 else None
+        psycopg2 = get_psycopg2()
         s3 = self.get_boto_client('s3')
-        s3.upload_file(f'{path}.gpg', ctx['bucket'], f'fuku/{ctx["cluster"]}/{ctx["app"]}/{inst_name}/{name}.pgpass.gpg')
+        with connection(params) as conn:
+            for name in names:
+                password = gen_secret(16)
+                db_id = self.get_db_id(name)
+                try:
+                    execute(conn, [f'CREATE DATABASE {db_id} OWNER {inst_name}'])
+                    try:
+                        with transaction(conn):
+                            execute(conn, [
+                                (f'CREATE ROLE {db_id} NOSUPERUSER NOCREATEDB NOCREATEROLE LOGIN'
+                                 f' ENCRYPTED PASSWORD %s', (password,)),
+                                f'GRANT ALL ON DATABASE {db_id} TO {db_id}',
+                                f'GRANT rds_superuser TO {db_id}',
+                            ])
+                    except psycopg2.Error:
+                        execute(conn, [f'DROP DATABASE {db_id}'])
+                        raise
+                except psycopg2.Error as e:
+                    self.error(f'failed to create "{name}": {str(e).strip()}')
+                path = os.path.join(self.get_rc_path(), ctx['app'], inst_name, f'{name}.pgpass')
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    pass
+                with open(path, 'w') as outf:
+                    outf.write('{}:{}:{}:{}:{}'.format(
+                        params['host'],
+                        params['port'],
+                        db_id,
+                        db_id,
+                        password
+                    ))
+                os.chmod(path, 0o600)
+                self.encrypt_file(path, purpose='the database credentials', passphrase=passphrase)
+                s3.upload_file(f'{path}.gpg', ctx['bucket'], f'fuku/{ctx["cluster"]}/{ctx["app"]}/{inst_name}/{name}.pgpass.gpg')
+                print(f'{name} [CREATED]')
 
     def handle_db_remove(self, args):
-        self.db_remove(args.dbname)
+        self.db_remove(args.dbnames)
 
-    def db_remove(self, name):
-        db_id = self.get_db_id(name)
-        self.psql(command=f'DROP DATABASE {db_id}')
-        self.psql(command=f'DROP ROLE {db_id}')
+    def db_remove(self, names):
+        if isinstance(names, str):
+            names = [names]
+        ctx = self.get_context()
+        self.check_db_names(names)
+        psycopg2 = get_psycopg2()
+        with connection(self.get_instance_params(ctx['dbinstance'])) as conn:
+            for name in names:
+                db_id = self.get_db_id(name)
+                try:
+                    execute(conn, [f'DROP DATABASE {db_id}', f'DROP ROLE {db_id}'])
+                except psycopg2.Error as e:
+                    self.error(f'failed to remove "{name}": {str(e).strip()}')
+                print(f'{name} [REMOVED]')
+
+    def check_db_names(self, names):
+        # Names end up in SQL as identifiers, so keep them plain.
+        for name in names:
+            if not DB_NAME.match(self.get_db_id(name)):
+                self.error(f'invalid database name "{name}"')
 
     # def handle_cache(self, args):
     #     self.cache(args.name, args.password)
@@ -284,9 +491,9 @@ class Pg(Module):
         self.clear_parent_selections()
 
     def handle_psql(self, args):
-        self.psql(args.dbname, args.command)
+        self.psql(args.dbname, args.command, args.file, args.single_transaction)
 
-    def psql(self, db_name=None, command=None):
+    def psql(self, db_name=None, command=None, file=None, single_transaction=False):
         ctx = self.get_context()
         inst_name = ctx['dbinstance']
         if db_name:
@@ -303,6 +510,11 @@ class Pg(Module):
         )
         if command:
             cmd = f'{cmd} -c "{self.escape(command)}"'
+        if file:
+            # Stop at the first error rather than running the rest.
+            cmd = f'{cmd} -v ON_ERROR_STOP=1 -f {shlex.quote(file)}'
+            if single_transaction:
+                cmd = f'{cmd} -1'
         self.run(
             cmd,
             capture=False,
@@ -310,28 +522,48 @@ class Pg(Module):
         )
 
     def handle_dump(self, args):
-        self.dump(args.dbname, args.output)
+        self.dump(args.dbname, args.output, args.parallel, args.jobs, args.tables, args.exclude_tables)
 
-    def dump(self, db_name, output):
+    def dump(self, db_name, output, parallel=False, jobs=None, tables=None, exclude_tables=None):
         ctx = self.get_context()
         db_id, path = self.get_db_creds(db_name)
         endpoint = self.get_endpoint(ctx['dbinstance'])
+        cmd = [
+            'pg_dump', '-x', '-O', '--verbose',
+            '-h', endpoint['Address'], '-p', str(endpoint['Port']),
+            '-U', db_id, '-d', db_id, '-f', output
+        ]
+        if parallel:
+            jobs = jobs or self.get_vcpus(ctx['dbinstance'])
+            cmd += ['-Fd', '-j', str(jobs)]
+        else:
+            cmd += ['-Fc']
+        for table in tables or []:
+            cmd += ['-t', table]
+        for table in exclude_tables or []:
+            cmd += ['-T', table]
+        start = time.monotonic()
         self.run(
-            'pg_dump -Fc -x -O -h {} -p {} -U {} -d {} -f {}'.format(
-                endpoint['Address'],
-                endpoint['Port'],
-                db_id,
-                db_id,
-                output
-            ),
+            cmd,
             capture=False,
-            env={'PGPASSFILE': path}
+            env={'PGPASSFILE': path},
+            on_stderr=TableProgress().feed
         )
+        print(f'dumped in {time.monotonic() - start:.1f}s')
 
     def handle_restore(self, args):
-        self.restore(args.dbname, args.input)
+        if args.from_backup:
+            if args.input:
+                self.error('give either INPUT or --from-backup, not both')
+            if args.parallel or args.jobs or args.exclude_tables:
+                self.error('--parallel, --jobs and --exclude-table need a local INPUT')
+            self.restore_backup(args.dbname, args.from_backup, args.tables, args.workers)
+        elif args.input:
+            self.restore(args.dbname, args.input, args.parallel, args.jobs, args.tables, args.exclude_tables)
+        else:
+            self.error('give INPUT or --from-backup')
 
-    def restore(self, db_name, input):
+    def restore(self, db_name, input, parallel=False, jobs=None, tables=None, exclude_tables=None):
         ctx = self.get_context()
         db_id, path = self.get_db_creds(db_name)
         # self.psql(command=f'DROP DATABASE {db_id}')
@@ -342,11 +574,87 @@ class Pg(Module):
         #     f'psql -h {endpoint["Address"]} -p {endpoint["Port"]} -U {db_name} {db_name} -c \'DROP SCHEMA public CASCADE; CREATE SCHEMA public;\'',
         #     env={'PGPASSFILE': path}
         # )
-        self.run(
-            f'pg_restore -x -O -c -h {endpoint["Address"]} -p {endpoint["Port"]} -U {db_id} -d {db_id} {input}',
-            capture=False,
-            env={'PGPASSFILE': path}
+        cmd = [
+            'pg_restore', '-x', '-O', '-c', '--verbose',
+            '-h', endpoint['Address'], '-p', str(endpoint['Port']),
+            '-U', db_id, '-d', db_id
+        ]
+        # Parallel jobs work with both custom files and directories.
+        if parallel or jobs or os.path.isdir(input):
+            jobs = jobs or self.get_vcpus(ctx['dbinstance'])
+            cmd += ['-j', str(jobs)]
+        with self.temporary_file() as list_file:
+            toc = self.filter_toc(input, tables, exclude_tables)
+            list_file.write('\n'.join(toc['entries']).encode())
+            list_file.flush()
+            cmd += ['-L', list_file.name, input]
+            start = time.monotonic()
+            self.run(
+                cmd,
+                capture=False,
+                env={'PGPASSFILE': path},
+                on_stderr=TableProgress(toc['tables']).feed
+            )
+        print(f'restored in {time.monotonic() - start:.1f}s')
+
+    def restore_backup(self, db_name, key, tables=None, workers=4, part_size=DEFAULT_PART_SIZE):
+        """ Restore a backup straight from S3, fetching it in concurrent
+        ranges and piping it into pg_restore. A pipe can't be seeked, so
+        the restore runs as a single job and tables can only be selected
+        by pg_restore's own -t.
+        """
+        ctx = self.get_context()
+        bucket_key = self.get_backup_key(db_name, key)
+        if bucket_key is None:
+            self.error(f'no backup "{key}"')
+        db_id, path = self.get_db_creds(db_name)
+        endpoint = self.get_endpoint(ctx['dbinstance'])
+        cmd = [
+            'pg_restore', '-x', '-O', '-c', '--verbose',
+            '-h', endpoint['Address'], '-p', str(endpoint['Port']),
+            '-U', db_id, '-d', db_id
+        ]
+        for table in tables or []:
+            cmd += ['-t', table]
+        download = RangedDownload(
+            self.get_boto_client('s3'), ctx['bucket'], bucket_key,
+            part_size=part_size, workers=workers, decompress=bucket_key.endswith('.zst')
         )
+        start = time.monotonic()
+        try:
+            with stream(cmd, 'w', env=dict(os.environ, PGPASSFILE=path),
+                        on_stderr=TableProgress().feed) as restore:
+                download.download(restore)
+        except CommandError as e:
+            self.error(f'restore failed: {e.out.stderr}')
+        print(f'restored in {time.monotonic() - start:.1f}s')
+
+    def filter_toc(self, input, tables=None, exclude_tables=None):
+        """ Read a dump's table of contents, keeping only the entries of
+        the selected tables. See `select_toc`.
+        """
+        toc = self.run(['pg_restore', '-l', input], capture=True).splitlines()
+        script = ''
+        if tables or exclude_tables:
+            script = self.run(['pg_restore', '-s', '--verbose', input], capture=True)
+        return select_toc(toc, script, tables, exclude_tables)
+
+    def get_vcpus(self, inst_name):
+        """ Number of vCPUs of a DB instance's class, used as the default
+        number of parallel dump/restore jobs.
+        """
+        rds = self.get_boto_client('rds', cache=True)
+        try:
+            inst_class = rds.describe_db_instances(
+                DBInstanceIdentifier=self.get_instance_id(inst_name)
+            )['DBInstances'][0]['DBInstanceClass']
+            ec2 = self.get_boto_client('ec2', cache=True)
+            return ec2.describe_instance_types(
+                InstanceTypes=[inst_class[len('db.'):]]
+            )['InstanceTypes'][0]['VCpuInfo']['DefaultVCpus']
+        except Exception:
+            self.get_logger().warning(f'unable to find vCPUs of "{inst_name}", assuming 2')
+            return 2
 
     def handle_rollback(self, args):
         self.rollback(args.dbname, args.time)
@@ -367,86 +675,216 @@ class Pg(Module):
         )
 
     def handle_backup(self, args):
-        self.backup(args.dbname, args.list)
-
-    def backup(self, db_name, list):
+        if args.list:
+            self.backup_list(args.dbname)
+        else:
+            self.backup(args.dbname, args.compress, args.part_size * MB, args.workers)
+
+    def backup_list(self, db_name):
+        def mb(size):
+            return '-' if size is None else f'{size / MB:.1f}MB'
+
+        for entry in self.get_manifest(db_name)['backups']:
+            line = f'{entry["key"]}  ({entry["created"]})  {mb(entry.get("size"))}'
+            line += f' stored as {mb(entry.get("compressed_size"))}'
+            if entry.get('duration') is not None:
+                line += f' in {entry["duration"]:.1f}s'
+            if entry.get('pg_version'):
+                line += f'  pg {entry["pg_version"]}'
+            print(line)
+
+    def backup(self, db_name, compress=None, part_size=DEFAULT_PART_SIZE, workers=4):
+        """ Stream a dump straight into S3, optionally compressed with zstd,
+        without writing it to local disk.
+        """
         ctx = self.get_context()
-        if list:
-            pre = 'backups/{}/{}/'.format(
-                ctx['dbinstance'],
-                db_name,
-            )
-            for obj in self.iters3(pre):
-                key = obj.key[obj.key.rfind('/') + 1:obj.key.rfind('.')]
-                print(f'{key}  ({obj.last_modified})')
-            return
         db_id, path = self.get_db_creds(db_name)
         endpoint = self.get_endpoint(ctx['dbinstance'])
-        cmd = 'pg_dump -Fc -x -O -h {} -p {} -U {} -d {}'.format(
-            endpoint['Address'],
-            endpoint['Port'],
-            db_id,
-            db_id
-        )
-        # key = str(datetime.now()).replace(' ', '-')
+        cmd = [
+            'pg_dump', '-Fc', '-x', '-O',
+            '-h', endpoint['Address'], '-p', str(endpoint['Port']),
+            '-U', db_id, '-d', db_id
+        ]
+        if compress is not None:
+            # Leave compression to zstd.
+            cmd += ['-Z', '0']
+        s3 = self.get_boto_client('s3')
+        existing = {e['key'] for e in self.get_manifest(db_name, s3=s3)['backups']}
         while 1:
             key = str(uuid.uuid4()).replace('-', '')[:8]
-            s3 = self.get_boto_resource('s3')
-            bucket_key = 'backups/{}/{}/{}.dump'.format(
-                ctx['dbinstance'],
-                db_name,
-                key
-            )
-            try:
-                s3.Object(ctx['bucket'], bucket_key)
+            if key not in existing:
                 break
-            except botocore.exceptions.ClientError as e:
-                pass
-        cmd += ' | aws s3 cp - s3://{}/backups/{}/{}/{}.dump --profile {}'.format(
-            ctx['bucket'],
-            ctx['dbinstance'],
-            db_name,
-            key,
-            ctx['profile']
-        )
-        self.run(
-            cmd,
-            capture=False,
-            env={'PGPASSFILE': path}
+        bucket_key = self.get_backup_prefix(db_name) + key + ('.dump.zst' if compress is not None else '.dump')
+        upload = MultipartUpload(
+            s3, ctx['bucket'], bucket_key,
+            part_size=part_size, workers=workers, compress=compress
         )
+        try:
+            with stream(cmd, env=dict(os.environ, PGPASSFILE=path)) as dump:
+                result = upload.upload(dump)
+        except CommandError as e:
+            # The dump stopped early, so what was uploaded is incomplete.
+            s3.delete_object(Bucket=ctx['bucket'], Key=bucket_key)
+            self.error(f'backup failed: {e.out.stderr}')
+        self.update_manifest(db_name, add=[{
+            'key': key,
+            'object': bucket_key,
+            'created': datetime.utcnow().isoformat(timespec='seconds'),
+            'size': result['size'],
+            'compressed_size': result['stored_size'],
+            'compression': 'zstd' if compress is not None else None,
+            'duration': round(result['duration'], 1),
+            'pg_version': self.get_engine_version(ctx['dbinstance']),
+            'sha256': result['sha256'],
+        }], s3=s3)
         print(f'backed up as "{key}"')
 
+    def handle_prune(self, args):
+        self.prune(args.dbname, args.keep, args.younger_than, args.dry_run)
+
+    def prune(self, db_name, keep=7, younger_than=None, dry_run=False):
+        """ Remove all but the latest `keep` backups, also keeping any made
+        within `younger_than` seconds.
+        """
+        ctx = self.get_context()
+        s3 = self.get_boto_client('s3')
+        backups = self.get_manifest(db_name, s3=s3)['backups']
+        candidates = backups[:max(len(backups) - keep, 0)]
+        if younger_than is not None:
+            cutoff = (datetime.utcnow() - timedelta(seconds=younger_than)).isoformat(timespec='seconds')
+            candidates = [e for e in candidates if e['created'] < cutoff]
+        for entry in candidates:
+            print(f'{entry["key"]}  ({entry["created"]})' + ('' if dry_run else ' [REMOVED]'))
+        if dry_run or not candidates:
+            return
+        for batch in chunks([e['object'] for e in candidates], 1000):
+            s3.delete_objects(
+                Bucket=ctx['bucket'],
+                Delete={'Objects': [{'Key': k} for k in batch], 'Quiet': True}
+            )
+        self.update_manifest(db_name, remove=[e['key'] for e in candidates], s3=s3)
+
+    def get_backup_prefix(self, db_name):
+        ctx = self.get_context()
+        return f'backups/{ctx["dbinstance"]}/{db_name}/'
+
+    def get_manifest(self, db_name, s3=None):
+        """ Load the catalog of a database's backups, oldest first. Backups
+        made before there was a manifest are found by listing the prefix
+        once, and are recorded when the manifest is next written.
+        """
+        from botocore.exceptions import ClientError
+        ctx = self.get_context()
+        if s3 is None:
+            s3 = self.get_boto_client('s3')
+        prefix = self.get_backup_prefix(db_name)
+        try:
+            body = s3.get_object(Bucket=ctx['bucket'], Key=prefix + MANIFEST)['Body'].read()
+            return json.loads(body)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                raise
+        # List directly rather than with iters3, which hides errors that
+        # would otherwise leave existing backups out of the manifest.
+        backups = []
+        paginator = s3.get_paginator('list_objects_v2')
+        try:
+            for page in paginator.paginate(Bucket=ctx['bucket'], Prefix=prefix):
+                for obj in page.get('Contents', []):
+                    name = obj['Key'][len(prefix):]
+                    if name == MANIFEST or '.dump' not in name:
+                        continue
+                    backups.append({
+                        'key': name[:name.find('.')],
+                        'object': obj['Key'],
+                        'created': obj['LastModified'].replace(tzinfo=None).isoformat(timespec='seconds'),
+                        'compressed_size': obj['Size'],
+                        'compression': 'zstd' if name.endswith('.zst') else None,
+                    })
+        except ClientError as e:
+            self.error(f'unable to list backups: {e}')
+        backups.sort(key=lambda e: e['created'])
+        return {'backups': backups}
+
+    def update_manifest(self, db_name, add=(), remove=(), s3=None):
+        """ Add and remove manifest entries. The manifest is re-read just
+        before writing to keep the window for racing writers small.
+        """
+        ctx = self.get_context()
+        if s3 is None:
+            s3 = self.get_boto_client('s3')
+        manifest = self.get_manifest(db_name, s3=s3)
+        manifest['backups'] = [e for e in manifest['backups'] if e['key'] not in remove] + list(add)
+        s3.put_object(
+            Bucket=ctx['bucket'],
+            Key=self.get_backup_prefix(db_name) + MANIFEST,
+            Body=json.dumps(manifest, indent=2).encode(),
+            ContentType='application/json'
+        )
+        return manifest
+
+    def get_backup_key(self, db_name, key, s3=None):
+        """ Find the object holding a backup, or None if there's no such
+        backup.
+        """
+        for entry in self.get_manifest(db_name, s3=s3)['backups']:
+            if entry['key'] == key:
+                return entry['object']
+        return None
+
+    def get_engine_version(self, inst_name):
+        rds = self.get_boto_client('rds', cache=True)
+        try:
+            return rds.describe_db_instances(
+                DBInstanceIdentifier=self.get_instance_id(inst_name)
+            )['DBInstances'][0]['EngineVersion']
+        except Exception:
+            return None
+
     def handle_share(self, args):
         self.share(args.dbname, args.key)
 
     def share(self, db_name, key):
         ctx = self.get_context()
-        db_id, path = self.get_db_creds(db_name)
-        # endpoint = self.get_endpoint(ctx['dbinstance'])
-        cmd = 'aws s3 presign s3://{}/backups/{}/{}/{}.dump --profile {}'.format(
-            ctx['bucket'],
-            ctx['dbinstance'],
-            db_name,
-            key,
-            ctx['profile']
-        )
-        r = self.run(
-            cmd,
-            capture=True,
-            env={'PGPASSFILE': path}
-        )
-        print(r)
+        bucket_key = self.get_backup_key(db_name, key)
+        if bucket_key is None:
+            self.error(f'no backup "{key}"')
+        s3 = self.get_boto_client('s3')
+        print(s3.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': ctx['bucket'], 'Key': bucket_key}
+        ))
 
     def handle_summary(self, args):
-        self.summary()
+        self.summary(args.workers, args.sample)
+
+    def summary(self, workers=8, sample=1.0):
+        """ Inventory every instance at once, printing each as it answers.
+        Credentials are fetched one at a time first, as decrypting them may
+        prompt.
+        """
+        params = {name: self.get_instance_params(name) for name in self.iter_db_instances()}
+
+        def inventory_one(inst_name):
+            return inventory(params[inst_name], sample)
 
-    def summary(self):
         print('')
-        for dbinst in self.iter_db_instances():
-            print(dbinst)
-            for db in self.iter_dbs(dbinst):
-                print(f'  {db}')
+        failed = []
+        for inst_name, rows, error in imap_concurrent(inventory_one, sorted(params), workers):
+            if error:
+                failed.append(inst_name)
+                print(f'{inst_name} [FAILED: {error}]')
+                print('')
+                continue
+            total = sum(r['size'] for r in rows)
+            print(
+                f'{inst_name}  ({len(rows)} databases, {total / MB / 1024:.1f}GB,'
+                f' {sum(r["connections"] for r in rows)} conns, {sum(r["tps"] or 0 for r in rows):.1f} tps)'
+            )
+            self.print_inventory(rows, indent='  ')
             print('')
+        if failed:
+            self.error(f'unable to inventory: {", ".join(sorted(failed))}')
 
     def get_instance_id(self, instance):
         ctx = self.get_context(use_context=False)
@@ -462,7 +900,7 @@ class Pg(Module):
 
     def get_endpoint(self, name):
         inst_id = self.get_instance_id(name)
-        rds = self.get_boto_client('rds')
+        rds = self.get_boto_client('rds', cache=True)
         try:
             return rds.describe_db_instances(
                 DBInstanceIdentifier=inst_id
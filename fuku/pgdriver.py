@@ -0,0 +1,142 @@
+import threading
+import time
+from contextlib import contextmanager
+
+CONNECT_TIMEOUT = 10
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_psycopg2():
+    try:
+        import psycopg2
+        import psycopg2.pool
+    except ImportError:
+        raise RuntimeError('talking to postgres needs the psycopg2 package, install fuku[pg]')
+    return psycopg2
+
+
+def read_pgpass(path):
+    """ Connection parameters from a single line pgpass file, as written by
+    `fuku pg mk` and `fuku pg db mk`.
+    """
+    with open(path) as inf:
+        host, port, dbname, user, password = inf.read().strip().split(':', 4)
+    return {'host': host, 'port': int(port), 'dbname': dbname, 'user': user, 'password': password}
+
+
+def get_pool(params, maxconn=4):
+    """ Shared thread safe pool of connections for a set of connection
+    parameters, created on first use. The password is part of the key so a
+    changed password never reuses connections made with the old one.
+    """
+    key = tuple(sorted(params.items()))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            psycopg2 = get_psycopg2()
+            pool = psycopg2.pool.ThreadedConnectionPool(
+                0, maxconn, connect_timeout=CONNECT_TIMEOUT, **params
+            )
+            _pools[key] = pool
+    return pool
+
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+
+
+@contextmanager
+def connection(params, autocommit=True):
+    """ Borrow a pooled connection. Connections left broken by an error are
+    discarded rather than returned to the pool.
+    """
+    pool = get_pool(params)
+    conn = pool.getconn()
+    broken = False
+    try:
+        if conn.autocommit != autocommit:
+            conn.autocommit = autocommit
+        yield conn
+    except BaseException:
+        broken = bool(conn.closed)
+        if not conn.closed and not conn.autocommit:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn, close=broken)
+
+
+@contextmanager
+def transaction(conn):
+    """ Run the statements of a block in one transaction on an autocommit
+    connection, committing if the block succeeds.
+    """
+    conn.autocommit = False
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        if not conn.closed:
+            conn.autocommit = True
+
+
+def execute(conn, statements):
+    """ Run statements one after another on a connection, each either
+    SQL or a tuple of SQL and its arguments.
+    """
+    with conn.cursor() as cur:
+        for stmt in statements:
+            sql, args = stmt if isinstance(stmt, tuple) else (stmt, None)
+            cur.execute(sql, args)
+
+
+def query(conn, sql, args=None):
+    """ Run a statement and return its rows as dictionaries.
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql, args)
+        if cur.description is None:
+            return []
+        names = [col.name for col in cur.description]
+        return [dict(zip(names, row)) for row in cur.fetchall()]
+
+
+INVENTORY_SQL = '''
+SELECT d.datname AS name,
+       pg_database_size(d.datname) AS size,
+       s.numbackends AS connections,
+       s.xact_commit + s.xact_rollback AS xacts
+  FROM pg_database d
+  JOIN pg_stat_database s ON s.datid = d.oid
+ WHERE NOT d.datistemplate
+ ORDER BY d.datname
+'''
+
+
+def inventory(params, sample=1.0):
+    """ Size, connection count and transactions per second of each database
+    on a server. The rate comes from two samples of the transaction
+    counters taken `sample` seconds apart, and is None without a sample.
+    """
+    with connection(params) as conn:
+        first = query(conn, INVENTORY_SQL)
+        if not sample:
+            return [dict(row, tps=None) for row in first]
+        start = time.monotonic()
+        time.sleep(sample)
+        second = {row['name']: row for row in query(conn, INVENTORY_SQL)}
+        elapsed = time.monotonic() - start
+    rows = []
+    for row in first:
+        later = second.get(row['name'], row)
+        rows.append(dict(later, tps=(later['xacts'] - row['xacts']) / elapsed))
+    return rows
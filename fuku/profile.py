@@ -1,8 +1,7 @@
 import os
 from configparser import ConfigParser
 
-import boto3
-
+from . import aws
 from .module import Module
 from .utils import entity_already_exists, limit_exceeded
 
@@ -92,7 +91,7 @@ class Profile(Module):
     def create_ec2_role(self, user):
         role_name = 'ec2-role'
         inst_name = 'ec2-profile'
-        iam = boto3.Session(profile_name=user).client('iam')
+        iam = aws.get_client('iam', profile=user)
         self.create_role(user, role_name, ['ec2-policy'], iam=iam)
         with entity_already_exists():
             iam.create_instance_profile(
@@ -107,7 +106,7 @@ class Profile(Module):
 
     def create_role(self, user, name, policies=[], iam=None):
         if iam is None:
-            iam = boto3.Session(profile_name=user).client('iam')
+            iam = aws.get_client('iam', profile=user)
         with entity_already_exists():
             iam.create_role(
                 RoleName=name,
@@ -1,11 +1,17 @@
+import asyncio
 import os
 import re
+import signal
 import subprocess
+import threading
+from collections import deque
 from contextlib import contextmanager
 
-from fabric.operations import _AttributeString, _prefix_commands, _prefix_env_vars
-from fabric.state import env as _env
-from fabric.state import output, win32
+# Captured output beyond this many bytes per stream is dropped from the
+# front, keeping the tail where errors usually are.
+MAX_CAPTURE = 16 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+OK_RETURN_CODES = (0,)
 
 
 class CommandError(Exception):
@@ -14,100 +20,259 @@ class CommandError(Exception):
         self.out = out
 
 
-def local(command, capture=False, shell=None, ignore_errors=False, env=None):
+class CommandOutput(str):
+    """ Stripped standard output of a command, carrying `command`,
+    `return_code`, `stderr`, `failed`, `succeeded` and `truncated`.
     """
-    Run a command on the local system.
-    `local` is simply a convenience wrapper around the use of the builtin
-    Python ``subprocess`` module with ``shell=True`` activated. If you need to
-    do anything special, consider using the ``subprocess`` module directly.
-    ``shell`` is passed directly to `subprocess.Popen
-    <http://docs.python.org/library/subprocess.html#subprocess.Popen>`_'s
-    ``execute`` argument (which determines the local shell to use.)  As per the
-    linked documentation, on Unix the default behavior is to use ``/bin/sh``,
-    so this option is useful for setting that value to e.g.  ``/bin/bash``.
-    `local` is not currently capable of simultaneously printing and
-    capturing output, as `~fabric.operations.run`/`~fabric.operations.sudo`
-    do. The ``capture`` kwarg allows you to switch between printing and
-    capturing as necessary, and defaults to ``False``.
-    When ``capture=False``, the local subprocess' stdout and stderr streams are
-    hooked up directly to your terminal, though you may use the global
-    :doc:`output controls </usage/output_controls>` ``output.stdout`` and
-    ``output.stderr`` to hide one or both if desired. In this mode, the return
-    value's stdout/stderr values are always empty.
-    When ``capture=True``, you will not see any output from the subprocess in
-    your terminal, but the return value will contain the captured
-    stdout/stderr.
-    In either case, as with `~fabric.operations.run` and
-    `~fabric.operations.sudo`, this return value exhibits the ``return_code``,
-    ``stderr``, ``failed``, ``succeeded``, ``command`` and ``real_command``
-    attributes. See `run` for details.
-    `~fabric.operations.local` will honor the `~fabric.context_managers.lcd`
-    context manager, allowing you to control its current working directory
-    independently of the remote end (which honors
-    `~fabric.context_managers.cd`).
-    .. versionchanged:: 1.0
-        Added the ``succeeded`` and ``stderr`` attributes.
-    .. versionchanged:: 1.0
-        Now honors the `~fabric.context_managers.lcd` context manager.
-    .. versionchanged:: 1.0
-        Changed the default value of ``capture`` from ``True`` to ``False``.
-    .. versionadded:: 1.9
-        The return value attributes ``.command`` and ``.real_command``.
+
+
+class Capture(object):
+    """ Bounded buffer of output lines, optionally passing each line to a
+    callback as it arrives.
     """
-    given_command = command
-    # Apply cd(), path() etc
-    with_env = _prefix_env_vars(command, local=True)
-    wrapped_command = _prefix_commands(with_env, 'local')
-    # if output.debug:
-    #     print("[localhost] local: %s" % (wrapped_command))
-    # elif output.running:
-    #     print("[localhost] local: " + given_command)
-    # Tie in to global output controls as best we can; our capture argument
-    # takes precedence over the output settings.
-    dev_null = None
-    if capture:
-        out_stream = subprocess.PIPE
-        err_stream = subprocess.PIPE
-    else:
-        dev_null = open(os.devnull, 'w+')
-        # Non-captured, hidden streams are discarded.
-        out_stream = None if output.stdout else dev_null
-        err_stream = None if output.stderr else dev_null
+
+    def __init__(self, keep=True, callback=None, limit=MAX_CAPTURE):
+        self.keep = keep
+        self.callback = callback
+        self.limit = limit
+        self.lines = deque()
+        self.size = 0
+        self.truncated = False
+
+    def feed(self, data):
+        if self.callback:
+            self.callback(data.decode(errors='replace').rstrip('\r\n'))
+        if not self.keep:
+            return
+        self.lines.append(data)
+        self.size += len(data)
+        while self.size > self.limit and len(self.lines) > 1:
+            self.size -= len(self.lines.popleft())
+            self.truncated = True
+
+    def getvalue(self):
+        return b''.join(self.lines).decode(errors='replace').strip()
+
+
+def make_output(command, return_code, out, err, ignore_errors):
+    output = CommandOutput(out.getvalue())
+    output.command = command
+    output.return_code = return_code
+    output.stderr = CommandOutput(err.getvalue())
+    output.truncated = out.truncated or err.truncated
+    output.failed = return_code not in OK_RETURN_CODES
+    output.succeeded = not output.failed
+    if output.failed and not ignore_errors:
+        raise CommandError(output)
+    return output
+
+
+def prepare(command, capture, on_stdout, on_stderr, stdin):
+    """ Work out how to connect a command's streams. Output is piped only
+    when it's captured or streamed to a callback, otherwise the command
+    shares our terminal.
+    """
+    shell = isinstance(command, str)
+    out_pipe = capture or on_stdout is not None
+    err_pipe = capture or on_stderr is not None
+    if isinstance(stdin, str):
+        stdin = stdin.encode()
+    return shell, out_pipe, err_pipe, stdin
+
+
+def local(command, capture=False, shell=None, ignore_errors=False, env=None, timeout=None,
+          on_stdout=None, on_stderr=None, stdin=None, cwd=None, max_capture=MAX_CAPTURE):
+    """ Run a command on the local system.
+
+    A string is run by the shell (`shell` picks the executable, /bin/sh by
+    default), while a list is executed directly without any quoting
+    concerns. With `capture` the stripped standard output is returned and
+    standard error is available as its `stderr` attribute, each holding at
+    most `max_capture` bytes. `on_stdout` and `on_stderr` are called with
+    each line as it's produced, whether or not output is captured.
+
+    `stdin` may be bytes or text to send, or a file object to read from.
+    After `timeout` seconds the command and its children are killed. A
+    non-zero exit raises `CommandError` unless `ignore_errors` is set.
+    """
+    is_shell, out_pipe, err_pipe, stdin = prepare(command, capture, on_stdout, on_stderr, stdin)
     if env is None:
         env = os.environ
+    p = subprocess.Popen(
+        command,
+        shell=is_shell,
+        executable=shell if is_shell else None,
+        stdin=subprocess.PIPE if isinstance(stdin, bytes) else stdin,
+        stdout=subprocess.PIPE if out_pipe else None,
+        stderr=subprocess.PIPE if err_pipe else None,
+        cwd=cwd,
+        env=env,
+        # A separate process group lets a timeout kill the shell's
+        # children too.
+        start_new_session=timeout is not None
+    )
+    out = Capture(capture, on_stdout, max_capture)
+    err = Capture(capture, on_stderr, max_capture)
+
+    def pump(stream, sink):
+        with stream:
+            for data in iter(lambda: stream.readline(CHUNK_SIZE), b''):
+                sink.feed(data)
+
+    def feed_stdin():
+        try:
+            p.stdin.write(stdin)
+            p.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    threads = []
+    if out_pipe:
+        threads.append(threading.Thread(target=pump, args=(p.stdout, out), daemon=True))
+    if err_pipe:
+        threads.append(threading.Thread(target=pump, args=(p.stderr, err), daemon=True))
+    if isinstance(stdin, bytes):
+        threads.append(threading.Thread(target=feed_stdin, daemon=True))
+    for thread in threads:
+        thread.start()
     try:
-        cmd_arg = wrapped_command if win32 else [wrapped_command]
-        p = subprocess.Popen(cmd_arg, shell=True, stdout=out_stream,
-                             stderr=err_stream, executable=shell,
-                             close_fds=(not win32),
-                             env=env)
-        (stdout, stderr) = p.communicate()
+        p.wait(timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(p.pid, signal.SIGKILL)
+        p.wait()
+        err.keep = True
+        err.feed(f'timed out after {timeout}s\n'.encode())
+    except BaseException:
+        p.kill()
+        p.wait()
+        raise
     finally:
-        if dev_null is not None:
-            dev_null.close()
-    # Handle error condition (deal with stdout being None, too)
-    out = _AttributeString(stdout.decode().strip() if stdout else "")
-    err = _AttributeString(stderr.decode().strip() if stderr else "")
-    out.command = given_command
-    out.real_command = wrapped_command
-    out.failed = False
-    out.return_code = p.returncode
-    out.stderr = err
-    if p.returncode not in _env.ok_ret_codes and not ignore_errors:
-        out.failed = True
-        # msg = "local() encountered an error (return code %s) while executing '%s'" % (p.returncode, command)
-        # print('\n\n')
-        # if out:
-        #     print('{}'.format(out))
-        # print('\n')
-        # if err:
-        #     print('{}'.format(err))
-        # sys.exit(1)
-        raise CommandError(out)
-        # error(message=msg, stdout=out, stderr=err)
-    out.succeeded = not out.failed
-    # If we were capturing, this will be a string; otherwise it will be None.
-    return out
+        for thread in threads:
+            thread.join()
+    return make_output(command, p.returncode, out, err, ignore_errors)
+
+
+async def local_async(command, capture=False, shell=None, ignore_errors=False, env=None,
+                      timeout=None, on_stdout=None, on_stderr=None, stdin=None, cwd=None,
+                      max_capture=MAX_CAPTURE):
+    """ Coroutine version of `local`, for running several commands at
+    once from an event loop.
+    """
+    is_shell, out_pipe, err_pipe, stdin = prepare(command, capture, on_stdout, on_stderr, stdin)
+    if env is None:
+        env = os.environ
+    kwargs = dict(
+        stdin=subprocess.PIPE if isinstance(stdin, bytes) else stdin,
+        stdout=subprocess.PIPE if out_pipe else None,
+        stderr=subprocess.PIPE if err_pipe else None,
+        cwd=cwd,
+        env=env,
+        limit=CHUNK_SIZE,
+        start_new_session=timeout is not None
+    )
+    if is_shell:
+        p = await asyncio.create_subprocess_shell(command, executable=shell, **kwargs)
+    else:
+        p = await asyncio.create_subprocess_exec(*command, **kwargs)
+    out = Capture(capture, on_stdout, max_capture)
+    err = Capture(capture, on_stderr, max_capture)
+
+    async def pump(stream, sink):
+        while True:
+            try:
+                data = await stream.readuntil(b'\n')
+            except asyncio.IncompleteReadError as e:
+                data = e.partial
+            except asyncio.LimitOverrunError as e:
+                data = await stream.read(e.consumed)
+            if not data:
+                break
+            sink.feed(data)
+
+    async def feed_stdin():
+        try:
+            p.stdin.write(stdin)
+            await p.stdin.drain()
+            p.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    tasks = []
+    if out_pipe:
+        tasks.append(pump(p.stdout, out))
+    if err_pipe:
+        tasks.append(pump(p.stderr, err))
+    if isinstance(stdin, bytes):
+        tasks.append(feed_stdin())
+    try:
+        await asyncio.wait_for(asyncio.gather(p.wait(), *tasks), timeout)
+    except asyncio.TimeoutError:
+        os.killpg(p.pid, signal.SIGKILL)
+        await p.wait()
+        err.keep = True
+        err.feed(f'timed out after {timeout}s\n'.encode())
+    except BaseException:
+        if p.returncode is None:
+            p.kill()
+            await p.wait()
+        raise
+    return make_output(command, p.returncode, out, err, ignore_errors)
+
+
+@contextmanager
+def stream(command, mode='r', env=None, stdin=None, stdout=None, on_stderr=None, max_capture=MAX_CAPTURE):
+    """ Start a command and yield a binary pipe to it, its standard
+    output with mode "r" or its standard input with "w", so large data can
+    be streamed through Python without touching disk. The other stream
+    may be given as a file object. Standard error is captured, and passed
+    line by line to `on_stderr` if given. Once the block exits a non-zero
+    exit raises `CommandError`, which takes precedence over a broken pipe
+    from writing to a command that has already failed.
+    """
+    if mode not in ('r', 'w'):
+        raise ValueError('mode must be "r" or "w"')
+    p = subprocess.Popen(
+        command,
+        shell=isinstance(command, str),
+        stdin=subprocess.PIPE if mode == 'w' else stdin,
+        stdout=subprocess.PIPE if mode == 'r' else stdout,
+        stderr=subprocess.PIPE,
+        env=env,
+        # Killing the whole group stops a shell's children too, which
+        # would otherwise hold standard error open.
+        start_new_session=True
+    )
+    err = Capture(True, on_stderr, max_capture)
+    pipe = p.stdout if mode == 'r' else p.stdin
+
+    def pump():
+        with p.stderr:
+            for data in iter(lambda: p.stderr.readline(CHUNK_SIZE), b''):
+                err.feed(data)
+
+    thread = threading.Thread(target=pump, daemon=True)
+    thread.start()
+    broken = None
+    try:
+        yield pipe
+    except BrokenPipeError as e:
+        if mode != 'w':
+            os.killpg(p.pid, signal.SIGKILL)
+            raise
+        broken = e
+    except BaseException:
+        os.killpg(p.pid, signal.SIGKILL)
+        raise
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+        p.wait()
+        thread.join()
+    make_output(command, p.returncode, Capture(), err, False)
+    if broken is not None:
+        raise broken
 
 
 run = local
@@ -120,134 +285,3 @@ def already_exists(expr):
     except Exception as e:
         if not re.search(expr, str(e)):
             raise
-
-# from fabric.api import task, run as fabrun
-
-
-# @task
-# def run(cmd):
-#     fabrun(cmd)
-
-
-# from contextlib import contextmanager
-
-# # from fabric.operations import _run_command
-# from fabric.context_managers import (
-#     warn_only as warn_only_manager,
-#     quiet as quiet_manager
-# )
-
-
-# @contextmanager
-# def _noop():
-#     yield
-
-
-# env = {
-#     'use_shell': False,
-
-# }
-
-
-# def _shell_wrap(command, shell_escape, shell=True, sudo_prefix=None):
-#     """
-#     Conditionally wrap given command in env.shell (while honoring sudo.)
-#     """
-#     # Honor env.shell, while allowing the 'shell' kwarg to override it (at
-#     # least in terms of turning it off.)
-#     if shell and not env.use_shell:
-#         shell = False
-#     # Sudo plus space, or empty string
-#     if sudo_prefix is None:
-#         sudo_prefix = ""
-#     else:
-#         sudo_prefix += " "
-#     # If we're shell wrapping, prefix shell and space. Next, escape the command
-#     # if requested, and then quote it. Otherwise, empty string.
-#     if shell:
-#         shell = env.shell + " "
-#         if shell_escape:
-#             command = _shell_escape(command)
-#         command = '"%s"' % command
-#     else:
-#         shell = ""
-#     # Resulting string should now have correct formatting
-#     return sudo_prefix + shell + command
-
-
-# def _run_command(command, shell=True, pty=True, combine_stderr=True,
-#                  sudo=False, user=None, quiet=False, warn_only=False,
-#                  stdout=None, stderr=None, group=None, timeout=None,
-#                  shell_escape=None, capture_buffer_size=None):
-#     """
-#     Underpinnings of `run` and `sudo`. See their docstrings for more info.
-#     """
-#     manager = _noop
-#     if warn_only:
-#         manager = warn_only_manager
-#     # Quiet's behavior is a superset of warn_only's, so it wins.
-#     if quiet:
-#         manager = quiet_manager
-#     with manager():
-#         # Set up new var so original argument can be displayed verbatim later.
-#         given_command = command
-
-#         # # Check if shell_escape has been overridden in env
-#         # if shell_escape is None:
-#         #     shell_escape = env.get('shell_escape', True)
-
-#         # Handle context manager modifications, and shell wrapping
-#         wrapped_command = _shell_wrap(
-#             _prefix_env_vars(_prefix_commands(command, 'remote')),
-#             shell_escape,
-#             shell,
-#             _sudo_prefix(user, group) if sudo else None
-#         )
-#         # Execute info line
-#         which = 'sudo' if sudo else 'run'
-#         if output.debug:
-#             print("[%s] %s: %s" % (env.host_string, which, wrapped_command))
-#         elif output.running:
-#             print("[%s] %s: %s" % (env.host_string, which, given_command))
-
-#         # Actual execution, stdin/stdout/stderr handling, and termination
-#         result_stdout, result_stderr, status = _execute(
-#             channel=default_channel(), command=wrapped_command, pty=pty,
-#             combine_stderr=combine_stderr, invoke_shell=False, stdout=stdout,
-#             stderr=stderr, timeout=timeout,
-#             capture_buffer_size=capture_buffer_size)
-
-#         # Assemble output string
-#         out = _AttributeString(result_stdout)
-#         err = _AttributeString(result_stderr)
-
-#         # Error handling
-#         out.failed = False
-#         out.command = given_command
-#         out.real_command = wrapped_command
-#         if status not in env.ok_ret_codes:
-#             out.failed = True
-#             msg = "%s() received nonzero return code %s while executing" % (
-#                 which, status
-#             )
-#             if env.warn_only:
-#                 msg += " '%s'!" % given_command
-#             else:
-#                 msg += "!\n\nRequested: %s\nExecuted: %s" % (
-#                     given_command, wrapped_command
-#                 )
-#             error(message=msg, stdout=out, stderr=err)
-
-#         # Attach return code to output string so users who have set things to
-#         # warn only, can inspect the error code.
-#         out.return_code = status
-
-#         # Convenience mirror of .failed
-#         out.succeeded = not out.failed
-
-#         # Attach stderr for anyone interested in that.
-#         out.stderr = err
-
-#         return out
-
-# run = _run_command
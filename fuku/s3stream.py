@@ -0,0 +1,217 @@
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+MB = 1024 * 1024
+# S3 needs parts of at least 5MB, other than the last.
+MIN_PART_SIZE = 5 * MB
+MAX_PART_SIZE = 5 * 1024 * MB
+MAX_PARTS = 10000
+# Part sizes double after this many parts, so streams of unknown length
+# fit within S3's part limit.
+PARTS_PER_STEP = 1000
+DEFAULT_PART_SIZE = 64 * MB
+READ_SIZE = 1 * MB
+REPORT_EVERY = 5
+
+
+def get_compressor(level):
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError('compression needs the zstandard package, install fuku[zstd]')
+    return zstandard.ZstdCompressor(level=level, threads=-1).compressobj()
+
+
+def get_decompressor():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError('decompression needs the zstandard package, install fuku[zstd]')
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+class Progress(object):
+    """ Periodically prints how much has been read and stored, and the
+    throughput so far.
+    """
+
+    def __init__(self, label, out=print, every=REPORT_EVERY):
+        self.label = label
+        self.out = out
+        self.every = every
+        self.start = self.last = time.monotonic()
+        self.read = 0
+        self.written = 0
+        self.lock = threading.Lock()
+
+    def update(self, read=0, written=0):
+        with self.lock:
+            self.read += read
+            self.written += written
+            now = time.monotonic()
+            if now - self.last >= self.every:
+                self.last = now
+                self.report()
+
+    def report(self, final=False):
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        msg = (
+            f'{self.label}: {self.read / MB:.1f}MB read, {self.written / MB:.1f}MB stored,'
+            f' {self.read / MB / elapsed:.1f}MB/s'
+        )
+        if final:
+            msg += f' in {elapsed:.1f}s'
+        self.out(msg)
+
+
+class MultipartUpload(object):
+    """ Upload a stream of unknown length to S3 as a multipart upload,
+    optionally compressing it with zstd on the way. Parts are uploaded
+    concurrently while more of the stream is read, with at most a few
+    parts held in memory at once. As the stream's length isn't known up
+    front, parts grow as more are uploaded; from the smallest part size
+    of 5MB, up to about 5TB fits in S3's 10,000 parts.
+    """
+
+    def __init__(self, s3_cli, bucket, key, part_size=DEFAULT_PART_SIZE, workers=4,
+                 compress=None, out=print):
+        self.s3_cli = s3_cli
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.workers = workers
+        self.compress = compress
+        self.out = out
+
+    def get_part_size(self, number):
+        step = (number - 1) // PARTS_PER_STEP
+        return min(self.part_size * 2 ** step, MAX_PART_SIZE)
+
+    def upload(self, stream):
+        """ Read `stream` to the end and store it. Returns a dictionary with
+        the `size` read, `stored_size`, `sha256` of the stored object,
+        `parts` and `duration`.
+        """
+        progress = Progress(self.key, self.out)
+        compressor = get_compressor(self.compress) if self.compress is not None else None
+        digest = hashlib.sha256()
+        upload_id = self.s3_cli.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        slots = threading.Semaphore(self.workers + 1)
+        futures = []
+
+        def upload_part(number, body):
+            try:
+                etag = self.s3_cli.upload_part(
+                    Bucket=self.bucket, Key=self.key, UploadId=upload_id,
+                    PartNumber=number, Body=body
+                )['ETag']
+                progress.update(written=len(body))
+                return {'PartNumber': number, 'ETag': etag}
+            finally:
+                slots.release()
+
+        def submit(pool, body):
+            if len(futures) >= MAX_PARTS:
+                raise RuntimeError(f'{self.key} is too large for a multipart upload')
+            digest.update(body)
+            slots.acquire()
+            futures.append(pool.submit(upload_part, len(futures) + 1, body))
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                buf = bytearray()
+                while True:
+                    data = stream.read(READ_SIZE)
+                    if not data:
+                        break
+                    progress.update(read=len(data))
+                    buf += compressor.compress(data) if compressor else data
+                    while len(buf) >= self.get_part_size(len(futures) + 1):
+                        size = self.get_part_size(len(futures) + 1)
+                        submit(pool, bytes(buf[:size]))
+                        del buf[:size]
+                        # Fail early rather than reading the whole stream.
+                        for future in futures:
+                            if future.done() and future.exception():
+                                raise future.exception()
+                if compressor:
+                    buf += compressor.flush()
+                if buf or not futures:
+                    submit(pool, bytes(buf))
+                parts = [future.result() for future in futures]
+            self.s3_cli.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except BaseException:
+            self.s3_cli.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=upload_id)
+            raise
+        progress.report(final=True)
+        return {
+            'size': progress.read,
+            'stored_size': progress.written,
+            'sha256': digest.hexdigest(),
+            'parts': len(parts),
+            'duration': time.monotonic() - progress.start,
+        }
+
+
+class RangedDownload(object):
+    """ Stream an S3 object into a file-like object using concurrent
+    ranged GETs, optionally decompressing zstd on the way. Ranges are
+    fetched ahead of the writer but written strictly in order, with at
+    most a few ranges held in memory at once.
+    """
+
+    def __init__(self, s3_cli, bucket, key, part_size=DEFAULT_PART_SIZE, workers=4,
+                 decompress=False, out=print):
+        self.s3_cli = s3_cli
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.workers = workers
+        self.decompress = decompress
+        self.out = out
+
+    def download(self, dest):
+        """ Write the object to `dest`. Returns a dictionary with the
+        `size` written, `stored_size`, `parts` and `duration`.
+        """
+        size = self.s3_cli.head_object(Bucket=self.bucket, Key=self.key)['ContentLength']
+        progress = Progress(self.key, self.out)
+        decompressor = get_decompressor() if self.decompress else None
+        ranges = [(start, min(start + self.part_size, size) - 1) for start in range(0, size, self.part_size)]
+
+        def fetch(byte_range):
+            return self.s3_cli.get_object(
+                Bucket=self.bucket, Key=self.key,
+                Range=f'bytes={byte_range[0]}-{byte_range[1]}'
+            )['Body'].read()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = [pool.submit(fetch, r) for r in ranges[:self.workers + 1]]
+            queued = len(pending)
+            try:
+                while pending:
+                    data = pending.pop(0).result()
+                    if queued < len(ranges):
+                        pending.append(pool.submit(fetch, ranges[queued]))
+                        queued += 1
+                    if decompressor:
+                        data, stored = decompressor.decompress(data), len(data)
+                    else:
+                        stored = len(data)
+                    dest.write(data)
+                    progress.update(read=stored, written=len(data))
+            finally:
+                for future in pending:
+                    future.cancel()
+        progress.report(final=True)
+        return {
+            'size': progress.written,
+            'stored_size': size,
+            'parts': len(ranges),
+            'duration': time.monotonic() - progress.start,
+        }
@@ -1,8 +1,9 @@
 import json
+import time
 
 from .module import Module
+from .parallel import RateLimiter, chunks, imap_concurrent, throttled
 from .runner import CommandError
-from .task import IGNORED_TASK_KWARGS
 from .utils import (
     StoreKeyValuePair,
     dict_to_env,
@@ -10,9 +11,13 @@ from .utils import (
     env_to_string,
     json_serial,
     mounts_to_string,
+    parse_duration,
     ports_to_string,
     volumes_to_dict,
 )
+from .waiter import ServiceWaiter, WaitTimeout
+
+ROLLOUT_HISTORY = 50
 
 
 class Service(Module):
@@ -216,34 +221,14 @@ class Service(Module):
 
     def run(self, task_name, command):
         task_mod = self.get_module('task')
-        ecs_cli = self.get_boto_client('ecs')
+        node_mod = self.get_module('node')
         ec2 = self.get_boto_resource('ec2')
-        ctx = self.get_context()
         family = '_' + task_mod.get_task_family(task_name)
-        cluster = f'fuku-{ctx["cluster"]}'
-        task_arns = ecs_cli.list_tasks(
-            cluster=cluster,
-            family=family,
-            desiredStatus='RUNNING'
-        )['taskArns']
-        if not task_arns:
+        inst_id = next(node_mod.get_topology().iter_task_ec2_ids(family), None)
+        if inst_id is None:
             self.error('no running tasks for that service')
-        # task_id = task_arns[0][task_arns[0].rfind('/') + 1:]
-        cinst_arn = ecs_cli.describe_tasks(
-            cluster=cluster,
-            tasks=[
-                task_arns[0]
-            ]
-        )['tasks'][0]['containerInstanceArn']
-        inst_id = ecs_cli.describe_container_instances(
-            cluster=cluster,
-            containerInstances=[
-                cinst_arn
-            ]
-        )['containerInstances'][0]['ec2InstanceId']
         inst = ec2.Instance(inst_id)
         cmd = f'docker exec -it `docker ps | grep {family} | awk \'{{ print $1 }}\' | head -1` {" ".join(command)}'
-        node_mod = self.get_module('node')
         node_mod.ssh_run(cmd, inst=inst, tty=True)
 
     def handle_logs(self, args):
@@ -357,6 +342,7 @@ class EcsService(Service):
         p.add_argument('task', metavar='TASK', help='task name')
         p.add_argument('--replicas', '-r', help='number of replicas')
         p.add_argument('--placement', '-p', action=StoreKeyValuePair, nargs='*', help='set placement')
+        p.add_argument('--prewarm', action='store_true', help='pull the image onto every node first')
         # p.add_argument('--min-healthy', help='minimum healthy tasks (%%)')
         # p.add_argument('--max-healthy', default=200, help='maximum healthy tasks (%%)')
         p.set_defaults(service_handler=self.handle_update)
@@ -368,11 +354,19 @@ class EcsService(Service):
 
         p = subp.add_parser('redeploy', help='redeploy all')
         p.add_argument('tasks', metavar='TASKS', nargs='*', help='task name')
+        p.add_argument('--wait', action='store_true', help='wait for services to become stable')
+        p.add_argument('--prewarm', action='store_true', help='pull images onto every node first')
+        p.add_argument('--workers', '-w', type=int, default=8, help='services to redeploy at once')
+        p.add_argument('--rate', type=float, default=5, help='maximum requests per second')
         p.set_defaults(service_handler=self.handle_redeploy)
 
         p = subp.add_parser('wait', help='wait for deployment')
         p.add_argument('tasks', metavar='TASK', nargs='*', help='task name')
-        p.add_argument('--stable', '-s', action='store_true', help='wait for stable services')
+        p.add_argument('--stable', '-s', action='store_true', default=True,
+                       help='wait for old deployments to drain (default)')
+        p.add_argument('--no-stable', dest='stable', action='store_false',
+                       help='return once the new deployment is running')
+        p.add_argument('--timeout', '-t', type=parse_duration, default=1800, help='give up after, e.g. 10m')
         p.set_defaults(service_handler=self.handle_wait)
 
         p = subp.add_parser('rm', help='remove a service')
@@ -435,11 +429,7 @@ class EcsService(Service):
         env['TASK_NAME'] = task_name
         ctr_def['environment'] = dict_to_env(env)
         task['containerDefinitions'] = [ctr_def]
-        ecs_cli = self.get_boto_client('ecs')
-        skip = set(IGNORED_TASK_KWARGS)
-        task = ecs_cli.register_task_definition(**{
-            k: v for k, v in task.items() if k not in skip
-        })['taskDefinition']
+        task = task_mod.register_task(task)['taskDefinition']
         # TODO: Deregister previous task definitions.
         kwargs = {
             'cluster': cluster,
@@ -477,26 +467,25 @@ class EcsService(Service):
                 }
             ]
             kwargs['role'] = 'ecsServiceRole'
+        ecs_cli = self.get_boto_client('ecs')
         ecs_cli.create_service(**kwargs)
 
-    def update(self, task_name, replicas=None, mode=None, placement=None):
+    def handle_update(self, args):
+        if args.prewarm:
+            self.prewarm([args.task])
+        self.update(args.task, args.replicas, placement=args.placement)
+
+    def update(self, task_name, replicas=None, mode=None, placement=None, app_task=None, limiter=None):
         ctx = self.get_context()
         cluster = f'fuku-{ctx["cluster"]}'
         task_mod = self.client.get_module('task')
-        app_task = task_mod.get_task(None)
-        task = task_mod.get_task(task_name)
-        task['family'] = '_' + task['family']
-        env = env_to_dict(task_mod.get_container_definition(app_task, ctx['app'])['environment'])
-        ctr_def = task_mod.get_container_definition(task, task_name)
-        env.update(env_to_dict(ctr_def['environment']))
-        env['TASK_NAME'] = f'{ctx["app"]}.{task_name}'
-        ctr_def['environment'] = dict_to_env(env)
-        task['containerDefinitions'] = [ctr_def]
-        ecs_cli = self.get_boto_client('ecs')
-        skip = set(IGNORED_TASK_KWARGS)
-        task = ecs_cli.register_task_definition(**{
-            k: v for k, v in task.items() if k not in skip
-        })['taskDefinition']
+        if app_task is None:
+            app_task = task_mod.get_task(None)
+        task = self.make_service_task(task_name, app_task, ctx=ctx)
+        if limiter:
+            task = throttled(limiter, task_mod.register_task, task)['taskDefinition']
+        else:
+            task = task_mod.register_task(task)['taskDefinition']
         # TODO: Deregister previous task definitions.
         kwargs = {
             'cluster': cluster,
@@ -505,7 +494,90 @@ class EcsService(Service):
         }
         if replicas:
             kwargs['desiredCount'] = int(replicas) if replicas is not None else 1
-        ecs_cli.update_service(**kwargs)
+        ecs_cli = self.get_boto_client('ecs')
+        if limiter:
+            throttled(limiter, ecs_cli.update_service, **kwargs)
+        else:
+            ecs_cli.update_service(**kwargs)
+
+    def make_service_task(self, task_name, app_task, ctx=None):
+        """ Build a service's task definition from its task, with the
+        app's environment underneath its own.
+        """
+        if ctx is None:
+            ctx = self.get_context()
+        task_mod = self.client.get_module('task')
+        task = task_mod.get_task(task_name)
+        task['family'] = '_' + task['family']
+        env = env_to_dict(task_mod.get_container_definition(app_task, ctx['app'])['environment'])
+        ctr_def = task_mod.get_container_definition(task, task_name)
+        env.update(env_to_dict(ctr_def['environment']))
+        env['TASK_NAME'] = f'{ctx["app"]}.{task_name}'
+        ctr_def['environment'] = dict_to_env(env)
+        task['containerDefinitions'] = [ctr_def]
+        return task
+
+    def handle_redeploy(self, args):
+        self.redeploy(args.tasks, wait=args.wait, workers=args.workers, rate=args.rate, prewarm=args.prewarm)
+
+    def redeploy(self, task_names, wait=False, workers=8, rate=5, prewarm=False):
+        """ Register new definitions for many services and update them
+        concurrently. The app's base task is only fetched once.
+        """
+        if not task_names:
+            task_names = list(self.iter_services())
+        task_mod = self.client.get_module('task')
+        app_task = task_mod.get_task(None)
+        limiter = RateLimiter(rate)
+        prewarm_time = self.prewarm(task_names) if prewarm else None
+        start = time.monotonic()
+
+        def redeploy_one(task_name):
+            self.update(task_name, app_task=app_task, limiter=limiter)
+
+        failed = []
+        for task_name, _, error in imap_concurrent(redeploy_one, task_names, workers):
+            if error:
+                failed.append(task_name)
+                # Errors raised through `error` have already been printed.
+                reason = f': {error}' if str(error) else ''
+                print(f'{task_name} [FAILED{reason}]')
+            else:
+                print(f'{task_name} [UPDATED]')
+        if failed:
+            self.error(f'failed to redeploy: {", ".join(sorted(failed))}', status=1)
+        if wait:
+            self.wait(task_names, True)
+            self.record_rollout(len(task_names), time.monotonic() - start, prewarm_time)
+
+    def prewarm(self, task_names):
+        """ Pull the images used by some services onto every node.
+        """
+        task_mod = self.client.get_module('task')
+        uris = set()
+        for name in task_names:
+            uris.update(ctr['image'] for ctr in task_mod.get_task(name)['containerDefinitions'])
+        return self.get_module('image').prewarm(uris)
+
+    def record_rollout(self, count, rollout_time, prewarm_time=None):
+        """ Keep a short history of rollout times so prewarmed rollouts can
+        be compared against cold ones.
+        """
+        history = self.store.setdefault('rollouts', [])
+        history.append({
+            'services': count,
+            'rollout': round(rollout_time, 1),
+            'prewarm': round(prewarm_time, 1) if prewarm_time is not None else None,
+        })
+        del history[:-ROLLOUT_HISTORY]
+        msg = f'rolled out {count} services in {rollout_time:.1f}s'
+        if prewarm_time is not None:
+            msg += f' after {prewarm_time:.1f}s prewarming'
+        print(msg)
+        for label, warm in (('prewarmed', True), ('cold', False)):
+            times = [h['rollout'] for h in history if (h['prewarm'] is not None) == warm]
+            if times:
+                print(f'  {label}: {sum(times) / len(times):.1f}s average over {len(times)} rollouts')
 
     def handle_scale(self, args):
         self.scale(args.task, args.replicas)
@@ -514,10 +586,10 @@ class EcsService(Service):
         ctx = self.get_context()
         cluster = f'fuku-{ctx["cluster"]}'
         family = f'_fuku-{ctx["cluster"]}-{ctx["app"]}-{task_name}'
+        task = self.get_module('task').describe_task(family)
+        if task is None:
+            self.error(f'no service task "{task_name}"')
         ecs_cli = self.get_boto_client('ecs')
-        task = ecs_cli.describe_task_definition(
-            taskDefinition=family
-        )['taskDefinition']
         ecs_cli.update_service(
             cluster=cluster,
             service=f'fuku-{ctx["app"]}-{task_name}',
@@ -526,21 +598,27 @@ class EcsService(Service):
         )
 
     def handle_wait(self, args):
-        self.wait(args.tasks, args.stable)
+        self.wait(args.tasks, args.stable, args.timeout)
 
-    def wait(self, task_names, stable):
+    def wait(self, task_names, stable=True, timeout=1800):
         if not task_names:
             task_names = list(self.iter_services())
         ecs = self.get_boto_client('ecs')
         ctx = self.get_context()
-        waiter = ecs.get_waiter('services_stable')
-        waiter.wait(
-            cluster=f'fuku-{ctx["cluster"]}',
-            services=[
-                f'fuku-{ctx["app"]}-{n}'
-                for n in task_names
-            ]
+        waiter = ServiceWaiter(
+            ecs,
+            f'fuku-{ctx["cluster"]}',
+            [f'fuku-{ctx["app"]}-{n}' for n in task_names],
+            stable=stable,
+            timeout=timeout
         )
+        try:
+            results = waiter.wait()
+        except WaitTimeout as e:
+            self.error(str(e), status=1)
+        failed = sorted(name for name, result in results.items() if result != 'SETTLED')
+        if failed:
+            self.error(f'failed to deploy: {", ".join(failed)}', status=1)
 
     def remove(self, task_name):
         self.confirm_remove(task_name)
@@ -560,7 +638,7 @@ class EcsService(Service):
         )
 
     def iter_services(self, task_name=None, app_name=None):
-        ecs_cli = self.get_boto_client('ecs')
+        ecs_cli = self.get_boto_client('ecs', cache=True)
         paginator = ecs_cli.get_paginator('list_services')
         ctx = self.get_context()
         cluster = f'fuku-{ctx["cluster"]}'
@@ -573,6 +651,32 @@ class EcsService(Service):
                 if app == app_name:
                     yield name
 
+    def iter_service_arns(self):
+        ctx = self.get_context(use_context=False)
+        ecs_cli = self.get_boto_client('ecs', cache=True)
+        paginator = ecs_cli.get_paginator('list_services')
+        for page in paginator.paginate(cluster=f'fuku-{ctx["cluster"]}'):
+            for arn in page['serviceArns']:
+                yield arn
+
+    def iter_service_descriptions(self, services, workers=8):
+        """ Describe services in batches of ten on a pool of threads,
+        yielding each batch as it arrives.
+        """
+        ctx = self.get_context(use_context=False)
+        ecs_cli = self.get_boto_client('ecs')
+
+        def describe(batch):
+            return ecs_cli.describe_services(
+                cluster=f'fuku-{ctx["cluster"]}',
+                services=batch
+            )['services']
+
+        for batch, data, error in imap_concurrent(describe, chunks(services, 10), workers):
+            if error:
+                raise error
+            yield data
+
     def is_running(self, task_name):
         ecs_cli = self.get_boto_client('ecs')
         ctx = self.get_context()
@@ -26,7 +26,7 @@ class Session(Module):
 
     def handle_save(self, args):
         cache = {}
-        for mod in self.client.modules:
+        for mod in self.client.iter_stored_modules():
             if mod.name == 'session':
                 continue
             cache[mod.name] = mod.save()
@@ -37,7 +37,7 @@ class Session(Module):
             print(f'Session {args.name} not found')
 
         cache = self.store.get(args.name, {})
-        for mod in self.client.modules:
+        for mod in self.client.iter_stored_modules(cache):
             if mod.name == 'session':
                 continue
             mod.load(cache.get(mod.name, {}))
@@ -47,7 +47,7 @@ class Session(Module):
             print(name)
 
     def handle_show(self, args):
-        for mod in self.client.modules:
+        for mod in self.client.iter_stored_modules():
             cache = mod.save()
             if cache and mod.name not in {'session'}:
                 print('{}:'.format(mod.name))
@@ -0,0 +1,109 @@
+import os
+import shlex
+import subprocess
+import threading
+
+from .db import get_rc_path
+
+CONTROL_PERSIST = '10m'
+USER = 'ec2-user'
+
+_added_keys = set()
+_masters = {}
+_lock = threading.Lock()
+
+
+def get_control_path():
+    path = os.path.join(get_rc_path(), 'ssh')
+    try:
+        os.makedirs(path, mode=0o700)
+    except OSError:
+        pass
+    # OpenSSH expands %C to a hash of the connection, keeping paths short.
+    return os.path.join(path, '%C')
+
+
+def add_key(pem):
+    """ Add a key to the SSH agent, once per process.
+    """
+    with _lock:
+        if pem in _added_keys:
+            return
+        subprocess.run(['ssh-add', pem], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _added_keys.add(pem)
+
+
+def get_options(persist=False):
+    opts = [
+        '-o', 'StrictHostKeyChecking=no',
+        '-o', 'LogLevel=QUIET',
+        '-o', 'ControlMaster=auto',
+        '-o', f'ControlPath={get_control_path()}',
+    ]
+    if persist:
+        opts += ['-o', f'ControlPersist={CONTROL_PERSIST}']
+    return opts
+
+
+def open_master(host, bastion=None, timeout=None):
+    """ Start a persistent master connection to `host`, and to `bastion`
+    first when hopping through one, once per process. Masters outlive the
+    command that starts them, so they're started here with their standard
+    streams on /dev/null rather than holding open the pipes of a command
+    whose output is being captured. `timeout` bounds each connection
+    attempt.
+    """
+    with _lock:
+        state = _masters.setdefault((host, bastion), {'lock': threading.Lock(), 'open': False})
+    with state['lock']:
+        if state['open']:
+            return
+        if bastion:
+            open_master(bastion, timeout=timeout)
+        target = [f'{USER}@{host}']
+        check = ['ssh'] + get_options() + ['-O', 'check'] + target
+        devnull = {
+            'stdin': subprocess.DEVNULL,
+            'stdout': subprocess.DEVNULL,
+            'stderr': subprocess.DEVNULL,
+        }
+        if subprocess.run(check, **devnull).returncode != 0:
+            args = ['ssh'] + get_options(persist=True) + proxy_options(bastion) + ['-f', '-N'] + target
+            # Failing to start a master only loses the reuse, each command
+            # still connects on its own.
+            try:
+                subprocess.run(args, timeout=timeout, **devnull)
+            except subprocess.TimeoutExpired:
+                pass
+        state['open'] = True
+
+
+def proxy_options(bastion):
+    if not bastion:
+        return []
+    # Tokens in ProxyCommand are expanded by the outer ssh, so escape
+    # the bastion's control path and leave only its %h:%p target.
+    proxy = ['ssh'] + get_options() + ['-W', '%h:%p', f'{USER}@{bastion}']
+    proxy = ' '.join(shlex.quote(a) for a in proxy).replace('%C', '%%C')
+    return ['-o', f'ProxyCommand={proxy}']
+
+
+def ssh_args(host, cmd='', bastion=None, tty=False):
+    """ Build an SSH command line for running `cmd` on `host`, hopping
+    through `bastion` when given. Connections to both the bastion and the
+    host are multiplexed over any master opened by `open_master`, so after
+    the first command each one reuses an open session instead of
+    handshaking again.
+    """
+    args = ['ssh'] + get_options() + ['-A']
+    if tty:
+        args.append('-t')
+    args += proxy_options(bastion)
+    args.append(f'{USER}@{host}')
+    if cmd:
+        args.append(cmd)
+    return args
+
+
+def ssh_command(host, cmd='', bastion=None, tty=False):
+    return ' '.join(shlex.quote(a) for a in ssh_args(host, cmd, bastion, tty))
@@ -1,9 +1,11 @@
+import copy
 import json
 import time
+from contextlib import contextmanager
 
-import botocore
-
+from .cache import get_cache
 from .module import Module
+from .parallel import RateLimiter, imap_concurrent, throttled
 from .utils import (
     StoreKeyValuePair,
     StorePortPair,
@@ -13,6 +15,7 @@ from .utils import (
     dict_to_volumes,
     env_to_dict,
     mounts_to_dict,
+    parse_duration,
     ports_to_dict,
     volumes_to_dict,
 )
@@ -25,12 +28,18 @@ IGNORED_TASK_KWARGS = [
     'compatibilities',
 ]
 
+# Task definition revisions never change once registered, so their content
+# is cached indefinitely. Only the pointer from a family to its latest
+# revision expires.
+LATEST_REVISION_TTL = 30
+
 
 class Task(Module):
     dependencies = ['app']
 
     def __init__(self, **kwargs):
         super().__init__('task', **kwargs)
+        self._edits = {}
 
     def add_arguments(self, parser):
         subp = parser.add_subparsers(help='task help')
@@ -53,6 +62,20 @@ class Task(Module):
         p.add_argument('--memory', '-m', help='memory reservation (MiB)')
         p.set_defaults(task_handler=self.handle_update)
 
+        p = subp.add_parser('edit', help='apply several changes as a single revision')
+        p.add_argument('name', metavar='NAME', help='task name')
+        p.add_argument('--image', '-i', metavar='IMAGE', help='image name')
+        p.add_argument('--cpu', '-c', help='cpu reservation')
+        p.add_argument('--memory', '-m', help='memory reservation (MiB)')
+        p.add_argument('--env', '-e', metavar='KEY=VALUE', action='append', default=[], help='set environment variable')
+        p.add_argument('--unset-env', metavar='KEY', action='append', default=[], help='remove environment variable')
+        p.add_argument('--port', '-p', metavar='HOST:CONTAINER', action='append', default=[], help='set port mapping')
+        p.add_argument('--unset-port', metavar='PORT', action='append', default=[], help='remove port mapping')
+        p.add_argument('--volume', '-v', metavar='VOLUME:DEST[:SOURCE]', action='append', default=[], help='add volume')
+        p.add_argument('--remove-volume', metavar='VOLUME', action='append', default=[], help='remove volume')
+        p.add_argument('--command', metavar='COMMAND', help='command to run')
+        p.set_defaults(task_handler=self.handle_edit)
+
         p = subp.add_parser('rm', help='remove a task')
         p.add_argument('--name', default='', metavar='NAME', help='task name')
         p.set_defaults(task_handler=self.handle_remove)
@@ -107,6 +130,13 @@ class Task(Module):
         p.set_defaults(task_handler=self.handle_logs)
 
         p = subp.add_parser('prune', help='remove unused task definitions')
+        p.add_argument('names', metavar='NAME', nargs='*', help='task names (default: all)')
+        p.add_argument('--keep', '-k', type=int, default=1, help='number of latest revisions to keep')
+        p.add_argument('--younger-than', '-y', metavar='AGE', type=parse_duration,
+                       help='keep revisions registered within AGE, e.g. 12h or 30d')
+        p.add_argument('--dry-run', '-n', action='store_true', help='only report what would be removed')
+        p.add_argument('--workers', '-w', type=int, default=8, help='concurrent requests')
+        p.add_argument('--rate', '-r', type=float, default=5, help='maximum requests per second')
         p.set_defaults(task_handler=self.handle_prune)
 
     def handle_list(self, args):
@@ -173,58 +203,101 @@ class Task(Module):
 
     def deregister_from_prefix(self, familyPrefix):
         '''
-            Deregisters a given task definiton ARN.
-            If it fails due to ThrottlingException, wait 10 seconds and retry.
+            Deregisters all task definitions with a family prefix.
         '''
-        ecs_cli = self.get_boto_client('ecs')
+        arns = list(self.iter_task_definition_arns(familyPrefix))
+        self.deregister_task_definitions(arns)
 
+    def iter_task_definition_arns(self, family_prefix, exact=False, sort='ASC'):
+        ecs_cli = self.get_boto_client('ecs')
         paginator = ecs_cli.get_paginator('list_task_definitions')
-        task_defs = paginator.paginate(familyPrefix=familyPrefix)
-        for results in task_defs:
-            for arn in results['taskDefinitionArns']:
-                while True:
-                    try:
-                        ecs_cli.deregister_task_definition(taskDefinition=arn)
-                        print(f'{arn} [DELETED]')
-                    except botocore.exceptions.ClientError as error:
-                        if error.response['Error']['Code'] != 'ThrottlingException':
-                            raise error
-                        print('Throttled.. waiting..')
-                        time.sleep(10)
-                    else:
-                        break
+        pages = paginator.paginate(familyPrefix=family_prefix, sort=sort)
+        for page in pages:
+            for arn in page['taskDefinitionArns']:
+                if exact and arn[arn.rfind('/') + 1:arn.rfind(':')] != family_prefix:
+                    continue
+                yield arn
+
+    def deregister_task_definitions(self, arns, workers=8, rate=5, limiter=None):
+        ecs_cli = self.get_boto_client('ecs')
+        if limiter is None:
+            limiter = RateLimiter(rate)
 
-    def handle_update(self, args):
-        self.update(args.name, args.image, args.cpu, args.memory)
+        def deregister(arn):
+            throttled(limiter, ecs_cli.deregister_task_definition, taskDefinition=arn)
 
-    def update(self, name, image_name=None, cpu=None, memory=None):
-        ctx = self.get_context()
-        task = self.get_task(name, ctx=ctx)
-        ctr_def = self.get_container_definition(task, name)
+        failed = 0
+        for arn, _, error in imap_concurrent(deregister, arns, workers):
+            if error:
+                failed += 1
+                print(f'{arn} [FAILED: {error}]')
+            else:
+                print(f'{arn} [DELETED]')
 
-        if image_name:
-            img_uri = self.client.get_module('image').image_name_to_uri(image_name)
-            ctr_def['image'] = img_uri
+        # The latest revision may have gone, so stop trusting the pointers.
+        cache = get_cache()
+        namespace = self.get_task_namespace()
+        for family in {arn[arn.rfind('/') + 1:arn.rfind(':')] for arn in arns}:
+            cache.invalidate(namespace, family)
 
-        if cpu is not None:
-            ctr_def['cpu'] = int(cpu)
+        if failed:
+            self.error(f'failed to remove {failed} of {len(arns)} task definitions')
+
+    def handle_update(self, args):
+        self.update(args.name, args.image, args.cpu, args.memory)
 
-        if memory is not None:
-            ctr_def['memory'] = int(memory)
-            ctr_def['memoryReservation'] = int(memory)
+    def update(self, name, image_name=None, cpu=None, memory=None):
+        with self.editing(name) as task:
+            ctr_def = self.get_container_definition(task, name)
 
-        response = self.register_task(task)
+            if image_name:
+                img_uri = self.client.get_module('image').image_name_to_uri(image_name)
+                ctr_def['image'] = img_uri
 
-        # checks that the desired updates went through
-        containerDef = response['taskDefinition']['containerDefinitions'][0]
-        if image_name:
-            assert containerDef['image'].endswith(image_name)
+            if cpu is not None:
+                ctr_def['cpu'] = int(cpu)
 
-        if cpu is not None:
-            assert containerDef['cpu'] == cpu
+            if memory is not None:
+                ctr_def['memory'] = int(memory)
+                ctr_def['memoryReservation'] = int(memory)
 
-        if memory is not None:
-            assert containerDef['memory'] == memory
+    def handle_edit(self, args):
+        name = args.name
+        # Check everything before anything is changed.
+        for env in args.env:
+            if '=' not in env:
+                self.error(f'invalid environment variable "{env}", expected KEY=VALUE')
+        for port in args.port:
+            try:
+                host, container = port.split(':', 1)
+                int(host), int(container)
+            except ValueError:
+                self.error(f'invalid port mapping "{port}", expected HOST:CONTAINER')
+        for port in args.unset_port:
+            try:
+                int(port)
+            except ValueError:
+                self.error(f'invalid port "{port}"')
+        with self.editing(name):
+            if args.image or args.cpu is not None or args.memory is not None:
+                self.update(name, args.image, args.cpu, args.memory)
+            if args.env:
+                self.env_set(name, values=dict(e.split('=', 1) for e in args.env))
+            if args.unset_env:
+                self.env_unset(name, args.unset_env)
+            if args.port:
+                self.ports_set(name, dict(p.split(':', 1) for p in args.port))
+            if args.unset_port:
+                self.ports_unset(name, args.unset_port)
+            for vol in args.volume:
+                parts = vol.split(':')
+                if len(parts) not in (2, 3):
+                    self.error(f'invalid volume "{vol}"')
+                self.volume_add(name, parts[0], parts[1], parts[2] if len(parts) == 3 else None)
+            for vol in args.remove_volume:
+                self.volume_remove(name, vol)
+            if args.command:
+                self.command(name, args.command)
 
     def handle_env_list(self, args):
         self.env_list(args.name)
@@ -251,30 +324,28 @@ class Task(Module):
                     k = line[:ii]
                     v = line[ii + 1:]
                     to_set[k] = v
-        to_set.update(values)
-        task = self.get_task(name)
-        ctr_def = self.get_container_definition(task, name)
-        env = env_to_dict(ctr_def['environment'])
-        env.update(to_set)
-        env = dict_to_env(env)
-        ctr_def['environment'] = env
-        self.register_task(task)
+        to_set.update(values or {})
+        with self.editing(name) as task:
+            ctr_def = self.get_container_definition(task, name)
+            env = env_to_dict(ctr_def['environment'])
+            env.update(to_set)
+            env = dict_to_env(env)
+            ctr_def['environment'] = env
 
     def handle_env_unset(self, args):
         self.env_unset(args.name, args.values)
 
     def env_unset(self, name, keys):
-        task = self.get_task(name)
-        ctr_def = self.get_container_definition(task, name)
-        env = env_to_dict(ctr_def['environment'])
-        for k in keys:
-            try:
-                del env[k]
-            except KeyError:
-                pass
-        env = dict_to_env(env)
-        ctr_def['environment'] = env
-        self.register_task(task)
+        with self.editing(name) as task:
+            ctr_def = self.get_container_definition(task, name)
+            env = env_to_dict(ctr_def['environment'])
+            for k in keys:
+                try:
+                    del env[k]
+                except KeyError:
+                    pass
+            env = dict_to_env(env)
+            ctr_def['environment'] = env
 
     def handle_ports_list(self, args):
         self.ports_list(args.name)
@@ -290,137 +361,157 @@ class Task(Module):
         self.ports_set(args.name, args.values)
 
     def ports_set(self, name, values):
-        task = self.get_task(name)
-        ctr_def = self.get_container_definition(task, name)
-        ports = ports_to_dict(ctr_def['portMappings'])
-        for k, v in values.items():
-            ports[int(k)] = int(v)
-        ports = dict_to_ports(ports)
-        ctr_def['portMappings'] = ports
-        self.register_task(task)
+        with self.editing(name) as task:
+            ctr_def = self.get_container_definition(task, name)
+            ports = ports_to_dict(ctr_def['portMappings'])
+            for k, v in values.items():
+                ports[int(k)] = int(v)
+            ports = dict_to_ports(ports)
+            ctr_def['portMappings'] = ports
 
     def handle_ports_unset(self, args):
         self.ports_unset(args.name, args.values)
 
     def ports_unset(self, name, values):
-        app_task = self.get_app_task()
-        ctr_def = self.get_container_definition(app_task, name)
-        ports = ports_to_dict(ctr_def['portMappings'])
-        for p in values:
-            try:
-                del ports[int(p)]
-            except KeyError:
-                pass
-        ports = dict_to_ports(ports)
-        ctr_def['portMappings'] = ports
-        self.register_task(app_task)
+        with self.editing(name) as task:
+            ctr_def = self.get_container_definition(task, name)
+            ports = ports_to_dict(ctr_def['portMappings'])
+            for p in values:
+                try:
+                    del ports[int(p)]
+                except KeyError:
+                    pass
+            ports = dict_to_ports(ports)
+            ctr_def['portMappings'] = ports
 
     def handle_volume_add(self, args):
         self.volume_add(args.name, args.volume, args.destination, args.source)
 
     def volume_add(self, task_name, vol_name, dst, src=None, read_only=False):
-        task = self.get_task(task_name)
-        ctr_def = self.get_container_definition(task, task_name)
-        volumes = volumes_to_dict(task['volumes'])
-        volumes[vol_name] = src
-        task['volumes'] = dict_to_volumes(volumes)
-        mounts = mounts_to_dict(ctr_def['mountPoints'])
-        mounts[vol_name] = {
-            'containerPath': dst,
-            'readOnly': read_only
-        }
-        ctr_def['mountPoints'] = dict_to_mounts(mounts)
-        self.register_task(task)
+        with self.editing(task_name) as task:
+            ctr_def = self.get_container_definition(task, task_name)
+            volumes = volumes_to_dict(task['volumes'])
+            volumes[vol_name] = src
+            task['volumes'] = dict_to_volumes(volumes)
+            mounts = mounts_to_dict(ctr_def['mountPoints'])
+            mounts[vol_name] = {
+                'containerPath': dst,
+                'readOnly': read_only
+            }
+            ctr_def['mountPoints'] = dict_to_mounts(mounts)
 
     def handle_volume_remove(self, args):
         self.volume_remove(args.name, args.volume)
 
     def volume_remove(self, ctr_name, vol_name):
-        app_task = self.get_app_task()
-        ctr_def = self.get_container_definition(app_task, ctr_name)
-        volumes = volumes_to_dict(app_task['volumes'])
-        try:
-            del volumes[vol_name]
-        except KeyError:
-            pass
-        app_task['volumes'] = dict_to_volumes(volumes)
-        mounts = mounts_to_dict(ctr_def['mountPoints'])
-        try:
-            del mounts[vol_name]
-        except KeyError:
-            pass
-        ctr_def['mountPoints'] = dict_to_mounts(mounts)
-        self.register_task(app_task)
+        with self.editing(ctr_name) as task:
+            ctr_def = self.get_container_definition(task, ctr_name)
+            volumes = volumes_to_dict(task['volumes'])
+            try:
+                del volumes[vol_name]
+            except KeyError:
+                pass
+            task['volumes'] = dict_to_volumes(volumes)
+            mounts = mounts_to_dict(ctr_def['mountPoints'])
+            try:
+                del mounts[vol_name]
+            except KeyError:
+                pass
+            ctr_def['mountPoints'] = dict_to_mounts(mounts)
 
     def handle_command(self, args):
         self.command(args.name, args.command, args.remove)
 
     def command(self, name, cmd, remove=False):
-        task = self.get_task(name)
-        ctr_def = self.get_container_definition(task, name)
-        if remove:
-            try:
-                del ctr_def['command']
-            except KeyError:
-                pass
-        else:
-            ctr_def['command'] = cmd.split()
-        self.register_task(task)
+        with self.editing(name) as task:
+            ctr_def = self.get_container_definition(task, name)
+            if remove:
+                try:
+                    del ctr_def['command']
+                except KeyError:
+                    pass
+            else:
+                ctr_def['command'] = cmd.split()
 
     def handle_logs(self, args):
         self.logs(args.name, args.driver, args.options)
 
     def logs(self, name, driver, options):
         ctx = self.get_context()
-        task = self.get_task(name, ctx=ctx)
-        ctr_def = self.get_container_definition(task, name)
-        if driver == 'aws':
-            ctr_def['logConfiguration'] = {
-                'logDriver': 'awslogs',
-                'options': {
-                    'awslogs-group': f'/{ctx["cluster"]}',
-                    'awslogs-region': ctx['region'],
-                    'awslogs-stream-prefix': ctx['app']
+        with self.editing(name) as task:
+            ctr_def = self.get_container_definition(task, name)
+            if driver == 'aws':
+                ctr_def['logConfiguration'] = {
+                    'logDriver': 'awslogs',
+                    'options': {
+                        'awslogs-group': f'/{ctx["cluster"]}',
+                        'awslogs-region': ctx['region'],
+                        'awslogs-stream-prefix': ctx['app']
+                    }
                 }
-            }
-        elif driver == 'syslog':
-            opts = {
-                'tag': '{{ (.ExtraAttributes nil).TASK_NAME }}/{{ .ID }}',
-                'env': 'TASK_NAME'
-            }
-            opts.update(options)
-            ctr_def['logConfiguration'] = {
-                'logDriver': 'syslog',
-                'options': opts
-            }
-        elif driver == 'none':
-            try:
-                del ctr_def['logConfiguration']
-            except KeyError:
-                pass
-        self.register_task(task)
+            elif driver == 'syslog':
+                opts = {
+                    'tag': '{{ (.ExtraAttributes nil).TASK_NAME }}/{{ .ID }}',
+                    'env': 'TASK_NAME'
+                }
+                opts.update(options)
+                ctr_def['logConfiguration'] = {
+                    'logDriver': 'syslog',
+                    'options': opts
+                }
+            elif driver == 'none':
+                try:
+                    del ctr_def['logConfiguration']
+                except KeyError:
+                    pass
 
     def handle_prune(self, args):
-        self.prune()
+        self.prune(args.names, args.keep, args.younger_than, args.dry_run, args.workers, args.rate)
 
-    def prune(self):
+    def prune(self, names=None, keep=1, younger_than=None, dry_run=False, workers=8, rate=5):
+        ctx = self.get_context()
         ecs_cli = self.get_boto_client('ecs')
-        for fam in self.iter_task_families():
+        limiter = RateLimiter(rate)
+        if names:
+            families = [self.get_task_family(n, ctx=ctx) for n in names]
+        else:
+            families = list(self.iter_task_families())
+
+        # Never remove anything a service is still deploying.
+        svc_mod = self.get_module('service')
+        in_use = set()
+        for services in svc_mod.iter_service_descriptions(list(svc_mod.iter_service_arns()), workers):
+            for svc in services:
+                in_use.update(dep['taskDefinition'] for dep in svc['deployments'])
+
+        candidates = []
+        for fam in families:
             for prefix in ['', '_']:
-                paginator = ecs_cli.get_paginator('list_task_definitions')
-                response = paginator.paginate(
-                    familyPrefix=prefix + fam,
-                    sort='DESC'
-                )
-                first = True
-                for results in response:
-                    for arn in results['taskDefinitionArns']:
-                        if not first:
-                            ecs_cli.deregister_task_definition(
-                                taskDefinition=arn
-                            )
-                        else:
-                            first = False
+                arns = list(self.iter_task_definition_arns(prefix + fam, exact=True, sort='DESC'))
+                candidates.extend(arn for arn in arns[keep:] if arn not in in_use)
+
+        if younger_than is not None:
+            cutoff = time.time() - younger_than
+
+            def registered_at(arn):
+                return throttled(
+                    limiter, ecs_cli.describe_task_definition, taskDefinition=arn
+                )['taskDefinition'].get('registeredAt')
+
+            old = set()
+            for arn, when, error in imap_concurrent(registered_at, candidates, workers):
+                if error:
+                    raise error
+                if when is None or when.timestamp() < cutoff:
+                    old.add(arn)
+            candidates = [arn for arn in candidates if arn in old]
+
+        if dry_run:
+            for arn in candidates:
+                print(f'{arn} [WOULD DELETE]')
+            print(f'{len(candidates)} task definitions would be removed')
+            return
+        self.deregister_task_definitions(candidates, workers=workers, limiter=limiter)
 
     def get_task_family(self, name, ctx=None):
         if ctx is None:
@@ -430,18 +521,42 @@ class Task(Module):
 
     def get_task(self, name, ctx=None, fail=True):
         family = self.get_task_family(name, ctx)
+        task = self.describe_task(family)
+        if task is None and fail:
+            self.error(f'no task "{name}"')
+        return task
+
+    def describe_task(self, family):
+        cache = get_cache()
+        namespace = self.get_task_namespace()
+        revision = cache.get(namespace, family)
+        if revision is not None:
+            task = cache.get(namespace, f'{family}:{revision}')
+            if task is not None:
+                return task
         ecs = self.get_boto_client('ecs')
         try:
-            return ecs.describe_task_definition(
+            task = ecs.describe_task_definition(
                 taskDefinition=family
             )['taskDefinition']
         except Exception:
-            if fail:
-                self.error(f'no task "{name}"')
+            return None
+        self.cache_task(task)
+        return task
+
+    def cache_task(self, task):
+        cache = get_cache()
+        namespace = self.get_task_namespace()
+        cache.set(namespace, f'{task["family"]}:{task["revision"]}', task)
+        cache.set(namespace, task['family'], task['revision'], LATEST_REVISION_TTL)
+
+    def get_task_namespace(self):
+        ctx = self.get_context(use_context=False)
+        return f'taskdef:{ctx.get("profile")}:{ctx.get("region")}'
 
     def iter_task_families(self, name=None):
         ctx = self.get_context()
-        ecs_cli = self.get_boto_client('ecs')
+        ecs_cli = self.get_boto_client('ecs', cache=True)
         paginator = ecs_cli.get_paginator('list_task_definition_families')
         prefix = f'fuku-{ctx["cluster"]}-{ctx["app"]}'
         tasks = paginator.paginate(
@@ -453,12 +568,34 @@ class Task(Module):
                 if f != prefix:
                     yield f
 
+    @contextmanager
+    def editing(self, name):
+        """ Collect changes to a task definition, registering a single new
+        revision once the outermost edit finishes, and only if something
+        actually changed.
+        """
+        if name in self._edits:
+            yield self._edits[name]
+            return
+        task = self.get_task(name)
+        original = copy.deepcopy(task)
+        self._edits[name] = task
+        try:
+            yield task
+        finally:
+            del self._edits[name]
+        if task != original:
+            self.register_task(task)
+        else:
+            self.get_logger().info(f'task "{name}" unchanged')
+
     def register_task(self, task):
         ecs = self.get_boto_client('ecs')
         skip = set(IGNORED_TASK_KWARGS)
         response = ecs.register_task_definition(**{
             k: v for k, v in task.items() if k not in skip
         })
+        self.cache_task(response['taskDefinition'])
         return response
 
     def get_container_definition(self, task, name, fail=True):
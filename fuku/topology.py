@@ -0,0 +1,91 @@
+from collections import defaultdict
+
+from .parallel import chunks, imap_concurrent
+
+DESCRIBE_BATCH = 100
+
+
+def task_family(task):
+    arn = task['taskDefinitionArn']
+    return arn[arn.rfind('/') + 1:arn.rfind(':')]
+
+
+class Topology(object):
+    """ Snapshot of which container instances run on which EC2 instances,
+    and which tasks are running on each. Container instances and tasks are
+    described in batches of 100, so building the index costs a handful of
+    calls regardless of cluster size.
+    """
+
+    def __init__(self, ecs_cli, cluster, workers=4):
+        self.ecs_cli = ecs_cli
+        self.cluster = cluster
+        self.workers = workers
+        self.container_instances = {}
+        self.arn_by_ec2_id = {}
+        self.tasks_by_arn = defaultdict(list)
+        self.tasks_by_family = defaultdict(list)
+        self.build()
+
+    def build(self):
+        arns = self.list('list_container_instances', 'containerInstanceArns')
+        for ci in self.describe('describe_container_instances', 'containerInstances', arns):
+            self.container_instances[ci['containerInstanceArn']] = ci
+            self.arn_by_ec2_id[ci['ec2InstanceId']] = ci['containerInstanceArn']
+        arns = self.list('list_tasks', 'taskArns', desiredStatus='RUNNING')
+        for task in self.describe('describe_tasks', 'tasks', arns):
+            self.tasks_by_arn[task.get('containerInstanceArn')].append(task)
+            self.tasks_by_family[task_family(task)].append(task)
+
+    def list(self, operation, key, **kwargs):
+        paginator = self.ecs_cli.get_paginator(operation)
+        return [
+            arn
+            for page in paginator.paginate(cluster=self.cluster, **kwargs)
+            for arn in page[key]
+        ]
+
+    def describe(self, operation, key, arns):
+        def describe_batch(batch):
+            return getattr(self.ecs_cli, operation)(
+                cluster=self.cluster,
+                **{key: batch}
+            )[key]
+
+        results = []
+        for _, data, error in imap_concurrent(describe_batch, chunks(arns, DESCRIBE_BATCH), self.workers):
+            if error:
+                raise error
+            results.extend(data)
+        return results
+
+    def get_instance_arn(self, ec2_id):
+        return self.arn_by_ec2_id.get(ec2_id)
+
+    def get_ec2_id(self, instance_arn):
+        try:
+            return self.container_instances[instance_arn]['ec2InstanceId']
+        except KeyError:
+            return None
+
+    def iter_tasks(self, family=None, ec2_id=None):
+        if ec2_id is not None:
+            tasks = self.tasks_by_arn.get(self.get_instance_arn(ec2_id), [])
+        elif family is not None:
+            tasks = self.tasks_by_family.get(family, [])
+        else:
+            tasks = [t for ts in self.tasks_by_arn.values() for t in ts]
+        for task in tasks:
+            if family is None or task_family(task) == family:
+                yield task
+
+    def iter_task_ec2_ids(self, family):
+        """ EC2 instance IDs hosting running tasks of a family, in the order
+        the tasks were described, without repeats.
+        """
+        seen = set()
+        for task in self.iter_tasks(family):
+            ec2_id = self.get_ec2_id(task.get('containerInstanceArn'))
+            if ec2_id and ec2_id not in seen:
+                seen.add(ec2_id)
+                yield ec2_id
@@ -1,11 +1,10 @@
 import argparse
 import random
+import re
 import string
 from contextlib import contextmanager
 from datetime import datetime
 
-import botocore
-
 
 class EntityAlreadyExists(Exception):
     pass
@@ -124,6 +123,16 @@ def mounts_to_string(val, existing={}, opt='--mount'):
         return ''
 
 
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_duration(value):
+    m = re.fullmatch(r'(\d+(?:\.\d+)?)([smhdw]?)', value.strip())
+    if not m:
+        raise ValueError(f'invalid duration "{value}"')
+    return float(m.group(1)) * DURATION_UNITS[m.group(2) or 's']
+
+
 def gen_secret(length=64):
     return ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(length))
 
@@ -137,9 +146,10 @@ def gen_name(length=16):
 
 @contextmanager
 def entity_already_exists(hide=True):
+    from botocore.exceptions import ClientError
     try:
         yield
-    except botocore.exceptions.ClientError as e:
+    except ClientError as e:
         if e.response['Error']['Code'] not in [
                 'EntityAlreadyExists',
                 'InvalidKeyPair.Duplicate',
@@ -155,9 +165,10 @@ def entity_already_exists(hide=True):
 
 @contextmanager
 def limit_exceeded():
+    from botocore.exceptions import ClientError
     try:
         yield
-    except botocore.exceptions.ClientError as e:
+    except ClientError as e:
         if e.response['Error']['Code'] != 'LimitExceeded':
             raise
 
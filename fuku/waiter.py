@@ -0,0 +1,126 @@
+import time
+
+from .parallel import chunks, imap_concurrent
+
+
+class WaitTimeout(Exception):
+    def __init__(self, holdouts):
+        super().__init__(f'timed out waiting for {", ".join(sorted(holdouts))}')
+        self.holdouts = holdouts
+
+
+class ServiceWaiter(object):
+    """ Poll ECS services until each has settled, printing progress as
+    counts, rollout states and events change.
+
+    Services are described ten at a time with batches polled concurrently.
+    Polling starts every `min_interval` seconds and backs off towards
+    `max_interval` while nothing changes. A service has settled once its
+    primary deployment runs the desired number of tasks or its rollout
+    fails, and with `stable` only once older deployments have drained.
+    """
+
+    def __init__(self, ecs_cli, cluster, services, stable=True, min_interval=1,
+                 max_interval=15, timeout=1800, workers=4, report_every=30, out=print):
+        self.ecs_cli = ecs_cli
+        self.cluster = cluster
+        self.services = list(services)
+        self.stable = stable
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.workers = workers
+        self.report_every = report_every
+        self.out = out
+        self.width = max([len(s) for s in self.services] or [0])
+        self.states = {}
+        self.seen_events = {}
+        self.polled = set()
+        self.settled = {}
+        self.settled_at = {}
+
+    def describe(self, batch):
+        response = self.ecs_cli.describe_services(cluster=self.cluster, services=batch)
+        found = {svc['serviceName']: svc for svc in response['services']}
+        return [(name, found.get(name)) for name in batch]
+
+    def get_state(self, svc):
+        if svc is None or svc.get('status') != 'ACTIVE':
+            return 'missing', 'MISSING'
+        primary = next(
+            (d for d in svc['deployments'] if d['status'] == 'PRIMARY'),
+            svc['deployments'][0]
+        )
+        rollout = primary.get('rolloutState', '')
+        counts = (
+            f'{primary["runningCount"]}/{primary["desiredCount"]} running,'
+            f' {primary["pendingCount"]} pending'
+        )
+        if len(svc['deployments']) > 1:
+            counts += f', {len(svc["deployments"]) - 1} draining'
+        if rollout:
+            counts += f', {rollout.lower()}'
+        if rollout == 'FAILED':
+            return counts, 'FAILED'
+        done = primary['runningCount'] == primary['desiredCount'] and not primary['pendingCount']
+        if self.stable:
+            done = done and len(svc['deployments']) == 1 and rollout in ('', 'COMPLETED')
+        if done:
+            return counts, 'SETTLED'
+        return counts, None
+
+    def print(self, name, msg):
+        self.out(f'{name.ljust(self.width)} | {msg}')
+
+    def update(self, name, svc):
+        state, result = self.get_state(svc)
+        if state != self.states.get(name):
+            self.states[name] = state
+            self.print(name, state)
+        seen = self.seen_events.setdefault(name, set())
+        events = (svc or {}).get('events', [])
+        # The first poll only marks existing events as seen.
+        first = name not in self.polled
+        self.polled.add(name)
+        for event in reversed(events):
+            if event['id'] not in seen:
+                seen.add(event['id'])
+                if not first:
+                    self.print(name, event['message'])
+        if result:
+            self.settled[name] = result
+            self.settled_at[name] = time.monotonic()
+            self.print(name, f'[{result}]')
+
+    def wait(self):
+        start = last_report = time.monotonic()
+        interval = self.min_interval
+        while True:
+            pending = [s for s in self.services if s not in self.settled]
+            if not pending:
+                return self.settled
+            before = dict(self.states)
+            for _, results, error in imap_concurrent(self.describe, chunks(pending, 10), self.workers):
+                if error:
+                    raise error
+                for name, svc in results:
+                    self.update(name, svc)
+            if len(self.settled) == len(self.services):
+                return self.settled
+
+            now = time.monotonic()
+            holdouts = [s for s in self.services if s not in self.settled]
+            if now - start > self.timeout:
+                raise WaitTimeout(holdouts)
+            if now - last_report > self.report_every:
+                last_report = now
+                self.out('waiting on ' + ', '.join(
+                    f'{s} ({self.states.get(s)})' for s in holdouts
+                ))
+
+            # Poll quickly while things are moving, back off when not.
+            if self.states == before:
+                interval = min(self.max_interval, interval * 1.5)
+            else:
+                interval = self.min_interval
+            time.sleep(interval)
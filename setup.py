@@ -31,17 +31,20 @@ setup(
         'Programming Language :: Python :: 3.5'
     ],
     license='BSD',
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests']),
     include_package_data=True,
     package_data={'': ['*.txt', '*.js', '*.html', '*.*']},
     install_requires=[
         'setuptools',
         'six',
         'boto3',
-        'fabric3',
         'colorama',
         'pprint',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'pg': ['psycopg2-binary'],
+    },
     scripts=[
         'fuku/scripts/fuku',
     ],
@@ -0,0 +1,9 @@
+import pytest
+
+
+@pytest.fixture
+def lines():
+    """ A list to pass as the `out` callable of progress reporters, via its
+    `append`, collecting what they print.
+    """
+    return []
@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'fuku', 'scripts', 'fuku')
+
+# Runs the real entry point, failing if every module gets imported or an
+# AWS SDK is loaded along the way.
+RUN = '''
+import runpy, sys
+from fuku.client import Client
+
+def all_modules(self):
+    raise AssertionError('Client.modules was used')
+
+Client.modules = property(all_modules)
+sys.argv = ['fuku'] + sys.argv[1:]
+runpy.run_path(%r, run_name='__main__')
+loaded = sorted(m for m in ('boto3', 'botocore') if m in sys.modules)
+assert not loaded, 'imported ' + ', '.join(loaded)
+modules = sorted(m for m in sys.modules if m.startswith('fuku.') and m.count('.') == 1)
+print(' '.join(modules))
+''' % SCRIPT
+
+
+def fuku(tmp_path, *argv):
+    env = dict(os.environ, HOME=str(tmp_path), PYTHONPATH=ROOT)
+    return subprocess.run(
+        [sys.executable, '-c', RUN] + list(argv),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, universal_newlines=True
+    )
+
+
+@pytest.mark.parametrize('argv, module', [
+    (['region', 'ls'], 'fuku.region'),
+    (['profile', 'ls'], 'fuku.profile'),
+])
+def test_listing_loads_only_the_invoked_module(tmp_path, argv, module):
+    result = fuku(tmp_path, *argv)
+    assert result.returncode == 0, result.stderr
+    loaded = result.stdout.split('\n')[-2].split()
+    assert module in loaded
+    for other in ('fuku.cluster', 'fuku.service', 'fuku.pg', 'fuku.node', 'fuku.deploy'):
+        assert other not in loaded
+
+
+def test_session_show_skips_modules_without_state(tmp_path):
+    os.makedirs(tmp_path / '.fukurc')
+    (tmp_path / '.fukurc' / 'db.json').write_text('{"region": {"selected": "ap-southeast-2"}}')
+    result = fuku(tmp_path, 'session', 'sh')
+    assert result.returncode == 0, result.stderr
+    assert 'region:' in result.stdout
+    loaded = result.stdout.split('\n')[-2].split()
+    assert 'fuku.region' in loaded
+    assert 'fuku.cluster' not in loaded
+
+
+def test_get_command_skips_global_options():
+    from fuku.client import Client
+    client = Client.__new__(Client)
+    assert client.get_command(['--app', 'web', '--log', 'DEBUG', 'service', 'ls']) == 'service'
+    assert client.get_command(['--no-cache']) is None
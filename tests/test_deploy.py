@@ -0,0 +1,56 @@
+import pytest
+
+from fuku.deploy import Deploy
+
+
+class FakeModule(object):
+    """ Stands in for the image, task and service modules, recording the
+    calls deploy makes.
+    """
+
+    def __init__(self, calls, bad=()):
+        self.calls = calls
+        self.bad = bad
+
+    def error(self, msg):
+        print(msg)
+        raise SystemExit()
+
+    def push(self, image):
+        self.calls.append(('push', image))
+
+    def image_name_to_uri(self, image):
+        return f'registry/{image}'
+
+    def iter_services(self):
+        return iter(['api', 'web', 'worker'])
+
+    def get_task(self, name):
+        return {}
+
+    def update(self, name, **kwargs):
+        if name in self.bad:
+            self.error(f'no such task "{name}"')
+        self.calls.append(('update', name))
+
+
+@pytest.fixture
+def deploy(monkeypatch):
+    calls = []
+    modules = {'image': FakeModule(calls), 'task': FakeModule(calls, bad={'web'}), 'service': FakeModule(calls)}
+    deploy = Deploy(db={})
+    monkeypatch.setattr(deploy, 'get_context', lambda: {'app': 'app', 'cluster': 'test'})
+    monkeypatch.setattr(deploy, 'get_module', modules.get)
+    deploy.calls = calls
+    return deploy
+
+
+def test_a_failing_service_fails_the_deploy(deploy, capsys):
+    with pytest.raises(SystemExit) as exc:
+        deploy.deploy('app:1', wait=False, workers=2)
+    assert exc.value.code == 1
+    out = capsys.readouterr().out
+    assert 'no such task "web"\n' in out and 'web [FAILED]\n' in out
+    assert 'api [UPDATED]' in out and 'worker [UPDATED]' in out
+    assert out.endswith('failed to deploy: web\n')
+    assert ('update', 'web') not in deploy.calls
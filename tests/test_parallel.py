@@ -0,0 +1,204 @@
+import sys
+import threading
+import time
+
+import pytest
+
+from fuku.module import Module
+from fuku.parallel import RateLimiter, StepFailed, chunks, imap_concurrent, run_graph, throttled
+
+
+class Throttled(Exception):
+    response = {'Error': {'Code': 'Throttling'}}
+
+
+def test_rate_limiter_bursts_then_limits():
+    limiter = RateLimiter(20, burst=5)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.acquire()
+    assert time.monotonic() - start < 0.05
+    for _ in range(4):
+        limiter.acquire()
+    # Four more calls at 20 per second.
+    assert time.monotonic() - start >= 0.15
+
+
+def test_rate_limiter_backoff_and_recover():
+    limiter = RateLimiter(8)
+    limiter.backoff()
+    limiter.backoff()
+    assert limiter.rate == 2
+    for _ in range(100):
+        limiter.recover()
+    assert limiter.rate == 8
+    for _ in range(20):
+        limiter.backoff()
+    assert limiter.rate == limiter.min_rate
+
+
+def test_throttled_retries(monkeypatch):
+    monkeypatch.setattr(time, 'sleep', lambda s: None)
+    calls = []
+
+    def call():
+        calls.append(1)
+        if len(calls) < 3:
+            raise Throttled()
+        return 'ok'
+
+    limiter = RateLimiter(1000)
+    assert throttled(limiter, call) == 'ok'
+    assert len(calls) == 3
+
+
+def test_throttled_raises_other_errors():
+    def call():
+        raise KeyError('boom')
+
+    with pytest.raises(KeyError):
+        throttled(RateLimiter(1000), call)
+
+
+def test_imap_concurrent():
+    def square(x):
+        if x == 3:
+            raise ValueError('three')
+        return x * x
+
+    results = {item: (result, error) for item, result, error in imap_concurrent(square, range(5), 3)}
+    assert {k: v[0] for k, v in results.items() if k != 3} == {0: 0, 1: 1, 2: 4, 4: 16}
+    assert isinstance(results[3][1], ValueError)
+
+
+def test_imap_concurrent_contains_module_errors(capsys):
+    module = Module('test', db={})
+
+    def check(x):
+        if x == 1:
+            module.error('bad item')
+        return x
+
+    results = {item: (result, error) for item, result, error in imap_concurrent(check, range(3))}
+    assert results[0] == (0, None) and results[2] == (2, None)
+    assert isinstance(results[1][1], SystemExit)
+    assert capsys.readouterr().out == 'bad item\n'
+
+
+def test_chunks():
+    assert list(chunks(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(chunks([], 3)) == []
+
+
+def test_run_graph_passes_results_in_dependency_order():
+    order = []
+    lock = threading.Lock()
+
+    def step(name, value):
+        def func(results):
+            with lock:
+                order.append(name)
+            return value + sum(results.values())
+        return func
+
+    steps = {
+        'vpc': ([], step('vpc', 1)),
+        'subnet': (['vpc'], step('subnet', 10)),
+        'sg': (['vpc'], step('sg', 100)),
+        'cluster': (['subnet', 'sg'], step('cluster', 1000)),
+    }
+    journal = run_graph(steps, workers=4)
+    assert journal == {'vpc': 1, 'subnet': 11, 'sg': 101, 'cluster': 1112}
+    assert order[0] == 'vpc' and order[-1] == 'cluster'
+
+
+def test_run_graph_resumes_from_journal():
+    ran = []
+
+    def step(name):
+        def func(results):
+            ran.append(name)
+            return name
+        return func
+
+    steps = {'a': ([], step('a')), 'b': (['a'], step('b'))}
+    checkpoints = []
+    journal = run_graph(steps, journal={'a': 'done'}, on_done=lambda name, j: checkpoints.append(name))
+    assert ran == ['b']
+    assert journal == {'a': 'done', 'b': 'b'}
+    assert checkpoints == ['b']
+
+
+def test_run_graph_stops_after_failure():
+    ran = []
+
+    def fail(results):
+        raise RuntimeError('no')
+
+    steps = {
+        'a': ([], fail),
+        'b': (['a'], lambda results: ran.append('b')),
+    }
+    journal = {}
+    with pytest.raises(StepFailed) as info:
+        run_graph(steps, journal=journal)
+    assert info.value.step == 'a'
+    assert ran == []
+    assert journal == {}
+
+
+def test_run_graph_rejects_bad_graphs():
+    with pytest.raises(ValueError, match='unknown'):
+        run_graph({'a': (['missing'], lambda r: None)})
+    with pytest.raises(ValueError, match='cycle'):
+        run_graph({'a': (['b'], lambda r: None), 'b': (['a'], lambda r: None)})
+
+
+def test_run_graph_turns_exits_into_step_failures():
+    # Module.error exits rather than raising an exception.
+    steps = {
+        'a': ([], lambda results: sys.exit()),
+        'b': ([], lambda results: 'b'),
+    }
+    journal = {}
+    with pytest.raises(StepFailed) as info:
+        run_graph(steps, journal=journal)
+    assert info.value.step == 'a'
+    assert isinstance(info.value.error, SystemExit)
+    assert 'a' not in journal
+
+
+def test_run_graph_runs_serial_steps_first_on_the_calling_thread():
+    order = []
+
+    def step(name):
+        def func(results):
+            order.append((name, threading.current_thread() is threading.main_thread()))
+            return name
+        return func
+
+    steps = {
+        'prompt': ([], step('prompt')),
+        'other': ([], step('other')),
+        'last': (['prompt', 'other'], step('last')),
+    }
+    run_graph(steps, serial=['prompt'])
+    assert order[0] == ('prompt', True)
+    assert ('other', False) in order
+
+
+def test_run_graph_serial_steps_cannot_wait_on_the_pool():
+    steps = {'a': ([], lambda r: None), 'b': (['a'], lambda r: None)}
+    with pytest.raises(ValueError, match='serial'):
+        run_graph(steps, serial=['b'])
+
+
+def test_run_graph_serial_failures_stop_everything():
+    ran = []
+    steps = {
+        'prompt': ([], lambda r: sys.exit()),
+        'other': ([], lambda r: ran.append('other')),
+    }
+    with pytest.raises(StepFailed):
+        run_graph(steps, serial=['prompt'])
+    assert ran == []
@@ -0,0 +1,109 @@
+from fuku.pg import TableProgress, select_toc
+
+TOC = """;
+; Archive created at 2026-10-18 00:00:00 UTC
+;
+215; 1259 16385 TABLE public foo app
+216; 1259 16390 SEQUENCE public foo_id_seq app
+3301; 0 0 SEQUENCE OWNED BY public foo_id_seq app
+217; 1259 16400 TABLE public big app
+218; 1259 16410 TABLE public other app
+219; 1255 16500 FUNCTION public touch() app
+3200; 2604 16391 DEFAULT public foo id app
+3400; 0 16385 TABLE DATA public foo app
+3401; 0 16400 TABLE DATA public big app
+3402; 0 16410 TABLE DATA public other app
+3500; 0 0 SEQUENCE SET public foo_id_seq app
+3600; 2606 16420 CONSTRAINT public foo foo_pkey app
+3601; 1259 16430 INDEX public big_created_idx app
+3602; 2606 16440 FK CONSTRAINT public other other_foo_fk app
+3603; 2606 16450 FK CONSTRAINT public big big_other_fk app
+3604; 2620 16460 TRIGGER public big big_touch app
+""".splitlines()
+
+SCRIPT = """
+--
+-- TOC entry 216 (class 1259 OID 16390)
+-- Name: foo_id_seq; Type: SEQUENCE; Schema: public; Owner: -
+--
+
+CREATE SEQUENCE public.foo_id_seq;
+
+--
+-- TOC entry 3301 (class 0 OID 0)
+-- Dependencies: 216
+-- Name: foo_id_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: -
+--
+
+ALTER SEQUENCE public.foo_id_seq OWNED BY public.foo.id;
+
+--
+-- TOC entry 3601 (class 1259 OID 16430)
+-- Name: big_created_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX big_created_idx ON public.big USING btree (created);
+
+--
+-- TOC entry 3602 (class 2606 OID 16440)
+-- Name: other other_foo_fk; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.other
+    ADD CONSTRAINT other_foo_fk FOREIGN KEY (foo_id) REFERENCES public.foo(id);
+
+--
+-- TOC entry 3603 (class 2606 OID 16450)
+-- Name: big big_other_fk; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.big
+    ADD CONSTRAINT big_other_fk FOREIGN KEY (other_id) REFERENCES public.other(id);
+"""
+
+
+def ids(result):
+    return [int(line.split(';')[0]) for line in result['entries'] if not line.startswith(';')]
+
+
+def test_select_toc_without_filters_keeps_everything():
+    result = select_toc(TOC)
+    assert result['entries'] == TOC
+    assert result['tables'] == 3
+
+
+def test_select_toc_include_keeps_only_the_selected_tables():
+    result = select_toc(TOC, SCRIPT, tables=['foo'])
+    # The table, its sequence, default, data, key, and the foreign key
+    # that a clean restore of foo would otherwise drop.
+    assert ids(result) == [215, 216, 3301, 3200, 3400, 3500, 3600, 3602]
+    assert result['tables'] == 1
+
+
+def test_select_toc_exclude_drops_the_whole_table():
+    result = select_toc(TOC, SCRIPT, exclude_tables=['big'])
+    kept = ids(result)
+    # Nothing of big may be restored, or a clean restore would empty it.
+    for toc_id in (217, 3401, 3601, 3604):
+        assert toc_id not in kept
+    # Its foreign key to a restored table has to be dropped and re-added.
+    assert 3603 in kept
+    assert 219 in kept
+    assert result['tables'] == 2
+
+
+def test_select_toc_patterns_match_schema_qualified_names():
+    assert ids(select_toc(TOC, SCRIPT, tables=['public.oth*'])) == [218, 3402, 3602, 3603]
+
+
+def test_table_progress(capsys):
+    progress = TableProgress(total=2)
+    progress.feed('pg_restore: processing data for table "public.foo"')
+    progress.feed('pg_restore: finished item 3400 TABLE DATA foo')
+    progress.feed('pg_restore: creating INDEX "public.foo_idx"')
+    progress.feed('pg_restore: error: could not execute query')
+    lines = capsys.readouterr().out.splitlines()
+    assert 'started public.foo' in lines[0]
+    assert '[1/2]' in lines[1] and 'finished foo' in lines[1]
+    assert lines[2] == 'pg_restore: error: could not execute query'
+    assert len(lines) == 3
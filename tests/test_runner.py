@@ -0,0 +1,139 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from fuku.runner import CommandError, local, local_async, stream
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # A killed child may linger as a zombie until its reaper gets to it.
+    with open(f'/proc/{pid}/stat') as inf:
+        return inf.read().split(')')[-1].split()[0] != 'Z'
+
+
+def test_local_captures_stripped_output():
+    out = local('echo " hello "; echo oops >&2', capture=True)
+    assert out == 'hello'
+    assert out.stderr == 'oops'
+    assert out.return_code == 0 and out.succeeded and not out.failed
+
+
+def test_local_runs_lists_without_a_shell():
+    assert local(['echo', '$HOME; ls'], capture=True) == '$HOME; ls'
+
+
+def test_local_raises_on_failure():
+    with pytest.raises(CommandError) as exc:
+        local('echo bad >&2; exit 3', capture=True)
+    assert exc.value.out.return_code == 3
+    assert str(exc.value) == 'bad'
+
+
+def test_local_can_ignore_failure():
+    out = local('exit 2', capture=True, ignore_errors=True)
+    assert out.return_code == 2 and out.failed
+
+
+def test_local_passes_lines_to_callbacks():
+    seen = []
+    out = local('printf "a\\nb\\n"; echo c >&2', on_stdout=seen.append, on_stderr=seen.append)
+    assert sorted(seen) == ['a', 'b', 'c']
+    assert out == ''
+
+
+def test_local_feeds_stdin(tmp_path):
+    assert local('tr a-z A-Z', capture=True, stdin='shout') == 'SHOUT'
+    path = tmp_path / 'in'
+    path.write_bytes(b'file')
+    with open(path, 'rb') as inf:
+        assert local('cat', capture=True, stdin=inf) == 'file'
+
+
+def test_local_keeps_the_tail_of_large_output():
+    out = local('seq 1 1000', capture=True, max_capture=100)
+    assert out.truncated
+    assert out.endswith('1000') and not out.startswith('1\n')
+
+
+def test_local_timeout_kills_the_process_group(tmp_path):
+    pid_path = tmp_path / 'pid'
+    start = time.monotonic()
+    with pytest.raises(CommandError) as exc:
+        local(f'sleep 30 & echo $! > {pid_path}; wait', capture=True, timeout=0.5)
+    assert time.monotonic() - start < 10
+    assert exc.value.out.stderr == 'timed out after 0.5s'
+    assert not is_running(int(pid_path.read_text()))
+
+
+def test_local_async():
+    async def main():
+        return await asyncio.gather(
+            local_async('sleep 0.2; echo one', capture=True),
+            local_async(['sh', '-c', 'echo two >&2; exit 1'], capture=True, ignore_errors=True),
+            local_async('cat', capture=True, stdin=b'three'),
+        )
+
+    one, two, three = asyncio.run(main())
+    assert one == 'one'
+    assert two.return_code == 1 and two.stderr == 'two'
+    assert three == 'three'
+
+
+def test_local_async_raises_on_failure():
+    with pytest.raises(CommandError):
+        asyncio.run(local_async('exit 1', capture=True))
+
+
+def test_local_async_timeout_kills_the_process_group(tmp_path):
+    pid_path = tmp_path / 'pid'
+    with pytest.raises(CommandError) as exc:
+        asyncio.run(local_async(f'sleep 30 & echo $! > {pid_path}; wait', capture=True, timeout=0.5))
+    assert exc.value.out.stderr == 'timed out after 0.5s'
+    assert not is_running(int(pid_path.read_text()))
+
+
+def test_stream_read():
+    with stream('seq 1 3') as pipe:
+        assert pipe.read() == b'1\n2\n3\n'
+
+
+def test_stream_write(tmp_path):
+    path = tmp_path / 'out'
+    with open(path, 'wb') as outf:
+        with stream('tr a-z A-Z', 'w', stdout=outf) as pipe:
+            pipe.write(b'quiet')
+    assert path.read_bytes() == b'QUIET'
+
+
+def test_stream_raises_on_failure():
+    lines = []
+    with pytest.raises(CommandError) as exc:
+        with stream('echo bad >&2; exit 1', on_stderr=lines.append) as pipe:
+            pipe.read()
+    assert str(exc.value) == 'bad'
+    assert lines == ['bad']
+
+
+def test_stream_failure_takes_precedence_over_broken_pipe():
+    with pytest.raises(CommandError):
+        with stream('exit 1', 'w') as pipe:
+            for _ in range(1000):
+                pipe.write(b'x' * 65536)
+
+
+def test_stream_kills_the_command_when_the_block_fails():
+    with pytest.raises(KeyError):
+        with stream('sleep 30') as pipe:
+            raise KeyError(pipe)
+
+
+def test_stream_rejects_bad_modes():
+    with pytest.raises(ValueError):
+        with stream('true', 'rw'):
+            pass
@@ -0,0 +1,121 @@
+import io
+
+import pytest
+
+from fuku import s3stream
+from fuku.s3stream import MB, MIN_PART_SIZE, MultipartUpload, RangedDownload
+
+
+class Body(object):
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class FakeS3(object):
+    def __init__(self, data=b'', fail_part=None):
+        self.data = data
+        self.fail_part = fail_part
+        self.parts = {}
+        self.completed = None
+        self.aborted = False
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {'UploadId': 'upload'}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_part:
+            raise RuntimeError('part failed')
+        self.parts[PartNumber] = Body
+        return {'ETag': f'etag{PartNumber}'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        numbers = [p['PartNumber'] for p in MultipartUpload['Parts']]
+        self.completed = b''.join(self.parts[n] for n in numbers)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted = True
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.data)}
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = map(int, Range[len('bytes='):].split('-'))
+        return {'Body': Body(self.data[start:end + 1])}
+
+
+def test_part_size_is_at_least_the_s3_minimum():
+    assert MultipartUpload(None, 'b', 'k', part_size=1).part_size == MIN_PART_SIZE
+
+
+def test_part_sizes_grow_to_fit_the_part_limit():
+    upload = MultipartUpload(None, 'b', 'k', part_size=MIN_PART_SIZE)
+    sizes = [upload.get_part_size(n) for n in range(1, s3stream.MAX_PARTS + 1)]
+    assert sizes[0] == sizes[999] == MIN_PART_SIZE
+    assert sizes[1000] == 2 * MIN_PART_SIZE
+    assert sizes == sorted(sizes)
+    assert max(sizes) <= s3stream.MAX_PART_SIZE
+    # Even the smallest part size holds several terabytes.
+    assert sum(sizes) > 4 * 1024 * 1024 * MB
+
+
+def test_upload_splits_the_stream_into_parts(monkeypatch, lines):
+    monkeypatch.setattr(s3stream, 'MIN_PART_SIZE', 1)
+    data = bytes(range(256)) * 1000
+    s3 = FakeS3()
+    result = MultipartUpload(s3, 'b', 'k', part_size=100000, workers=2, out=lines.append).upload(io.BytesIO(data))
+    assert s3.completed == data
+    assert result['parts'] == 3
+    assert result['size'] == result['stored_size'] == len(data)
+    assert lines[-1].startswith('k: 0.2MB read, 0.2MB stored')
+
+
+def test_upload_of_an_empty_stream_has_one_part(lines):
+    s3 = FakeS3()
+    result = MultipartUpload(s3, 'b', 'k', out=lines.append).upload(io.BytesIO(b''))
+    assert s3.completed == b''
+    assert result['parts'] == 1
+
+
+def test_upload_aborts_on_failure(monkeypatch, lines):
+    monkeypatch.setattr(s3stream, 'MIN_PART_SIZE', 1)
+    s3 = FakeS3(fail_part=2)
+    upload = MultipartUpload(s3, 'b', 'k', part_size=1000, out=lines.append)
+    with pytest.raises(RuntimeError):
+        upload.upload(io.BytesIO(b'x' * 5000))
+    assert s3.aborted
+    assert s3.completed is None
+
+
+def test_upload_refuses_to_exceed_the_part_limit(monkeypatch, lines):
+    monkeypatch.setattr(s3stream, 'MIN_PART_SIZE', 1)
+    monkeypatch.setattr(s3stream, 'MAX_PARTS', 3)
+    s3 = FakeS3()
+    upload = MultipartUpload(s3, 'b', 'k', part_size=10, out=lines.append)
+    with pytest.raises(RuntimeError, match='too large'):
+        upload.upload(io.BytesIO(b'x' * 100))
+    assert s3.aborted
+
+
+def test_ranged_download_writes_in_order(lines):
+    data = bytes(range(256)) * 1000
+    s3 = FakeS3(data)
+    out = io.BytesIO()
+    result = RangedDownload(s3, 'b', 'k', part_size=7000, workers=4, out=lines.append).download(out)
+    assert out.getvalue() == data
+    assert result['parts'] == 37
+    assert result['size'] == result['stored_size'] == len(data)
+
+
+def test_zstd_round_trip(monkeypatch, lines):
+    pytest.importorskip('zstandard')
+    monkeypatch.setattr(s3stream, 'MIN_PART_SIZE', 1)
+    data = b'some very compressible text ' * 50000
+    s3 = FakeS3()
+    result = MultipartUpload(s3, 'b', 'k', part_size=10000, compress=3, out=lines.append).upload(io.BytesIO(data))
+    assert result['stored_size'] < result['size']
+    out = io.BytesIO()
+    RangedDownload(FakeS3(s3.completed), 'b', 'k', part_size=1000, decompress=True, out=lines.append).download(out)
+    assert out.getvalue() == data
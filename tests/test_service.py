@@ -0,0 +1,40 @@
+import pytest
+
+from fuku.service import EcsService
+
+
+class FakeClient(object):
+    def __init__(self, modules):
+        self.modules = modules
+
+    def get_module(self, name):
+        return self.modules[name]
+
+
+class FakeTask(object):
+    def get_task(self, name):
+        return {}
+
+
+@pytest.fixture
+def service(monkeypatch):
+    service = EcsService(db={}, client=FakeClient({'task': FakeTask()}))
+    service.updated = []
+
+    def update(task_name, **kwargs):
+        if task_name == 'web':
+            service.error(f'no such task "{task_name}"')
+        service.updated.append(task_name)
+    monkeypatch.setattr(service, 'update', update)
+    return service
+
+
+def test_redeploy_reports_each_failure_and_exits_non_zero(service, capsys):
+    with pytest.raises(SystemExit) as exc:
+        service.redeploy(['api', 'web', 'worker'], workers=2)
+    assert exc.value.code == 1
+    out = capsys.readouterr().out
+    assert 'no such task "web"\n' in out and 'web [FAILED]\n' in out
+    assert 'api [UPDATED]\n' in out and 'worker [UPDATED]\n' in out
+    assert out.endswith('failed to redeploy: web\n')
+    assert sorted(service.updated) == ['api', 'worker']
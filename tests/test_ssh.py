@@ -0,0 +1,63 @@
+import subprocess
+
+import pytest
+
+from fuku import ssh
+
+
+class Completed(object):
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """ Commands passed to `subprocess.run`, with every master check
+    failing as though no master were open yet.
+    """
+    calls = []
+
+    def run(args, **kwargs):
+        calls.append((args, kwargs))
+        return Completed(255 if '-O' in args else 0)
+    monkeypatch.setattr(subprocess, 'run', run)
+    monkeypatch.setattr(ssh, 'get_control_path', lambda: '/tmp/fuku-ssh/%C')
+    monkeypatch.setattr(ssh, '_masters', {})
+    return calls
+
+
+def test_commands_never_persist_their_connection(calls):
+    args = ssh.ssh_args('10.0.0.5', 'uptime', bastion='1.2.3.4')
+    assert not any(a.startswith('ControlPersist') for a in args)
+    assert args[-2:] == ['ec2-user@10.0.0.5', 'uptime']
+
+
+def test_masters_start_detached_from_the_callers_streams(calls):
+    ssh.open_master('10.0.0.5', bastion='1.2.3.4')
+    started = [(args, kwargs) for args, kwargs in calls if '-f' in args]
+    assert [args[-1] for args, kwargs in started] == ['ec2-user@1.2.3.4', 'ec2-user@10.0.0.5']
+    for args, kwargs in started:
+        assert f'ControlPersist={ssh.CONTROL_PERSIST}' in args
+        for stream in ('stdin', 'stdout', 'stderr'):
+            assert kwargs[stream] == subprocess.DEVNULL
+
+
+def test_masters_open_once_per_host(calls):
+    ssh.open_master('10.0.0.5')
+    ssh.open_master('10.0.0.5')
+    assert len(calls) == 2
+
+
+def test_an_open_master_is_reused(calls, monkeypatch):
+    monkeypatch.setattr(subprocess, 'run', lambda args, **kwargs: calls.append(args) or Completed(0))
+    ssh.open_master('10.0.0.5')
+    assert calls == [['ssh'] + ssh.get_options() + ['-O', 'check', 'ec2-user@10.0.0.5']]
+
+
+def test_a_slow_master_is_given_up_on(calls, monkeypatch):
+    def run(args, timeout=None, **kwargs):
+        if '-f' in args:
+            raise subprocess.TimeoutExpired(args, timeout)
+        return Completed(255)
+    monkeypatch.setattr(subprocess, 'run', run)
+    ssh.open_master('10.0.0.5', timeout=1)
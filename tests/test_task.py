@@ -0,0 +1,29 @@
+import argparse
+
+import pytest
+
+from fuku.task import Task
+
+
+def edit_args(argv):
+    parser = argparse.ArgumentParser()
+    Task(db={}).add_arguments(parser)
+    return parser.parse_args(['edit', 'web'] + argv)
+
+
+@pytest.mark.parametrize('argv, message', [
+    (['--port', '80'], 'invalid port mapping "80", expected HOST:CONTAINER'),
+    (['--port', 'http:80'], 'invalid port mapping "http:80", expected HOST:CONTAINER'),
+    (['--port', '80:8o'], 'invalid port mapping "80:8o", expected HOST:CONTAINER'),
+    (['--unset-port', 'http'], 'invalid port "http"'),
+    (['--env', 'DEBUG'], 'invalid environment variable "DEBUG", expected KEY=VALUE'),
+])
+def test_edit_rejects_bad_values_before_editing(monkeypatch, capsys, argv, message):
+    task = Task(db={})
+
+    def editing(name):
+        raise AssertionError('started editing')
+    monkeypatch.setattr(task, 'editing', editing)
+    with pytest.raises(SystemExit):
+        task.handle_edit(edit_args(argv + ['--image', 'web:2']))
+    assert capsys.readouterr().out.strip() == message
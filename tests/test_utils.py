@@ -0,0 +1,22 @@
+import pytest
+
+from fuku.utils import parse_duration
+
+
+@pytest.mark.parametrize('value, seconds', [
+    ('30', 30),
+    ('30s', 30),
+    ('1.5m', 90),
+    ('12h', 43200),
+    ('2d', 172800),
+    ('1w', 604800),
+    (' 5m ', 300),
+])
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == seconds
+
+
+@pytest.mark.parametrize('value', ['', 'm', '5y', '-5m', '5 m', '1h30m'])
+def test_parse_duration_invalid(value):
+    with pytest.raises(ValueError):
+        parse_duration(value)
@@ -0,0 +1,104 @@
+import pytest
+
+from fuku.waiter import ServiceWaiter, WaitTimeout
+
+
+def deployment(running, desired, pending=0, status='PRIMARY', rollout='IN_PROGRESS'):
+    return {
+        'status': status, 'runningCount': running, 'desiredCount': desired,
+        'pendingCount': pending, 'rolloutState': rollout,
+    }
+
+
+def service(name, deployments, events=()):
+    return {
+        'serviceName': name,
+        'status': 'ACTIVE',
+        'deployments': list(deployments),
+        'events': [{'id': e, 'message': f'event {e}'} for e in reversed(events)],
+    }
+
+
+class FakeEcs(object):
+    """ Returns a scripted sequence of descriptions per service, repeating
+    the last, with None for a service that doesn't exist.
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.calls = 0
+
+    def describe_services(self, cluster, services):
+        self.calls += 1
+        found = []
+        for name in services:
+            states = self.script[name]
+            found.append(states.pop(0) if len(states) > 1 else states[0])
+        return {'services': [svc for svc in found if svc is not None]}
+
+
+def make_waiter(script, out, **kwargs):
+    kwargs.setdefault('min_interval', 0)
+    kwargs.setdefault('max_interval', 0)
+    return ServiceWaiter(FakeEcs(script), 'cluster', list(script), out=out, **kwargs)
+
+
+def test_settles_once_old_deployments_drain(lines):
+    script = {'web': [
+        service('web', [deployment(1, 2), deployment(2, 2, status='ACTIVE')]),
+        service('web', [deployment(2, 2), deployment(1, 2, status='ACTIVE')]),
+        service('web', [deployment(2, 2, rollout='COMPLETED')]),
+    ]}
+    waiter = make_waiter(script, lines.append)
+    assert waiter.wait() == {'web': 'SETTLED'}
+    assert waiter.ecs_cli.calls == 3
+    assert lines[-1] == 'web | [SETTLED]'
+
+
+def test_settles_without_draining_when_not_stable(lines):
+    script = {'web': [service('web', [deployment(2, 2), deployment(1, 2, status='ACTIVE')])]}
+    waiter = make_waiter(script, lines.append, stable=False)
+    assert waiter.wait() == {'web': 'SETTLED'}
+
+
+def test_failed_rollout_and_missing_service(lines):
+    script = {
+        'web': [service('web', [deployment(0, 2, rollout='FAILED')])],
+        'gone': [None],
+    }
+    waiter = make_waiter(script, lines.append)
+    assert waiter.wait() == {'web': 'FAILED', 'gone': 'MISSING'}
+
+
+def test_existing_events_are_skipped_and_new_ones_printed(lines):
+    script = {'web': [
+        service('web', [deployment(0, 1)], events=['old']),
+        service('web', [deployment(0, 1)], events=['old', 'new']),
+        service('web', [deployment(1, 1, rollout='COMPLETED')], events=['old', 'new']),
+    ]}
+    waiter = make_waiter(script, lines.append)
+    waiter.wait()
+    assert 'web | event old' not in lines
+    assert lines.count('web | event new') == 1
+
+
+def test_events_after_an_empty_first_poll_are_printed(lines):
+    script = {'web': [
+        service('web', [deployment(0, 1)]),
+        service('web', [deployment(0, 1, rollout='FAILED')], events=['task failed to start']),
+    ]}
+    waiter = make_waiter(script, lines.append)
+    assert waiter.wait() == {'web': 'FAILED'}
+    assert 'web | event task failed to start' in lines
+
+
+def test_timeout_reports_holdouts(lines):
+    script = {
+        'web': [service('web', [deployment(2, 2, rollout='COMPLETED')])],
+        'worker': [service('worker', [deployment(0, 1)])],
+    }
+    waiter = make_waiter(script, lines.append, timeout=0)
+    with pytest.raises(WaitTimeout) as info:
+        waiter.wait()
+    assert info.value.holdouts == ['worker']
+    assert waiter.settled == {'web': 'SETTLED'}